@@ -1,26 +1,51 @@
 import logging
 from os import path
+import click
 from flask import Flask
 from sqlalchemy import select
 
 from config import Config
-from database import db, DB_NAME
+from database import db, DB_NAME, add_missing_columns, set_sqlite_pragmas
 from app.rest import rest_blueprint
 from . import models
 from . import keys
 from . import auth
-
-def create_app():
+from . import environment
+from . import idempotency
+from . import json_backend
+from . import search
+from . import exports
+from . import datagen
+from . import profiling
+from .ledger import ledger_writer
+from .metrics import request_metrics
+from .query_detector import query_detector
+from .replica import replica_router
+from .roles import role_registry
+
+def create_app(config=Config):
     app = Flask(__name__)
     # app.config['SECRET_KEY'] = keys.API_KEYS['secret_key']
     # app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
-    app.config.from_object(Config)
+    app.config.from_object(config)
+    json_backend.init_app(app)
     db.init_app(app)
 
     with app.app_context():
+        # Before anything connects
+        set_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
         db.create_all()
+        add_missing_columns(db.engine, db.metadata)
+        role_registry.load()
+        replica_router.init_app(app, start_sync=not environment.is_testing())
+        for engine in filter(None, (db.engine, replica_router.engine)):
+            request_metrics.init_app(app, engine)
+            query_detector.init_app(app, engine)
 
     app.register_blueprint(rest_blueprint)
+    idempotency.init_app(app, start_sweeper=not environment.is_testing())
+    ledger_writer.init_app(app, start_flusher=not environment.is_testing())
+    profiling.init_app(app)
 
     @app.cli.command('db_create')
     def db_create():
@@ -89,6 +114,79 @@ def create_app():
         print('Database seeded')
 
 
+    @app.cli.command('db_generate')
+    @click.option('--users', type=int, default=100000, show_default=True)
+    @click.option('--products', type=int, default=1000000, show_default=True)
+    @click.option('--ledger', type=int, default=1000000, show_default=True)
+    @click.option('--vendor-share', type=float, default=0.05, show_default=True, help='Share of users that are vendors')
+    @click.option('--popularity', type=click.Choice(datagen.POPULARITY_DISTRIBUTIONS), default='zipf', show_default=True,
+                  help='How purchases are spread over products')
+    @click.option('--zipf-s', type=float, default=1.1, show_default=True, help='Exponent of the zipf popularity')
+    @click.option('--seed', type=int, default=0, show_default=True)
+    @click.option('--batch-size', type=int, default=50000, show_default=True)
+    def db_generate(users, products, ledger, vendor_share, popularity, zipf_s, seed, batch_size):
+        """Append a synthetic dataset for load testing, e.g. db_generate --users 1000000 --products 5000000"""
+        try:
+            datagen.generate(
+                db.engine, users, products, ledger, vendor_share=vendor_share, popularity=popularity,
+                zipf_s=zipf_s, seed=seed, batch_size=batch_size, progress=datagen.timed_progress(print),
+            )
+        except ValueError as error:
+            raise click.UsageError(str(error))
+        print('Database generated')
+
+
+    @app.cli.command('idempotency_sweep')
+    def idempotency_sweep():
+        swept = idempotency.sweep_expired(app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_SWEEP_BATCH'])
+        print(f'Swept {swept} expired idempotency keys')
+
+
+    @app.cli.command('search_rebuild')
+    def search_rebuild():
+        """Create the product search index if missing and reindex every product"""
+        with db.engine.begin() as connection:
+            search.create_index(connection)
+        print('Product search index rebuilt')
+
+
+    @app.cli.command('profile_header')
+    @click.option('--mode', type=click.Choice(profiling.PROFILE_MODES), default='deterministic', show_default=True)
+    @click.option('--ttl', type=int, default=300, show_default=True, help='Seconds the header is valid for')
+    def profile_header(mode, ttl):
+        """Print an X-Profile header value that gets requests profiled when PROFILER_ENABLED"""
+        print(profiling.make_header(app.config['PROFILER_SECRET'] or app.config['SECRET_KEY'], mode, ttl))
+
+
+    @app.cli.command('export')
+    @click.argument('table', type=click.Choice(list(exports.EXPORTS)))
+    @click.option('--format', 'export_format', type=click.Choice(list(exports.EXPORT_FORMATS)), default='ndjson')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write to, stdout by default')
+    @click.option('--seller-id', type=int, help='Only products or ledger entries of this vendor')
+    def export(table, export_format, output, seller_id):
+        """Stream a whole table as NDJSON or CSV, e.g. export ledger --format csv --output ledger.csv"""
+        query = exports.EXPORTS[table]
+        if seller_id is not None:
+            if table == 'users':
+                raise click.UsageError('--seller-id only applies to products and ledger')
+            query = query.where(query.selected_columns.seller_id == seller_id)
+        for chunk in exports.export_chunks(query, export_format):
+            output.write(chunk)
+
+
+    @app.cli.command('coin_inventory_set')
+    @click.argument('machine_id', type=int)
+    @click.argument('coins', nargs=-1)
+    def coin_inventory_set(machine_id, coins):
+        """Set the coins a machine has for change, e.g. coin_inventory_set 1 100=20 50=40 5=100"""
+        for coin_count in coins:
+            coin, count = (int(value) for value in coin_count.split('='))
+            db.session.merge(models.CoinInventory(machine_id=machine_id, coin=coin, count=count))
+        db.session.commit()
+        for row in models.CoinInventory.query.filter_by(machine_id=machine_id).all():
+            print(row)
+
+
     @app.cli.command('db_display')
     def db_display():
         all_roles = models.Role.query.all()
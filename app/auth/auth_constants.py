@@ -10,3 +10,9 @@ AUTH_SECRET_KEY = '12696d55cddefaa227aad77e7a3c1d2b42e721d062d33f192867085efadd0
 JWT_AUDIENCE = "https://example.com"
 
 LOGIN_EXPIRY_TIME = 60 * 60 * 24 * 500  # 500 days
+
+# Verified tokens are cached so that repeated requests skip the signature check
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60 * 5  # 5 minutes
+# A token version bumped by another worker is seen within this many seconds
+TOKEN_VERSION_CACHE_TTL = 5
@@ -1,12 +1,158 @@
+import collections
+import hashlib
 import logging
+import threading
 import time
 import jwt
 import jwt.exceptions
+from sqlalchemy import select, update
 
+from database import db
+from app.models import User
 from . import auth_constants
 
 
-def generate_base_jwt_payload(expiry=auth_constants.LOGIN_EXPIRY_TIME, user_id=None):
+class VerifiedTokenCache():
+    """Bounded LRU/TTL cache of verified token -> claims.
+
+    Keyed by a SHA256 digest of the token so that raw tokens aren't kept
+    around. Entries of a user can be dropped with invalidate_user. Tokens are
+    revoked by bumping the token version of their user, see bump_token_version.
+    """
+
+    def __init__(self, max_size=auth_constants.TOKEN_CACHE_SIZE, ttl=auth_constants.TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # digest -> (expires_at, claims)
+        self._user_digests = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(digest)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token, claims):
+        digest = self.digest(token)
+        with self._lock:
+            self._entries[digest] = (time.monotonic() + self.ttl, claims)
+            self._entries.move_to_end(digest)
+            self._user_digests[claims.get('user_id')].add(digest)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for digest in list(self._user_digests.pop(user_id, ())):
+                self._remove(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_digests.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            user_digests = self._user_digests.get(entry[1].get('user_id'))
+            if user_digests is not None:
+                user_digests.discard(digest)
+                if not user_digests:
+                    del self._user_digests[entry[1].get('user_id')]
+
+
+token_cache = VerifiedTokenCache()
+
+class TokenVersionCache():
+    """user_id -> token_version of the user, None for a user that doesn't exist.
+
+    Tokens carry the token version of their user at the time they were
+    issued, and only tokens of the current version are accepted. Bumping it
+    (bump_token_version, when the user's role changes) or deleting the user
+    makes every token issued before stale. Versions are kept for `ttl`
+    seconds, so a bump made by another worker is seen within that.
+    """
+
+    def __init__(self, max_size=auth_constants.TOKEN_CACHE_SIZE, ttl=auth_constants.TOKEN_VERSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (expires_at, token_version)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] >= time.monotonic():
+            return entry[1]
+        version = _load_token_version(user_id)
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[user_id] = (time.monotonic() + self.ttl, version)
+        return version
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _load_token_version(user_id):
+    # Always from the primary, a replica may not have seen the latest bump yet
+    return db.session.execute(
+        select(User.token_version).where(User.id == user_id),
+        bind_arguments={'bind': db.engine},
+    ).scalar()
+
+
+token_versions = TokenVersionCache()
+
+
+def bump_token_version(session, user_id):
+    """Make every token of the user issued so far stale, once the session is committed"""
+    session.execute(
+        update(User).where(User.id == user_id).values(token_version=User.token_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    forget_user_tokens(user_id)
+
+
+def forget_user_tokens(user_id):
+    """Drop what this process has cached about the tokens of the user"""
+    token_versions.invalidate(user_id)
+    token_cache.invalidate_user(user_id)
+
+
+def is_token_current(payload):
+    """Whether the claims were issued for the current token version of their user, who still exists"""
+    version = token_versions.get(payload.get('user_id'))
+    return version is not None and payload.get('token_version', 0) == version
+
+
+def generate_base_jwt_payload(expiry=auth_constants.LOGIN_EXPIRY_TIME, user_id=None, role=None, token_version=0):
     payload = {
         'iss': 'auth@example.com',
         'sub': 'auth@example.com',
@@ -16,7 +162,10 @@ def generate_base_jwt_payload(expiry=auth_constants.LOGIN_EXPIRY_TIME, user_id=N
     }
 
     if user_id:
-        payload.update({'user_id': user_id})
+        payload.update({'user_id': user_id, 'token_version': token_version})
+
+    if role:
+        payload.update({'role': role})
 
     return payload
 
@@ -49,20 +198,26 @@ def encode_jwt_payload(payload):
     return jwt.encode(payload, auth_constants.AUTH_SECRET_KEY, algorithm=auth_constants.JWT_ALGORITHM)
 
 
-def generate_custom_auth_token(user_id):
-    payload = generate_base_jwt_payload(user_id=user_id)
+def generate_custom_auth_token(user_id, role=None, token_version=0):
+    """Issue a login token for the user's current token_version, with the title of the user's role in its claims if given"""
+    payload = generate_base_jwt_payload(user_id=user_id, role=role, token_version=token_version)
     return encode_jwt_payload(payload)
 
 
 def decode_custom_auth_token(token):
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
     try:
-        return jwt.decode(
+        claims = jwt.decode(
             token,
             auth_constants.AUTH_SECRET_KEY,
             audience=auth_constants.JWT_AUDIENCE,
             algorithms=auth_constants.JWT_ALGORITHM,
             options={'verify_exp': False}
         )
+        token_cache.put(token, claims)
+        return claims
     except jwt.exceptions.ExpiredSignatureError:
         logging.info("Rejecting expired JWT login token")
         return None
@@ -75,7 +230,7 @@ def get_user_id_from_custom_token(token):
     try:
         payload = decode_custom_auth_token(token)
         # Don't check the expiry time of tokens for now
-        if not payload or not payload['user_id']:
+        if not payload or not payload['user_id'] or not is_token_current(payload):
             return None
         return int(payload['user_id'])
     except Exception:
@@ -0,0 +1,83 @@
+import functools
+import math
+
+
+def _windows(coins):
+    """How far below its greedy maximum each coin's count ever has to go.
+
+    If an optimal answer used more than coin // gcd(smaller coins) fewer of a
+    coin than fit, the smaller coins would contain a subset summing to a
+    multiple of that coin, and swapping it for the bigger coin would need
+    fewer coins. So trying that many counts per coin is enough to stay exact.
+    """
+    windows = []
+    for i, coin in enumerate(coins):
+        smaller = coins[i + 1:]
+        windows.append(coin // functools.reduce(math.gcd, smaller) if smaller else 0)
+    return windows
+
+
+def _fewest_coins(amount, coins, counts):
+    """Bounded knapsack: the fewest coins summing to exactly amount, as a list of counts, or None"""
+    windows = _windows(coins)
+    capacity = [0] * (len(coins) + 1)
+    for i in range(len(coins) - 1, -1, -1):
+        capacity[i] = capacity[i + 1] + coins[i] * counts[i]
+
+    best = None
+    best_size = None
+    used = [0] * len(coins)
+
+    def visit(i, remaining, size):
+        nonlocal best, best_size
+        if remaining == 0:
+            if best_size is None or size < best_size:
+                best, best_size = list(used), size
+            return
+        if remaining > capacity[i]:
+            return
+        # Even if only coins[i] were used from here on, this can't beat the best answer so far
+        if best_size is not None and size + -(-remaining // coins[i]) >= best_size:
+            return
+        top = min(counts[i], remaining // coins[i])
+        for count in range(top, max(0, top - windows[i]) - 1, -1):
+            used[i] = count
+            visit(i + 1, remaining - count * coins[i], size + count)
+        used[i] = 0
+
+    visit(0, amount, 0)
+    return best
+
+
+@functools.lru_cache(maxsize=4096)
+def solve_change(amount, inventory):
+    """Make change for amount out of a finite coin inventory.
+
+    :param int amount: the change to give
+    :param tuple inventory: the inventory signature, ((coin, count), ...) largest coin first
+    :return: (((coin, count), ...) to dispense, largest coin first, shortfall that could not be dispensed)
+    """
+    inventory = tuple((coin, count) for coin, count in inventory if count > 0)
+    if amount <= 0 or not inventory:
+        return (), max(amount, 0)
+    coins = [coin for coin, _ in inventory]
+    counts = [count for _, count in inventory]
+
+    # Nothing below the gcd of the coins can ever be given back
+    exact_amount = amount - amount % functools.reduce(math.gcd, coins)
+    used = _fewest_coins(exact_amount, coins, counts)
+    if used is None:
+        # Not even that works out exactly, give back as much as possible largest coin first
+        used = []
+        remaining = amount
+        for coin, count in inventory:
+            used.append(min(count, remaining // coin))
+            remaining -= used[-1] * coin
+
+    change = tuple((coin, count) for coin, count in zip(coins, used) if count)
+    return change, amount - sum(coin * count for coin, count in change)
+
+
+def inventory_signature(rows):
+    """Turn (coin, count) rows into the hashable signature solve_change is memoised by"""
+    return tuple(sorted(((coin, count) for coin, count in rows), reverse=True))
@@ -0,0 +1,191 @@
+"""Synthetic datasets for load testing and benchmarks, see `flask db_generate`.
+
+Users, products and ledger entries are generated in batches and written with
+executemany Core inserts, a transaction per batch, with explicit ids following
+whatever is in the tables already. All users share a single password hash,
+hashing is by far the slowest part of making a user otherwise. The same seed
+generates the same dataset.
+
+The ledger is history only: balances and stock are not adjusted for it.
+"""
+import contextlib
+import itertools
+import random
+import time
+
+from sqlalchemy import func, insert, select
+from werkzeug.security import generate_password_hash
+
+from app.models import LedgerEntry, LedgerKind, Product, Role, User
+from app import search
+
+GENERATED_PASSWORD = 'password'
+# Ledger history ends here rather than now, so that a seed always gives the same dataset
+HISTORY_END = 1672531200  # 2023-01-01
+HISTORY_DAYS = 365
+
+PRODUCT_WORDS = [
+    'cola', 'zero', 'classic', 'cherry', 'lemon', 'lime', 'orange', 'chocolate', 'caramel', 'peanut', 'almond',
+    'gum', 'mint', 'chips', 'salted', 'paprika', 'cheese', 'onion', 'water', 'sparkling', 'still', 'energy',
+    'drink', 'bar', 'cookie', 'wafer', 'coffee', 'espresso', 'latte', 'tea', 'green', 'black', 'juice', 'apple',
+]
+PRODUCT_COSTS = [5, 10, 15, 20, 25, 30, 40, 50, 65, 75, 100, 120, 150]
+
+POPULARITY_DISTRIBUTIONS = ('uniform', 'zipf')
+
+
+def popularity_weights(products, distribution, zipf_s=1.1):
+    """Cumulative purchase weights of products ranked from most to least popular"""
+    if distribution == 'uniform':
+        return list(range(1, products + 1))
+    if distribution == 'zipf':
+        return list(itertools.accumulate(1 / rank ** zipf_s for rank in range(1, products + 1)))
+    raise ValueError(f'Unknown popularity distribution {distribution!r}')
+
+
+def _next_id(connection, model):
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _role_id(connection, title):
+    role_id = connection.execute(select(Role.id).where(Role.title == title)).scalar()
+    if role_id is None:
+        role_id = connection.execute(insert(Role).values(title=title)).inserted_primary_key[0]
+    return role_id
+
+
+def _taken_usernames(connection, first_user_id, users):
+    """Usernames of existing users that clash with the generated gen<id> ones, case-insensitively like signup"""
+    generated = {f'gen{user_id}' for user_id in range(first_user_id, first_user_id + users)}
+    return [
+        username for username in connection.execute(select(User.username).where(func.lower(User.username).like('gen%'))).scalars()
+        if username.lower() in generated
+    ]
+
+
+def _batches(count, batch_size):
+    for start in range(0, count, batch_size):
+        yield range(start, min(start + batch_size, count))
+
+
+def _insert(engine, table, rows):
+    with engine.begin() as connection:
+        connection.execute(insert(table), rows)
+
+
+def generate(engine, users, products, ledger, vendor_share=0.05, popularity='zipf', zipf_s=1.1, seed=0,
+             batch_size=50000, progress=None):
+    """Append users, products and ledger entries to the database.
+
+    :param float vendor_share: the share of generated users that are vendors, there is at least one
+    :param str popularity: how purchases are spread over products, 'uniform' or 'zipf'
+    :param float zipf_s: exponent of the zipf distribution, higher concentrates sales on fewer products
+    :param callable progress: called with (table, rows written so far) as a table starts and after every batch
+    :return: {table: rows written}
+    :raises ValueError: the counts or distribution given can't make a consistent dataset, or users
+        signed up with some of the generated usernames
+    """
+    vendors = max(1, round(users * vendor_share)) if users else 0
+    if products and not vendors:
+        raise ValueError('Generating products needs at least one generated vendor')
+    if ledger and not (products and users > vendors):
+        raise ValueError('Generating ledger entries needs generated products and buyers')
+    cum_weights = popularity_weights(products, popularity, zipf_s) if ledger else None
+
+    rng = random.Random(seed)
+    progress = progress or (lambda table, written: None)
+    password = generate_password_hash(GENERATED_PASSWORD, method='sha256')
+
+    with engine.begin() as connection:
+        vendor_role_id = _role_id(connection, 'vendor')
+        buyer_role_id = _role_id(connection, 'buyer')
+        first_user_id = _next_id(connection, User)
+        first_product_id = _next_id(connection, Product)
+        first_entry_id = _next_id(connection, LedgerEntry)
+        taken = _taken_usernames(connection, first_user_id, users)
+    if taken:
+        raise ValueError(f'Usernames to generate are taken already: {", ".join(taken[:5])}')
+
+    progress('users', 0)
+    for batch in _batches(users, batch_size):
+        _insert(engine, User.__table__, [
+            {
+                'id': first_user_id + i,
+                'username': f'gen{first_user_id + i}',
+                'password': password,
+                'balance': rng.randrange(0, 2000, 5),
+                'role_id': vendor_role_id if i < vendors else buyer_role_id,
+            }
+            for i in batch
+        ])
+        progress('users', batch.stop)
+
+    vendor_ids = range(first_user_id, first_user_id + vendors)
+    buyer_ids = range(first_user_id + vendors, first_user_id + users)
+
+    product_costs = []
+    product_sellers = []
+    progress('products', 0)
+    with search.bulk_load(engine) if products else contextlib.nullcontext():
+        for batch in _batches(products, batch_size):
+            rows = []
+            for i in batch:
+                cost = rng.choice(PRODUCT_COSTS)
+                seller_id = rng.choice(vendor_ids)
+                product_costs.append(cost)
+                product_sellers.append(seller_id)
+                rows.append({
+                    'id': first_product_id + i,
+                    'product_name': ' '.join(rng.sample(PRODUCT_WORDS, rng.randint(1, 3))).capitalize() + f' {i}',
+                    'amount_available': rng.choice([0, rng.randint(1, 500)]),
+                    'cost': cost,
+                    'seller_id': seller_id,
+                })
+            _insert(engine, Product.__table__, rows)
+            progress('products', batch.stop)
+
+    # Popularity rank -> product, so that the best sellers are spread over the catalogue
+    ranked_products = list(range(products))
+    rng.shuffle(ranked_products)
+    history_start = HISTORY_END - HISTORY_DAYS * 24 * 60 * 60
+    progress('ledger', 0)
+    for batch in _batches(ledger, batch_size):
+        picks = rng.choices(ranked_products, cum_weights=cum_weights, k=len(batch))
+        rows = []
+        for i, product in zip(batch, picks):
+            created_at = history_start + (HISTORY_END - history_start) * i // ledger
+            buyer_id = rng.choice(buyer_ids)
+            if rng.random() < 0.1:
+                rows.append({
+                    'id': first_entry_id + i, 'kind': LedgerKind.DEPOSIT, 'created_at': created_at,
+                    'buyer_id': buyer_id, 'seller_id': None, 'product_id': None, 'amount': None,
+                    'total': rng.choice([5, 10, 20, 50, 100]),
+                })
+                continue
+            amount = rng.choice([1, 1, 1, 2, 3])
+            rows.append({
+                'id': first_entry_id + i, 'kind': LedgerKind.PURCHASE, 'created_at': created_at,
+                'buyer_id': buyer_id, 'seller_id': product_sellers[product],
+                'product_id': first_product_id + product, 'amount': amount,
+                'total': product_costs[product] * amount,
+            })
+        _insert(engine, LedgerEntry.__table__, rows)
+        progress('ledger', batch.stop)
+
+    return {'users': users, 'products': products, 'ledger': ledger}
+
+
+def format_rate(count, seconds):
+    return f'{count} rows in {seconds:.1f}s ({count / seconds if seconds else 0:.0f} rows/s)'
+
+
+def timed_progress(echo):
+    """A progress callback for generate printing rows written and the rate per table"""
+    started = {}
+
+    def progress(table, written):
+        if not written:
+            started[table] = time.perf_counter()
+            return
+        echo(f'{table}: {format_rate(written, time.perf_counter() - started[table])}')
+    return progress
@@ -3,6 +3,7 @@
 
 class Errors():
     ACCESS_DENIED = "ACCESS_DENIED"
+    NOT_VENDOR = "NOT_VENDOR"
     INVALID_REQUEST = "INVALID_REQUEST"
     INVALID_TOKEN = "INVALID_TOKEN"
     INVALID_USERNAME = "INVALID_USERNAME"
@@ -17,10 +18,15 @@ class Errors():
     NAN_PRODUCT_AMOUNT = "NAN_PRODUCT_AMOUNT"
     INSUFFICIENT_FUNDS = "INSUFFICIENT_FUNDS"
     NOT_ENOUGH_STOCK = "NOT_ENOUGH_STOCK"
+    PRICE_CHANGED = "PRICE_CHANGED"
+    CHANGE_UNAVAILABLE = "CHANGE_UNAVAILABLE"
+    CATALOGUE_CHANGED = "CATALOGUE_CHANGED"
+    REQUEST_IN_PROGRESS = "REQUEST_IN_PROGRESS"
 
 
 class ErrorsForHumans():
     ACCESS_DENIED = "Access denied."
+    NOT_VENDOR = "Only vendors can do this."
     INVALID_REQUEST = "Invalid request."
     INVALID_TOKEN = "Invalid token"
     INVALID_USERNAME = "Please provide a valid username"
@@ -35,3 +41,7 @@ class ErrorsForHumans():
     NAN_PRODUCT_AMOUNT = "Please provide the correct amount of product"
     INSUFFICIENT_FUNDS = "Not enough funds in your balance, please refill"
     NOT_ENOUGH_STOCK = "Unfortunately, there is less items of this position in stock than you wanted to buy"
+    PRICE_CHANGED = "The price of a product in your cart has just changed, please review your cart"
+    CHANGE_UNAVAILABLE = "The coins for your change have just been given out to someone else, please try again"
+    CATALOGUE_CHANGED = "Some of your products were changed while saving them, nothing was saved, please try again"
+    REQUEST_IN_PROGRESS = "A request with this Idempotency-Key is still being processed, please retry later"
@@ -0,0 +1,98 @@
+"""Streaming NDJSON/CSV exports of whole tables.
+
+Rows are read in batches from a streamed result on a connection of their own
+and encoded batch by batch into chunks of text, so memory use doesn't depend
+on the size of the table. The same generators back the export endpoints
+(as the body of a streamed response) and the `flask export` command.
+"""
+import csv
+import io
+
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy import case, select
+
+from database import db
+from app.models import LedgerEntry, LedgerKind, Product, Role, User
+
+
+EXPORT_BATCH_SIZE = 1000
+
+_LEDGER_KINDS = {value: name for name, value in vars(LedgerKind).items() if not name.startswith('_')}
+
+# Exportable tables, as queries in a stable order. Filters are added by the caller.
+EXPORTS = {
+    'products': select(
+        Product.id, Product.product_name, Product.amount_available, Product.cost, Product.seller_id,
+    ).order_by(Product.id),
+    # The role title is joined in rather than looked up per user
+    'users': select(
+        User.id, User.username, Role.title.label('role'), User.balance,
+    ).outerjoin(Role, Role.id == User.role_id).order_by(User.id),
+    'ledger': select(
+        LedgerEntry.id, case(_LEDGER_KINDS, value=LedgerEntry.kind).label('kind'), LedgerEntry.created_at,
+        LedgerEntry.buyer_id, LedgerEntry.seller_id, LedgerEntry.product_id, LedgerEntry.amount, LedgerEntry.total,
+    ).order_by(LedgerEntry.id),
+}
+
+
+def iter_batches(query, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the rows of query as lists of at most batch_size tuples, streaming them from the database"""
+    # The engine of the session, which is the replica's in read-only requests
+    with db.session.get_bind().connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(query)
+        for batch in result.partitions(batch_size):
+            yield batch
+
+
+def ndjson_chunks(columns, batches):
+    dumps = current_app.json.dumps
+    for batch in batches:
+        yield ''.join(dumps(dict(zip(columns, row))) + '\n' for row in batch)
+
+
+def csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Just the header when there are no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+    'csv': ('text/csv', csv_chunks),
+}
+
+# For @api.doc(params=...) of the export endpoints
+EXPORT_FORMAT_DOC = {
+    'format': {'in': 'query', 'type': 'string', 'enum': list(EXPORT_FORMATS), 'default': 'ndjson'},
+}
+
+
+def get_export_format():
+    """The ?format= of the request, 'ndjson' by default, or None if there is no such format"""
+    export_format = request.args.get('format', 'ndjson')
+    return export_format if export_format in EXPORT_FORMATS else None
+
+
+def export_chunks(query, export_format, batch_size=EXPORT_BATCH_SIZE):
+    """Generate the export of query in export_format ('ndjson' or 'csv') as chunks of text"""
+    _, encode = EXPORT_FORMATS[export_format]
+    columns = [column.name for column in query.selected_columns]
+    return encode(columns, iter_batches(query, batch_size))
+
+
+def export_response(query, export_format, filename):
+    """A streamed response with the export of query, downloaded as filename.<export_format>"""
+    mimetype, _ = EXPORT_FORMATS[export_format]
+    return Response(
+        stream_with_context(export_chunks(query, export_format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}.{export_format}'},
+    )
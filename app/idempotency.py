@@ -0,0 +1,234 @@
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from flask_restx.utils import unpack
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import db
+from app.errors import Errors
+from app.models import IdempotencyKey
+from app.auth.jwt_auth import get_custom_auth_token_from_request, get_user_id_from_custom_token
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# For @api.doc(params=...), so that the header can be sent from Swagger
+IDEMPOTENCY_HEADER_DOC = {
+    IDEMPOTENCY_HEADER: {
+        'in': 'header',
+        'type': 'string',
+        'description': 'Retries with the same key get the stored response back instead of being repeated',
+    },
+}
+
+
+class ResponseCache():
+    """In-process LRU of stored responses sitting in front of the idempotency_keys table"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_older_than(self, cutoff):
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry[0] < cutoff]
+            for key in expired:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def make_key(user_id, url, client_key):
+    """Scope a client supplied key to the user and the URL it was sent to, query string included"""
+    return hashlib.sha256(f'{user_id}:{url}:{client_key}'.encode()).digest()[:16]
+
+
+# load_response of a key reserved by a request that hasn't finished yet
+IN_PROGRESS = object()
+
+
+def load_response(key, ttl):
+    """Find a stored (created_at, status_code, data) that is still within the TTL, IN_PROGRESS or None"""
+    cutoff = int(time.time()) - ttl
+    entry = response_cache.get(key)
+    if entry is not None:
+        return entry if entry[0] >= cutoff else None
+
+    row = db.session.execute(
+        select(IdempotencyKey.created_at, IdempotencyKey.status_code, IdempotencyKey.response)
+        .where(IdempotencyKey.key == key)
+    ).first()
+    if row is None or row.created_at < cutoff:
+        return None
+    if row.status_code is None:
+        return IN_PROGRESS
+    entry = (row.created_at, row.status_code, json.loads(row.response))
+    response_cache.put(key, entry)
+    return entry
+
+
+def reserve_key(key, ttl):
+    """Claim the key with an in-progress row, committed on its own so that concurrent requests see it
+
+    :return: whether the key was claimed, False if another request holds it
+    """
+    now = int(time.time())
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        # An expired key that hasn't been swept yet is free again
+        connection.execute(delete(table).where(table.c.key == key, table.c.created_at < now - ttl))
+        try:
+            connection.execute(insert(table).values(key=key, created_at=now))
+        except IntegrityError:
+            return False
+    return True
+
+
+def release_key(key):
+    """Drop the reservation of a request that failed, so that it can be retried"""
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        connection.execute(delete(table).where(table.c.key == key, table.c.status_code.is_(None)))
+
+
+def store_response(key, status_code, data):
+    """Fill in the reserved row and commit it together with the writes of the request"""
+    entry = (int(time.time()), status_code, data)
+    db.session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key)
+        .values(created_at=entry[0], status_code=status_code, response=json.dumps(data))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    response_cache.put(key, entry)
+
+
+def idempotent(f):
+    """Replay the stored response for a repeated Idempotency-Key header.
+
+    The key is reserved before the handler runs, so a concurrent retry gets a
+    409 rather than running the handler a second time. The commits of the
+    handler are held back (see database.RoutingSession) and its writes are
+    committed in one transaction with the stored response, so a crash leaves
+    either both or neither. Server errors are not stored and release the key,
+    so that they can be retried.
+
+    Has to wrap login_required, so that a replay is answered from the token
+    claims and the stored response alone, without loading any User or
+    Product rows.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return f(*args, **kwargs)
+        user_id = get_user_id_from_custom_token(get_custom_auth_token_from_request(request))
+        if not user_id:
+            # Let login_required reject the request
+            return f(*args, **kwargs)
+
+        # The query string can change the response, e.g. ?change_format=compact
+        url = f'{request.path}?{request.query_string.decode()}' if request.query_string else request.path
+        key = make_key(user_id, url, client_key)
+        ttl = current_app.config['IDEMPOTENCY_TTL']
+        entry = load_response(key, ttl)
+        if entry is None and not reserve_key(key, ttl):
+            # Reserved by a concurrent request since
+            entry = load_response(key, ttl) or IN_PROGRESS
+        if entry is IN_PROGRESS:
+            return {
+                "errors": [Errors.REQUEST_IN_PROGRESS]
+            }, 409
+        if entry is not None:
+            return entry[2], entry[1], {REPLAYED_HEADER: 'true'}
+
+        g.hold_commit = True
+        try:
+            data, code, headers = unpack(f(*args, **kwargs))
+            g.hold_commit = False
+            if code >= 500:
+                db.session.rollback()
+                release_key(key)
+            else:
+                store_response(key, code, data)
+        except:
+            g.hold_commit = False
+            db.session.rollback()
+            release_key(key)
+            raise
+        return data, code, headers
+    return wrapper
+
+
+def sweep_expired(ttl, batch_size):
+    """Delete expired keys in batches of `batch_size`, each in its own short transaction"""
+    cutoff = int(time.time()) - ttl
+    table = IdempotencyKey.__table__
+    expired_batch = select(table.c.key).where(table.c.created_at < cutoff).limit(batch_size)
+    swept = 0
+    while True:
+        with db.engine.begin() as connection:
+            deleted = connection.execute(delete(table).where(table.c.key.in_(expired_batch))).rowcount
+        swept += deleted
+        if deleted < batch_size:
+            break
+    response_cache.discard_older_than(cutoff)
+    return swept
+
+
+class IdempotencySweeper(threading.Thread):
+    """Daemon thread that periodically sweeps expired idempotency keys"""
+
+    def __init__(self, app):
+        super(IdempotencySweeper, self).__init__(name='idempotency-sweeper', daemon=True)
+        self.app = app
+        self.interval = app.config['IDEMPOTENCY_SWEEP_INTERVAL']
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    swept = sweep_expired(
+                        self.app.config['IDEMPOTENCY_TTL'],
+                        self.app.config['IDEMPOTENCY_SWEEP_BATCH'],
+                    )
+                if swept:
+                    logging.info('Swept %s expired idempotency keys', swept)
+            except Exception:
+                logging.exception('Error sweeping idempotency keys')
+
+
+def init_app(app, start_sweeper=True):
+    response_cache.max_size = app.config['IDEMPOTENCY_CACHE_SIZE']
+    if start_sweeper and app.config['IDEMPOTENCY_SWEEP_INTERVAL']:
+        IdempotencySweeper(app).start()
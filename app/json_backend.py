@@ -0,0 +1,68 @@
+import logging
+
+from flask import current_app, make_response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional dependency
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson.
+
+    Output is always UTF-8 rather than ASCII escaped, and any indent is
+    rendered as two spaces, the only indent orjson knows. Other json.dumps
+    arguments (separators, cls, ...) are ignored.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj, **kwargs).decode()
+
+    def dumpb(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+JSON_BACKENDS = {
+    'json': DefaultJSONProvider,
+    'orjson': OrjsonProvider,
+}
+
+
+def init_app(app):
+    """Install the JSON_BACKEND configured for the app as app.json, used by jsonify, request.get_json and output_json"""
+    name = app.config['JSON_BACKEND']
+    if name not in JSON_BACKENDS:
+        raise ValueError(f'Unknown JSON_BACKEND {name!r}, expected one of {", ".join(JSON_BACKENDS)}')
+    if name == 'orjson' and orjson is None:
+        logging.warning('JSON_BACKEND is orjson but it is not installed, falling back to json')
+        name = 'json'
+    app.json = JSON_BACKENDS[name](app)
+
+
+def output_json(data, code, headers=None):
+    """flask_restx's JSON representation, encoded with the app's JSON backend"""
+    settings = dict(current_app.config.get('RESTX_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    # flask_restx never sorted keys, keep response bodies as they were
+    settings.setdefault('sort_keys', False)
+
+    dumpb = getattr(current_app.json, 'dumpb', None)
+    if dumpb is not None:
+        dumped = dumpb(data, **settings) + b'\n'
+    else:
+        dumped = current_app.json.dumps(data, **settings) + '\n'
+
+    resp = make_response(dumped, code)
+    resp.headers.extend(headers or {})
+    return resp
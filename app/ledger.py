@@ -0,0 +1,124 @@
+import atexit
+import logging
+import threading
+import time
+
+from sqlalchemy import event, insert
+
+from database import RoutingSession, db
+from app.models import LedgerEntry, LedgerKind
+
+# session.info key of the rows recorded in the session's transaction, buffered once it commits
+PENDING_ROWS = 'ledger_rows'
+
+
+class LedgerWriter():
+    """Write-behind buffer for the ledger.
+
+    Rows are recorded in the session that makes the change and go to an
+    in-memory buffer once its transaction commits, so a rolled back change,
+    or one whose commit is held back and then dropped (see
+    app/idempotency.py), leaves no entry. A background thread
+    group-commits the buffered rows in one executemany INSERT per transaction,
+    whenever `flush_size` rows are waiting or every `flush_interval` seconds.
+    Rows still in the buffer when the process dies without running atexit
+    handlers are lost, that is the price of keeping the buy path free of an
+    extra synchronous write.
+    """
+
+    def __init__(self, flush_size=500, flush_interval=1.0):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.app = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app, start_flusher=True):
+        self.app = app
+        self.flush_size = app.config['LEDGER_FLUSH_SIZE']
+        self.flush_interval = app.config['LEDGER_FLUSH_INTERVAL']
+        if start_flusher and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def append(self, session, kind, buyer_id, total, seller_id=None, product_id=None, amount=None):
+        """Buffer the row once the transaction of `session` commits"""
+        row = {
+            'kind': kind,
+            'created_at': int(time.time()),
+            'buyer_id': buyer_id,
+            'seller_id': seller_id,
+            'product_id': product_id,
+            'amount': amount,
+            'total': total,
+        }
+        session.info.setdefault(PENDING_ROWS, []).append(row)
+
+    def extend(self, rows):
+        with self._lock:
+            self._buffer.extend(rows)
+            full = len(self._buffer) >= self.flush_size
+        if full:
+            if self._thread is None:
+                self.flush()
+            else:
+                self._wakeup.set()
+
+    def record_purchase(self, session, buyer_id, seller_id, product_id, amount, total):
+        self.append(session, LedgerKind.PURCHASE, buyer_id, total, seller_id=seller_id, product_id=product_id, amount=amount)
+
+    def record_deposit(self, session, user_id, total):
+        self.append(session, LedgerKind.DEPOSIT, user_id, total)
+
+    def record_change(self, session, user_id, total):
+        self.append(session, LedgerKind.CHANGE, user_id, total)
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Write out everything buffered so far in a single transaction"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows or self.app is None:
+                return 0
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        connection.execute(insert(LedgerEntry.__table__), rows)
+            except Exception:
+                # Put the rows back in front so that they are retried with the next flush
+                with self._lock:
+                    self._buffer[:0] = rows
+                raise
+            return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Error flushing the ledger')
+
+
+ledger_writer = LedgerWriter()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _buffer_committed_rows(session):
+    rows = session.info.pop(PENDING_ROWS, None)
+    if rows:
+        ledger_writer.extend(rows)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _drop_rolled_back_rows(session):
+    session.info.pop(PENDING_ROWS, None)
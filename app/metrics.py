@@ -0,0 +1,180 @@
+"""Per-request latency and SQL instrumentation of the API, scraped at /api/metrics.
+
+Every request through the rest_blueprint is timed between its before_request
+and after_request hooks, and the statements it runs are counted and timed by
+before/after_cursor_execute events on the engine. Each thread accumulates
+into counters of its own, so recording takes no lock. A scrape merges the
+counters of all threads into the Prometheus text format. The counters of
+threads that have ended are folded into a retired total and dropped, so a
+thread-per-request server doesn't make them pile up.
+"""
+import bisect
+import threading
+import time
+
+from flask import request
+from sqlalchemy import event
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Positions in the list of counters kept per (endpoint, method, status)
+_REQUESTS, _SECONDS, _STATEMENTS, _SQL_SECONDS, _BUCKETS = range(5)
+
+
+class _ThreadCounters():
+    """Counters only ever written by the thread owning them"""
+
+    def __init__(self):
+        self.series = {}
+        # State of the request the thread is handling
+        self.started = None
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.statement_started = 0.0
+
+
+class RequestMetrics():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.enabled = False
+        self._local = threading.local()
+        self._threads = []  # [(thread, its counters)]
+        self._retired = {}  # series of the threads that have ended
+        self._threads_lock = threading.Lock()
+        self._engines = set()
+
+    def init_app(self, app, engine):
+        self.enabled = app.config['METRICS_ENABLED']
+        if self.enabled and engine not in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._engines.add(engine)
+
+    def _counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = _ThreadCounters()
+            # The only lock, taken once per thread
+            with self._threads_lock:
+                self._retire_ended_threads()
+                self._threads.append((threading.current_thread(), counters))
+            return counters
+
+    def _retire_ended_threads(self):
+        """Fold the counters of ended threads into the retired total. Needs the threads lock"""
+        alive = []
+        for thread, counters in self._threads:
+            if thread.is_alive():
+                alive.append((thread, counters))
+            else:
+                # Nobody writes to them anymore
+                _merge_series(self._retired, counters.series)
+        self._threads = alive
+
+    def start_request(self):
+        if not self.enabled:
+            return
+        counters = self._counters()
+        counters.statements = 0
+        counters.sql_seconds = 0.0
+        counters.started = time.perf_counter()
+
+    def end_request(self, response):
+        if not self.enabled:
+            return
+        counters = self._counters()
+        if counters.started is None:
+            return
+        seconds = time.perf_counter() - counters.started
+        counters.started = None
+
+        key = (request.endpoint or 'unmatched', request.method, response.status_code)
+        series = counters.series.get(key)
+        if series is None:
+            series = counters.series[key] = [0, 0.0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+        series[_REQUESTS] += 1
+        series[_SECONDS] += seconds
+        series[_STATEMENTS] += counters.statements
+        series[_SQL_SECONDS] += counters.sql_seconds
+        series[_BUCKETS][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        counters = getattr(self._local, 'counters', None)
+        if counters is not None and counters.started is not None:
+            counters.statement_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        counters = getattr(self._local, 'counters', None)
+        if counters is not None and counters.started is not None:
+            counters.statements += 1
+            counters.sql_seconds += time.perf_counter() - counters.statement_started
+
+    def snapshot(self):
+        """Counters of all threads added up, {(endpoint, method, status): [requests, seconds, statements, sql_seconds, buckets]}"""
+        with self._threads_lock:
+            self._retire_ended_threads()
+            threads = [counters for _, counters in self._threads]
+            merged = {}
+            _merge_series(merged, self._retired)
+        for counters in threads:
+            # Copying a dict is atomic, its owner may be writing to it meanwhile
+            _merge_series(merged, counters.series.copy())
+        return merged
+
+    def render(self):
+        """The merged counters in the Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = [
+            '# HELP api_request_duration_seconds Time from before_request to after_request',
+            '# TYPE api_request_duration_seconds histogram',
+        ]
+        for (endpoint, method, status), series in snapshot:
+            labels = f'endpoint="{_escape(endpoint)}",method="{method}",status="{status}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[_BUCKETS]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'api_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'api_request_duration_seconds_sum{{{labels}}} {series[_SECONDS]!r}')
+            lines.append(f'api_request_duration_seconds_count{{{labels}}} {series[_REQUESTS]}')
+        for name, index, help_text in (
+            ('api_request_sql_statements_total', _STATEMENTS, 'SQL statements run by requests'),
+            ('api_request_sql_seconds_total', _SQL_SECONDS, 'Time requests spent executing SQL statements'),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for (endpoint, method, status), series in snapshot:
+                labels = f'endpoint="{_escape(endpoint)}",method="{method}",status="{status}"'
+                lines.append(f'{name}{{{labels}}} {series[index]!r}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._threads_lock:
+            for _, counters in self._threads:
+                counters.series = {}
+            self._retired = {}
+
+
+def _merge_series(total, series_by_key):
+    """Add {key: series} onto total, copying rather than sharing the series"""
+    for key, series in series_by_key.items():
+        series = list(series)
+        merged = total.get(key)
+        if merged is None:
+            total[key] = [*series[:_BUCKETS], list(series[_BUCKETS])]
+            continue
+        for index in range(_BUCKETS):
+            merged[index] += series[index]
+        merged[_BUCKETS] = [a + b for a, b in zip(merged[_BUCKETS], series[_BUCKETS])]
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+request_metrics = RequestMetrics()
@@ -24,6 +24,8 @@ class User(db.Model, UserMixin):
     token = db.Column(db.String(160), nullable=True)
     balance = db.Column(db.Integer)
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
+    # Only tokens issued for the current version are accepted, see app/auth/jwt_auth.py
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     products = db.relationship('Product', backref='users')
 
     def __repr__(self) -> str:
@@ -37,6 +39,11 @@ class User(db.Model, UserMixin):
 
 class Product(db.Model):
     __tablename__ = 'products'
+    # For the keyset-paginated catalogue listing, see AddProduct.get in app/rest/products.py
+    __table_args__ = (
+        db.Index('ix_products_seller_id_id', 'seller_id', 'id'),
+        db.Index('ix_products_in_stock_id', 'id', sqlite_where=db.text('amount_available > 0')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     product_name = db.Column(db.String(160))
@@ -51,3 +58,91 @@ class Product(db.Model):
             f'cost: {self.cost}, '
             f'seller_id: {self.seller_id}>'
         )
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # Truncated SHA256 of the user id, the URL and the client supplied key
+    key = db.Column(db.LargeBinary(16), primary_key=True)
+    created_at = db.Column(db.Integer, index=True)
+    status_code = db.Column(db.SmallInteger)
+    response = db.Column(db.Text)
+
+    def __repr__(self) -> str:
+        return (
+            f'<key: {self.key.hex()}, '
+            f'created_at: {self.created_at}, '
+            f'status_code: {self.status_code}>'
+        )
+
+
+class RecentWrite(db.Model):
+    """When a user last wrote, their reads go to the primary for a while after, see app/replica.py"""
+    __tablename__ = 'recent_writes'
+
+    user_id = db.Column(db.Integer, primary_key=True)
+    written_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self) -> str:
+        return (
+            f'<user_id: {self.user_id}, '
+            f'written_at: {self.written_at}>'
+        )
+
+
+class CoinInventory(db.Model):
+    """How many coins of each denomination a vending machine has left to give change with"""
+    __tablename__ = 'coin_inventory'
+
+    machine_id = db.Column(db.Integer, primary_key=True)
+    coin = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return (
+            f'<machine_id: {self.machine_id}, '
+            f'coin: {self.coin}, '
+            f'count: {self.count}>'
+        )
+
+
+class LedgerKind():
+    PURCHASE = 1
+    DEPOSIT = 2
+    CHANGE = 3
+
+
+class LedgerEntry(db.Model):
+    """Append-only record of every purchase and deposit.
+
+    Integer-only on purpose, rows are written in bulk by app.ledger and never updated.
+    There are no foreign keys, the history has to outlive deleted users and products.
+    For deposits the depositing user is the buyer, for change dispensed by a
+    machine with a coin inventory the buyer is who got it.
+    """
+    __tablename__ = 'ledger'
+    __table_args__ = (
+        db.Index('ix_ledger_buyer_id_id', 'buyer_id', 'id'),
+        db.Index('ix_ledger_seller_id_id', 'seller_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.SmallInteger, nullable=False)
+    created_at = db.Column(db.Integer, nullable=False)
+    buyer_id = db.Column(db.Integer, nullable=False)
+    seller_id = db.Column(db.Integer, nullable=True)
+    product_id = db.Column(db.Integer, nullable=True)
+    amount = db.Column(db.Integer, nullable=True)
+    total = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return (
+            f'<id: {self.id}, '
+            f'kind: {self.kind}, '
+            f'buyer_id: {self.buyer_id}, '
+            f'seller_id: {self.seller_id}, '
+            f'product_id: {self.product_id}, '
+            f'amount: {self.amount}, '
+            f'total: {self.total}>'
+        )
@@ -0,0 +1,203 @@
+"""On-demand profiling of single requests, for staging.
+
+With PROFILER_ENABLED the WSGI app is wrapped in a RequestProfiler. A request
+carrying a valid X-Profile header runs under cProfile ('deterministic') or a
+stack sampler ('sampling'). The stats are dumped to PROFILER_DIR, which keeps
+the newest PROFILER_KEEP dumps, and the response gets the top hotspots in
+X-Profile-Summary and the name of the dump in X-Profile-File. Requests
+without the header go straight through, after a single dict lookup.
+
+The header is `<mode>:<expires>:<signature>`, signed with the app secret so
+that nobody else can make the server profile, see `flask profile_header`.
+"""
+import collections
+import cProfile
+import hashlib
+import hmac
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+PROFILE_HEADER = 'X-Profile'
+SUMMARY_HEADER = 'X-Profile-Summary'
+FILE_HEADER = 'X-Profile-File'
+PROFILE_MODES = ('deterministic', 'sampling')
+
+_ENVIRON_KEY = 'HTTP_' + PROFILE_HEADER.upper().replace('-', '_')
+_UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def sign(secret, mode, expires):
+    return hmac.new(secret.encode(), f'{mode}:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+
+def make_header(secret, mode='deterministic', ttl=300):
+    """An X-Profile value valid for ttl seconds"""
+    expires = int(time.time()) + ttl
+    return f'{mode}:{expires}:{sign(secret, mode, expires)}'
+
+
+def verify_header(secret, value):
+    """The profiling mode a header asks for, or None if it is malformed, expired or not signed with secret"""
+    try:
+        mode, expires, signature = value.split(':')
+        expired = int(expires) < time.time()
+    except ValueError:
+        return None
+    if mode not in PROFILE_MODES or expired:
+        return None
+    # As bytes, compare_digest refuses str with non-ASCII characters, which any client can send
+    if not hmac.compare_digest(signature.encode('latin-1', 'ignore'), sign(secret, mode, expires).encode()):
+        return None
+    return mode
+
+
+def _location(filename, lineno, name):
+    if filename == '~':
+        # Builtins
+        return name
+    return f'{os.path.basename(filename)}:{lineno}({name})'
+
+
+class _DeterministicRun():
+    extension = 'prof'
+
+    def __init__(self, interval):
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+
+    def hotspots(self, top):
+        """[(location, self time in ms)] of the top functions by time spent in them"""
+        stats = pstats.Stats(self.profile).stats
+        ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+        return [(_location(*function), f'{tottime * 1e3:.1f}ms') for function, (_, _, tottime, _, _) in ranked]
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class _SamplingRun():
+    """Samples the stack of the thread it runs in every interval seconds, from a thread of its own"""
+    extension = 'folded'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def hotspots(self, top):
+        """[(location, share of the samples)] of the top functions the samples were taken in"""
+        total = sum(self.stacks.values())
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack[-1]] += count
+        return [(_location(*function), f'{count / total:.0%}') for function, count in leaves.most_common(top)]
+
+    def dump(self, path):
+        """Collapsed stacks, the input format of flame graph tools"""
+        with open(path, 'w') as dump_file:
+            for stack, count in self.stacks.most_common():
+                dump_file.write(';'.join(_location(*function) for function in stack) + f' {count}\n')
+
+
+_RUNS = {'deterministic': _DeterministicRun, 'sampling': _SamplingRun}
+
+
+class RequestProfiler():
+    """WSGI middleware profiling the requests that ask for it with a signed X-Profile header"""
+
+    def __init__(self, wsgi_app, secret, directory, keep=50, top=5, sample_interval=0.001):
+        self.wsgi_app = wsgi_app
+        self.secret = secret
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+        self.sample_interval = sample_interval
+        self._rotate_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        header = environ.get(_ENVIRON_KEY)
+        if header is None:
+            return self.wsgi_app(environ, start_response)
+        mode = verify_header(self.secret, header)
+        if mode is None:
+            return self.wsgi_app(environ, start_response)
+        return self._profile(mode, environ, start_response)
+
+    def _profile(self, mode, environ, start_response):
+        started = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            # The headers are only sent once the profile is done, to add the summary to them
+            started.update(status=status, headers=headers, exc_info=exc_info)
+
+        with _RUNS[mode](self.sample_interval) as run:
+            body = self.wsgi_app(environ, capture_start_response)
+        # Streamed bodies are generated after this and aren't in the profile
+
+        filename = self._filename(environ, run.extension)
+        os.makedirs(self.directory, exist_ok=True)
+        run.dump(os.path.join(self.directory, filename))
+        self._rotate()
+
+        summary = '; '.join(f'{location} {value}' for location, value in run.hotspots(self.top))
+        headers = list(started['headers']) + [(SUMMARY_HEADER, summary), (FILE_HEADER, filename)]
+        start_response(started['status'], headers, started['exc_info'])
+        return body
+
+    def _filename(self, environ, extension):
+        path = _UNSAFE_FILENAME.sub('_', environ.get('PATH_INFO', '').strip('/'))[:80]
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        return f'{stamp}-{time.perf_counter_ns() % 10 ** 9:09d}-{environ.get("REQUEST_METHOD")}-{path}.{extension}'
+
+    def _rotate(self):
+        """Delete all but the newest `keep` dumps"""
+        with self._rotate_lock:
+            dumps = sorted(
+                (entry for entry in os.scandir(self.directory) if entry.is_file()),
+                key=lambda entry: entry.stat().st_mtime_ns,
+            )
+            for entry in dumps[:-self.keep]:
+                os.remove(entry.path)
+
+
+def init_app(app):
+    if not app.config['PROFILER_ENABLED']:
+        return
+    app.wsgi_app = RequestProfiler(
+        app.wsgi_app,
+        secret=app.config['PROFILER_SECRET'] or app.config['SECRET_KEY'],
+        directory=app.config['PROFILER_DIR'],
+        keep=app.config['PROFILER_KEEP'],
+        top=app.config['PROFILER_TOP'],
+        sample_interval=app.config['PROFILER_SAMPLE_INTERVAL'],
+    )
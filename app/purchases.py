@@ -0,0 +1,242 @@
+from sqlalchemy import bindparam, case, select, update
+
+from app.models import User, Product, CoinInventory
+from app.errors import Errors
+from app.ledger import ledger_writer
+from app.coins import solve_change, inventory_signature
+
+
+class PurchaseError(Exception):
+    """A purchase was rejected, nothing has been written"""
+
+    def __init__(self, error, status_code=400):
+        super(PurchaseError, self).__init__(error)
+        self.error = error
+        self.status_code = status_code
+
+
+def _product_cost(product_id):
+    return select(Product.cost).where(Product.id == product_id).scalar_subquery()
+
+
+def _product_seller(product_id):
+    return select(Product.seller_id).where(Product.id == product_id).scalar_subquery()
+
+
+def _execute(session, statement):
+    # Guarded UPDATEs carry subqueries the ORM can't evaluate in Python, and the
+    # identity map is expired on commit anyway.
+    return session.execute(statement.execution_options(synchronize_session=False))
+
+
+def _dispense_change(session, machine_id, buyer_id, balance):
+    """Give the buyer's balance back in coins the machine actually has.
+
+    Runs inside the purchase transaction: the coins and the balance they are
+    paid out of are taken in the same commit as the purchase itself. Whatever
+    can't be paid out in coins stays on the balance.
+
+    :return: ({coin: count} dispensed or None if the machine has no coin inventory, balance left)
+    """
+    if machine_id is None:
+        return None, balance
+    rows = session.execute(
+        select(CoinInventory.coin, CoinInventory.count).where(CoinInventory.machine_id == machine_id)
+    ).all()
+    if not rows:
+        return None, balance
+
+    change, shortfall = solve_change(balance, inventory_signature(rows))
+    if not change:
+        return {}, balance
+
+    inventory_table = CoinInventory.__table__
+    taken = session.execute(
+        update(inventory_table)
+        .where(
+            inventory_table.c.machine_id == machine_id,
+            inventory_table.c.coin == bindparam('b_coin'),
+            inventory_table.c.count >= bindparam('b_count'),
+        )
+        .values(count=inventory_table.c.count - bindparam('b_count')),
+        [{'b_coin': coin, 'b_count': count} for coin, count in change]
+    )
+    if taken.rowcount != len(change):
+        raise PurchaseError(Errors.CHANGE_UNAVAILABLE, 409)
+
+    _execute(session, (
+        update(User)
+        .where(User.id == buyer_id)
+        .values(balance=User.balance - (balance - shortfall))
+    ))
+    return dict(change), shortfall
+
+
+def _record_change(session, buyer_id, change):
+    if change:
+        ledger_writer.record_change(session, buyer_id, sum(coin * count for coin, count in change.items()))
+
+
+def purchase(session, buyer_id, product_id, amount, machine_id=None):
+    """Buy `amount` items of a product in a single transaction.
+
+    Each balance and stock move is a conditional UPDATE guarded in its WHERE
+    clause, so concurrent purchases can neither oversell nor lose a write.
+    The reason for a rejection is taken from the affected row counts.
+    On a machine with a coin inventory the change is dispensed in the same
+    transaction.
+
+    :return: (transaction_amount, buyer_balance, change) after the commit,
+        change is {coin: count} or None if the machine has no coin inventory
+    :raises PurchaseError: the transaction was rolled back
+    """
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount < 1:
+        raise PurchaseError(Errors.NAN_PRODUCT_AMOUNT, 400)
+
+    total = _product_cost(product_id) * amount
+    try:
+        debited = _execute(session, (
+            update(User)
+            .where(User.id == buyer_id, User.balance >= total)
+            .values(balance=User.balance - total)
+        ))
+        if debited.rowcount != 1:
+            # Either the product does not exist (the cost subquery is NULL) or the buyer is short
+            product_exists = session.execute(
+                select(Product.id).where(Product.id == product_id)
+            ).first()
+            if product_exists is None:
+                raise PurchaseError(Errors.WRONG_PRODUCT_ID, 404)
+            raise PurchaseError(Errors.INSUFFICIENT_FUNDS, 403)
+
+        taken = _execute(session, (
+            update(Product)
+            .where(Product.id == product_id, Product.amount_available >= amount)
+            .values(amount_available=Product.amount_available - amount)
+        ))
+        if taken.rowcount != 1:
+            raise PurchaseError(Errors.NOT_ENOUGH_STOCK, 400)
+
+        _execute(session, (
+            update(User)
+            .where(User.id == _product_seller(product_id))
+            .values(balance=User.balance + total)
+        ))
+
+        # The write lock is held from here on, so these are the values just written
+        transaction_amount, seller_id = session.execute(
+            select(Product.cost * amount, Product.seller_id).where(Product.id == product_id)
+        ).one()
+        buyer_balance = session.execute(select(User.balance).where(User.id == buyer_id)).scalar()
+        change, buyer_balance = _dispense_change(session, machine_id, buyer_id, buyer_balance)
+        ledger_writer.record_purchase(session, buyer_id, seller_id, product_id, amount, transaction_amount)
+        _record_change(session, buyer_id, change)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+    return transaction_amount, buyer_balance, change
+
+
+
+def _merge_cart(items):
+    """Sum up the amounts per product id, keeping the order they first appear in"""
+    if not items:
+        raise PurchaseError(Errors.INVALID_REQUEST, 400)
+    cart = {}
+    for item in items:
+        product_id = item.get('product_id')
+        amount = item.get('amount')
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            raise PurchaseError(Errors.WRONG_PRODUCT_ID, 404)
+        if not isinstance(amount, int) or isinstance(amount, bool) or amount < 1:
+            raise PurchaseError(Errors.NAN_PRODUCT_AMOUNT, 400)
+        cart[product_id] = cart.get(product_id, 0) + amount
+    return cart
+
+
+def checkout(session, buyer_id, items, machine_id=None):
+    """Buy a whole cart of `{"product_id", "amount"}` items as a single unit.
+
+    All products are loaded with one IN query, the stock is decremented with
+    one executemany of guarded UPDATEs and every seller is credited once with
+    their aggregated total. Either the whole cart is committed or nothing is,
+    including the change dispensed on a machine with a coin inventory.
+
+    :return: (cart, transaction_amount, buyer_balance, change) where cart maps product ids to amounts
+    :raises PurchaseError: the transaction was rolled back
+    """
+    cart = _merge_cart(items)
+
+    products = session.execute(
+        select(Product.id, Product.cost, Product.seller_id).where(Product.id.in_(cart))
+    ).all()
+    if len(products) != len(cart):
+        raise PurchaseError(Errors.WRONG_PRODUCT_ID, 404)
+
+    transaction_amount = 0
+    seller_totals = {}
+    for product in products:
+        subtotal = product.cost * cart[product.id]
+        transaction_amount += subtotal
+        seller_totals[product.seller_id] = seller_totals.get(product.seller_id, 0) + subtotal
+
+    products_table = Product.__table__
+    users_table = User.__table__
+    try:
+        debited = session.execute(
+            update(users_table)
+            .where(users_table.c.id == buyer_id, users_table.c.balance >= transaction_amount)
+            .values(balance=users_table.c.balance - transaction_amount)
+        )
+        if debited.rowcount != 1:
+            raise PurchaseError(Errors.INSUFFICIENT_FUNDS, 403)
+
+        # The cost guard makes sure nobody is charged a price that changed since the products were loaded
+        taken = session.execute(
+            update(products_table)
+            .where(
+                products_table.c.id == bindparam('b_id'),
+                products_table.c.cost == bindparam('b_cost'),
+                products_table.c.amount_available >= bindparam('b_amount'),
+            )
+            .values(amount_available=products_table.c.amount_available - bindparam('b_amount')),
+            [
+                {'b_id': product.id, 'b_cost': product.cost, 'b_amount': cart[product.id]}
+                for product in products
+            ]
+        )
+        if taken.rowcount != len(products):
+            out_of_stock = session.execute(
+                select(Product.id).where(
+                    Product.id.in_(cart),
+                    Product.amount_available < case(cart, value=Product.id),
+                )
+            ).first()
+            if out_of_stock is not None:
+                raise PurchaseError(Errors.NOT_ENOUGH_STOCK, 400)
+            raise PurchaseError(Errors.PRICE_CHANGED, 409)
+
+        session.execute(
+            update(users_table)
+            .where(users_table.c.id == bindparam('b_id'))
+            .values(balance=users_table.c.balance + bindparam('b_total')),
+            [
+                {'b_id': seller_id, 'b_total': total}
+                for seller_id, total in seller_totals.items()
+            ]
+        )
+
+        buyer_balance = session.execute(select(User.balance).where(User.id == buyer_id)).scalar()
+        change, buyer_balance = _dispense_change(session, machine_id, buyer_id, buyer_balance)
+        for product in products:
+            amount = cart[product.id]
+            ledger_writer.record_purchase(session, buyer_id, product.seller_id, product.id, amount, product.cost * amount)
+        _record_change(session, buyer_id, change)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+    return cart, transaction_amount, buyer_balance, change
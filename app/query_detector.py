@@ -0,0 +1,150 @@
+"""N+1 and slow-query detector for development and canary builds.
+
+Statements run while the rest_blueprint handles a request are normalised to
+fingerprints, with literals and parameter lists taken out, and counted per
+request. A request is flagged when it runs the same fingerprint more than
+QUERY_DETECTOR_REPEAT_THRESHOLD times, the tell of a query in a loop, or
+spends more than QUERY_DETECTOR_TIME_BUDGET seconds in SQL. Flagged requests
+are logged with the stack of the handler code that ran the statement.
+
+Off unless QUERY_DETECTOR_ENABLED. tests/pytest_query_detector.py makes it a
+pytest plugin that fails the tests of flagged requests.
+"""
+import collections
+import functools
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+
+from flask import request
+from sqlalchemy import event
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PARAMETER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROW_LIST = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+_WHITESPACE = re.compile(r'\s+')
+
+# Stack frames of these directories are the application's own
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_STACK_DIRS = tuple(os.path.join(_PROJECT_DIR, directory) + os.sep for directory in ('app', 'tests', 'benchmarks'))
+_THIS_FILE = os.path.abspath(__file__)
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement):
+    """The statement with literals and lengths of parameter lists normalised away
+
+    >>> fingerprint("SELECT * FROM roles WHERE id IN (?, ?, ?) AND title = 'vendor'")
+    'select * from roles where id in (?+) and title = ?'
+    """
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _PARAMETER_LIST.sub('(?+)', statement)
+    statement = _ROW_LIST.sub('(?+)', statement)
+    return _WHITESPACE.sub(' ', statement).strip().lower()
+
+
+def handler_stack():
+    """Frames of application code on the current stack, as formatted lines"""
+    frames = [
+        frame for frame in traceback.extract_stack()[:-1]
+        if frame.filename.startswith(_STACK_DIRS) and frame.filename != _THIS_FILE
+    ]
+    return ''.join(traceback.format_list(frames))
+
+
+class _RequestQueries():
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.stacks = {}
+        self.sql_seconds = 0.0
+        self.budget_stack = None
+        self.statement_started = 0.0
+
+
+class QueryDetector():
+    def __init__(self, repeat_threshold=5, time_budget=0.5):
+        self.repeat_threshold = repeat_threshold
+        self.time_budget = time_budget
+        self.enabled = False
+        # Findings are appended here too when it is a list, see tests/pytest_query_detector.py
+        self.collected = None
+        self._local = threading.local()
+        self._watched = set()
+
+    def init_app(self, app, engine):
+        self.enabled = app.config['QUERY_DETECTOR_ENABLED']
+        self.repeat_threshold = app.config['QUERY_DETECTOR_REPEAT_THRESHOLD']
+        self.time_budget = app.config['QUERY_DETECTOR_TIME_BUDGET']
+        if self.enabled:
+            self.watch(engine)
+
+    def watch(self, target):
+        """Listen to the statements of an engine, or of every engine when given the Engine class"""
+        if target not in self._watched:
+            event.listen(target, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(target, 'after_cursor_execute', self._after_cursor_execute)
+            self._watched.add(target)
+
+    def start_request(self):
+        if self.enabled:
+            self._local.queries = _RequestQueries()
+
+    def end_request(self):
+        """Check the queries of the request that just ended, logging it if flagged
+
+        :return: findings, [{'kind': 'repeated' or 'slow', 'endpoint', 'message', 'stack'}, ...]
+        """
+        queries = getattr(self._local, 'queries', None)
+        if queries is None:
+            return []
+        self._local.queries = None
+
+        endpoint = f'{request.method} {request.path}'
+        findings = [
+            {
+                'kind': 'repeated',
+                'endpoint': endpoint,
+                'message': f'same statement {count} times: {statement}',
+                'stack': queries.stacks[statement],
+            }
+            for statement, count in queries.counts.most_common()
+            if count > self.repeat_threshold
+        ]
+        if self.time_budget is not None and queries.sql_seconds > self.time_budget:
+            findings.append({
+                'kind': 'slow',
+                'endpoint': endpoint,
+                'message': f'{queries.sql_seconds * 1e3:.1f} ms in SQL, over the budget of {self.time_budget * 1e3:.0f} ms',
+                'stack': queries.budget_stack,
+            })
+        for finding in findings:
+            logging.warning('Query detector flagged %s, %s\n%s', finding['endpoint'], finding['message'], finding['stack'])
+        if findings and self.collected is not None:
+            self.collected.extend(findings)
+        return findings
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        queries = getattr(self._local, 'queries', None)
+        if queries is not None:
+            queries.statement_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        queries = getattr(self._local, 'queries', None)
+        if queries is None:
+            return
+        queries.sql_seconds += time.perf_counter() - queries.statement_started
+        key = fingerprint(statement)
+        queries.counts[key] += 1
+        # Stacks are only taken when something is going wrong, once per request and problem
+        if queries.counts[key] == self.repeat_threshold + 1:
+            queries.stacks[key] = handler_stack()
+        if queries.budget_stack is None and self.time_budget is not None and queries.sql_seconds > self.time_budget:
+            queries.budget_stack = handler_stack()
+
+
+query_detector = QueryDetector()
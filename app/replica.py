@@ -0,0 +1,152 @@
+"""Routing of read-only requests to a read replica of the database.
+
+When REPLICA_DATABASE_URI is set, the handlers decorated with @read_only run
+their statements against it (see database.RoutingSession), everything else
+against the primary. A user who has just written, with a successful POST,
+PUT, PATCH or DELETE, reads from the primary for the next
+REPLICA_STICKY_SECONDS, so that they see their own writes however far behind
+the replica is. The time of their last write is kept in the recent_writes
+table of the primary, so the window holds whichever worker serves the next
+request and whatever the client keeps between requests. It costs a write per
+write request and a primary key lookup per authenticated read, only when a
+replica is configured.
+
+A replica that is a local SQLite file is refreshed from the primary with the
+online backup API every REPLICA_SYNC_INTERVAL seconds, a stand-in for real
+replication to run the routing locally. Every sync copies the whole database.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import make_url
+
+from database import db, set_sqlite_pragmas
+from app.models import RecentWrite
+from app.auth.jwt_auth import get_custom_auth_token_from_request, get_user_id_from_custom_token
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def _sqlite_path(url):
+    if not url.drivername.startswith('sqlite') or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+def make_engine(app, uri):
+    """Engine with the same options and pragmas as the primary's"""
+    url = make_url(uri)
+    path = _sqlite_path(url)
+    if path is not None and not os.path.isabs(path):
+        # Relative to the instance folder, like Flask-SQLAlchemy does with the primary
+        os.makedirs(app.instance_path, exist_ok=True)
+        url = url.set(database=os.path.join(app.instance_path, path))
+    engine = create_engine(url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    set_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+    return engine
+
+
+def _request_user_id():
+    """User id in the token of the current request, without loading the user"""
+    token = get_custom_auth_token_from_request(request)
+    return get_user_id_from_custom_token(token) if token else None
+
+
+class ReplicaRouter():
+
+    def __init__(self, sticky_seconds=5.0, sync_interval=1.0):
+        self.engine = None
+        self.sticky_seconds = sticky_seconds
+        self.sync_interval = sync_interval
+        self._paths = None  # (primary, replica) when both are SQLite files
+        self._thread = None
+
+    def init_app(self, app, start_sync=True):
+        """Needs an app context, for the engine of the primary"""
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        self.sync_interval = app.config['REPLICA_SYNC_INTERVAL']
+        self._paths = None
+        uri = app.config['REPLICA_DATABASE_URI']
+        self.engine = make_engine(app, uri) if uri else None
+        if self.engine is None:
+            return
+        paths = _sqlite_path(db.engine.url), _sqlite_path(self.engine.url)
+        if None in paths:
+            # Kept up to date by something else
+            return
+        self._paths = paths
+        self.sync()
+        if start_sync and self.sync_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='replica-sync', daemon=True)
+            self._thread.start()
+
+    def sync(self):
+        """Copy the primary over the local replica, in one step so that it never has half of a change"""
+        if self._paths is None:
+            return
+        primary_path, replica_path = self._paths
+        source = sqlite3.connect(primary_path)
+        try:
+            target = sqlite3.connect(replica_path, timeout=5)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception:
+                logging.exception('Error syncing the replica')
+
+    def record_write(self, user_id):
+        """Send the reads of the user to the primary for the next sticky_seconds"""
+        if self.engine is None:
+            return
+        statement = insert(RecentWrite).values(user_id=user_id, written_at=time.time())
+        with db.engine.begin() as connection:
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[RecentWrite.user_id], set_={'written_at': statement.excluded.written_at}
+            ))
+
+    def is_sticky(self, user_id):
+        """Whether the user wrote less than sticky_seconds ago, as the primary knows"""
+        if not user_id:
+            return False
+        with db.engine.connect() as connection:
+            written_at = connection.execute(
+                select(RecentWrite.written_at).where(RecentWrite.user_id == user_id)
+            ).scalar()
+        return written_at is not None and time.time() - written_at < self.sticky_seconds
+
+    def after_request(self, response):
+        if self.engine is None or request.method in SAFE_METHODS or response.status_code >= 400:
+            return
+        identity = g.get('identity')
+        user_id = identity.user_id if identity is not None else _request_user_id()
+        if user_id:
+            self.record_write(user_id)
+
+
+replica_router = ReplicaRouter()
+
+
+def read_only(f):
+    """Run the handler against the replica, unless its user is within the sticky window of a write"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if replica_router.engine is not None and not replica_router.is_sticky(_request_user_id()):
+            g.read_replica = replica_router.engine
+        return f(*args, **kwargs)
+    return wrapper
@@ -1,16 +1,14 @@
 # APIs to be connected TO here
 
-import collections
-import json
-import logging
-import re
-
 import wtforms_json
-from flask import Blueprint
-from flask.wrappers import Response  # pylint: disable=unused-import
+from flask import Blueprint, Response
 from flask_restx import Api
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, NotFound
 
+from app import json_backend
+from app.metrics import request_metrics, PROMETHEUS_CONTENT_TYPE
+from app.query_detector import query_detector
+from app.replica import replica_router
 from app.rest.rest_models import api as rest_models_api
 from app.rest.users import api as users_api
 from app.rest.products import api as products_api
@@ -36,38 +34,46 @@ rest_api = Api(
     validate=True,
 )
 
+# Responses are encoded with the JSON_BACKEND from the config rather than always the stdlib json
+rest_api.representation('application/json')(json_backend.output_json)
+
 rest_api.add_namespace(rest_models_api)
 rest_api.add_namespace(users_api)
 rest_api.add_namespace(products_api)
 
+# Static CORS headers, built once rather than on every response
+CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),  # TODO: Restrict this to our web domain?
+    ('Access-Control-Allow-Methods', 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'),
+    ('Access-Control-Allow-Headers', 'Accept, Authorization, Content-Type'),
+)
+
+
+@rest_blueprint.before_request
+def before_request():
+    request_metrics.start_request()
+    query_detector.start_request()
+
+
 @rest_blueprint.after_request
 def after_request(response):
     """
+    Form errors are normalised where they are produced (see make_form_errors),
+    so response bodies are never parsed again here.
+
     :param Response response:
     :rtype: Response
     """
-    # Catch all types of errors as in no situation should trying to make the errors nicer break the API
-    try:
-        if response.headers.get('Content-Type') == 'application/json':
-            response_data = json.loads(response.get_data())
-
-            if response_data is None:
-                return response
-
-            form_errors = response_data.get('form_errors')  # This might not exist, might be None, or a dict
-
-            if form_errors:
-                for field_name, errors in form_errors.items():
-                    # Swap u'foo' is too short to 'foo' is too short
-                    new_errors = [re.sub(r"^u'", "'", error) for error in errors]
-                    response_data['form_errors'][field_name] = new_errors
-
-            response.set_data(json.dumps(response_data))
+    response.headers.extend(CORS_HEADERS)
+    replica_router.after_request(response)
+    request_metrics.end_request(response)
+    query_detector.end_request()
+    return response
 
-    except Exception:
-        logging.exception('Error modifying form errors')
 
-    response.headers.add('Access-Control-Allow-Origin', '*')  # TODO: Restrict this to our web domain?
-    response.headers.add('Access-Control-Allow-Methods', 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT')
-    response.headers.add('Access-Control-Allow-Headers', 'Accept, Authorization, Content-Type')
-    return response
+@rest_blueprint.route('/metrics')
+def metrics():
+    """Latency and SQL counters of the API in the Prometheus text format, see app/metrics.py"""
+    if not request_metrics.enabled:
+        raise NotFound()
+    return Response(request_metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
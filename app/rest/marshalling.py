@@ -0,0 +1,278 @@
+"""Compiled marshallers for flask_restx models.
+
+flask_restx's marshal interprets the field tree of a model for every object
+it serializes. compile_model walks the tree once and generates a specialised
+Python function for it instead, with each field's value lookup and formatting
+inlined. Its output is identical to marshal. Anything that isn't a plain
+Raw/String/Integer/Nested/List field (masks, callable or dotted attributes,
+defaults, other field types) is delegated to the field's own output(), and
+any error falls back to marshal for the whole object, so that errors are
+raised exactly as before.
+"""
+from functools import wraps
+from http import HTTPStatus
+import itertools
+
+import flask_restx
+from flask import current_app, has_request_context, request
+from flask_restx import fields as restx_fields, marshal
+from flask_restx.marshalling import make
+from flask_restx.utils import merge, unpack
+
+
+class NotCompilable(Exception):
+    """The model uses something only the interpreted marshal handles, e.g. a Wildcard field"""
+
+
+class _Fallback(Exception):
+    """Raised by generated code for an input it doesn't specialise for"""
+
+
+def _fallback():
+    raise _Fallback()
+
+
+def _value(obj, key):
+    """Same lookup as flask_restx.fields.get_value for a plain string key"""
+    if type(obj) is dict:  # pylint: disable=unidiomatic-typecheck
+        try:
+            return obj[key]
+        except KeyError:
+            return getattr(obj, key, None)
+    if hasattr(obj, '__iter__') and not hasattr(obj, 'strip'):
+        try:
+            return obj[key]
+        except (IndexError, TypeError, KeyError):
+            pass
+    if isinstance(obj, (list, tuple)):
+        try:
+            return obj[int(key)]
+        except (IndexError, TypeError, ValueError):
+            pass
+    return getattr(obj, key, None)
+
+
+def _is_plain(field):
+    return (
+        field.mask is None and
+        (field.attribute is None or (isinstance(field.attribute, str) and '.' not in field.attribute))
+    )
+
+
+def _resolved(model):
+    return getattr(model, 'resolved', model)
+
+
+class _Compiler():
+    def __init__(self):
+        self.namespace = {
+            '_value': _value,
+            '_fallback': _fallback,
+        }
+        self.lines = []
+        self.compiled = {}
+        self.counter = itertools.count()
+
+    def name(self, prefix):
+        return f'{prefix}{next(self.counter)}'
+
+    def bind(self, prefix, value):
+        name = self.name(prefix)
+        self.namespace[name] = value
+        return name
+
+    def model(self, model, skip_none):
+        """Generate a function marshalling one object (or a list of them) with model, return its name"""
+        cache_key = (id(model), skip_none)
+        if cache_key in self.compiled:
+            return self.compiled[cache_key]
+        name = self.name('marshal_')
+        self.compiled[cache_key] = name
+
+        body = []
+        keys = []
+        for key, field in _resolved(model).items():
+            var = f'v{len(keys)}'
+            keys.append((key, var))
+            if isinstance(field, dict):
+                body.append(f'{var} = {self.model(field, skip_none)}(obj)')
+            else:
+                body.extend(self.field(key, make(field), var))
+
+        lines = [
+            f'def {name}(obj):',
+            '    if isinstance(obj, (list, tuple)):',
+            f'        return [{name}(item) for item in obj]',
+        ]
+        lines.extend(f'    {line}' for line in body)
+        items = ', '.join(f'{key!r}: {var}' for key, var in keys)
+        if skip_none:
+            lines.append(f'    out = {{{items}}}')
+            lines.append('    return {key: value for key, value in out.items() if value is not None and value != {}}')
+        else:
+            lines.append(f'    return {{{items}}}')
+        self.lines.extend(lines)
+        self.lines.append('')
+        return name
+
+    def field(self, key, field, var):
+        """Lines computing the marshalled value of field into var"""
+        field_name = self.bind('field_', field)
+        generic = [f'{var} = {field_name}.output({key!r}, obj, ordered=False)']
+        if isinstance(field, restx_fields.Wildcard):
+            raise NotCompilable(f'Wildcard field {key!r}')
+        if not _is_plain(field):
+            return generic
+        attribute = field.attribute or key
+        lookup = f'{var} = _value(obj, {attribute!r})'
+        field_type = type(field)
+
+        if field.default is None and field_type in (restx_fields.Raw, restx_fields.String, restx_fields.Integer):
+            return [lookup] + [f'    {line}' if i else line for i, line in enumerate(self.scalar(field_type, var))]
+
+        if field_type is restx_fields.Nested:
+            nested = self.model(field.nested, field.skip_none)
+            return [
+                lookup,
+                f'if {var} is None:',
+                f'    {self.nested_null(field, field_name, nested, var)}',
+                'else:',
+                f'    {var} = {nested}({var})',
+            ]
+
+        if field_type is restx_fields.List and not callable(field.default):
+            element = self.list_element(field.container)
+            if element is None:
+                return generic
+            return [
+                lookup,
+                f'if type({var}) is list or type({var}) is tuple:',
+                f'    {var} = [{element} for x in {var}]',
+                f'elif {var} is None:',
+                f'    {var} = {field_name}.default',
+                'else:',
+                f'    {generic[0]}',
+            ]
+
+        return generic
+
+    @staticmethod
+    def scalar(field_type, var):
+        if field_type is restx_fields.String:
+            return [f'if {var} is not None:', f'{var} = str({var})']
+        if field_type is restx_fields.Integer:
+            return [f'if {var} is not None:', f'{var} = int({var})']
+        return []
+
+    def nested_null(self, field, field_name, nested, var):
+        if field.allow_null:
+            return f'{var} = None'
+        if field.default is not None:
+            return f'{var} = {field_name}.default'
+        return f'{var} = {nested}(None)'
+
+    def list_element(self, container):
+        """Expression marshalling the list element x the way List.format does, or None"""
+        if not _is_plain(container) or container.attribute is not None:
+            return None
+        container_type = type(container)
+        if container_type is restx_fields.Nested:
+            container_name = self.bind('field_', container)
+            nested = self.model(container.nested, container.skip_none)
+            if container.allow_null:
+                null = 'None'
+            elif container.default is not None:
+                null = f'{container_name}.default'
+            else:
+                null = f'{nested}(None)'
+            return f'({null} if x is None else {nested}(x))'
+        if container.default is not None:
+            return None
+        if container_type is restx_fields.Raw:
+            return 'x'
+        # A dict element is looked up by index rather than formatted, leave that to marshal
+        if container_type is restx_fields.String:
+            return 'None if x is None else (_fallback() if isinstance(x, dict) else str(x))'
+        if container_type is restx_fields.Integer:
+            return 'None if x is None else (_fallback() if isinstance(x, dict) else int(x))'
+        return None
+
+    def build(self, model, skip_none):
+        name = self.model(model, skip_none)
+        source = '\n'.join(self.lines)
+        exec(compile(source, f'<marshaller {getattr(model, "name", name)}>', 'exec'), self.namespace)  # pylint: disable=exec-used
+        return self.namespace[name], source
+
+
+def compile_model(model, skip_none=False):
+    """Compile a model into a function that marshals data exactly like marshal(data, model, skip_none=skip_none)
+
+    :raises NotCompilable: the model can only be marshalled by marshal
+    """
+    marshaller, source = _Compiler().build(model, skip_none)
+
+    def compiled(data):
+        try:
+            return marshaller(data)
+        except Exception:
+            # Let marshal produce the very same result or error
+            return marshal(data, model, skip_none=skip_none)
+
+    compiled.source = source
+    return compiled
+
+
+class marshal_with(flask_restx.marshal_with):
+    """flask_restx.marshal_with, serializing with a model compiled once when the decorator is applied.
+
+    Requests asking for a field mask (the X-Fields header) are marshalled by
+    flask_restx as before.
+    """
+
+    def __init__(self, fields, envelope=None, skip_none=False, mask=None, ordered=False):
+        super(marshal_with, self).__init__(fields, envelope, skip_none, mask, ordered)
+        self.compiled = None
+        if not (mask or ordered or getattr(fields, '__mask__', None)):
+            try:
+                self.compiled = compile_model(fields, skip_none)
+            except NotCompilable:
+                pass
+
+    def __call__(self, f):
+        interpreted = super(marshal_with, self).__call__(f)
+        if self.compiled is None:
+            return interpreted
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if has_request_context() and request.headers.get(current_app.config['RESTX_MASK_HEADER']):
+                return interpreted(*args, **kwargs)
+            resp = f(*args, **kwargs)
+            if isinstance(resp, tuple):
+                data, code, headers = unpack(resp)
+                return self.envelop(self.compiled(data)), code, headers
+            return self.envelop(self.compiled(resp))
+
+        return wrapper
+
+    def envelop(self, data):
+        return {self.envelope: data} if self.envelope else data
+
+
+class Namespace(flask_restx.Namespace):
+    """flask_restx.Namespace whose marshal_with serializes with compiled models"""
+
+    def marshal_with(self, fields, as_list=False, code=HTTPStatus.OK, description=None, **kwargs):
+        def wrapper(func):
+            doc = {
+                "responses": {
+                    str(code): (description, [fields], kwargs)
+                    if as_list
+                    else (description, fields, kwargs)
+                },
+                "__mask__": kwargs.get("mask", True),
+            }
+            func.__apidoc__ = merge(getattr(func, "__apidoc__", {}), doc)
+            return marshal_with(fields, ordered=self.ordered, **kwargs)(func)
+
+        return wrapper
@@ -1,16 +1,24 @@
-from flask import request
-from flask_restx import Namespace, Resource, fields
+from functools import wraps
+
+from flask import current_app, request
+from flask_restx import Resource, fields
 from wtforms import Form, StringField, validators, IntegerField
-from sqlalchemy import delete
+from sqlalchemy import delete, literal_column, select
 
 from database import db
-from app.models import User, Role, Product
+from app.models import LedgerEntry, LedgerKind, Product
 from app.rest.rest_models import product_model
+from app.rest.marshalling import Namespace
 from app.errors import Errors
-from app.auth.jwt_auth import get_user_id_from_custom_token, get_custom_auth_token_from_request
+from app.idempotency import idempotent, IDEMPOTENCY_HEADER_DOC
+from app.purchases import purchase, checkout, PurchaseError
+from app.catalogue import upsert_products, CatalogueError
+from app.search import search_products
+from app.replica import read_only
+from app.exports import EXPORTS, EXPORT_FORMAT_DOC, export_response, get_export_format
 from app.rest.utils import (
-    make_model, make_form_errors_model,
-    login_required, BSTNode, build_change
+    make_model, make_form_errors_model, make_form_errors,
+    login_required, role_required, get_identity, ChangeMaker, expand_change
 )
 
 
@@ -18,13 +26,25 @@ api = Namespace('product', path='/product')
 
 
 coin_values = [20, 5, 10, 50, 100]
-coin_bst = BSTNode()
-for val in coin_values:
-    coin_bst.insert(val)
-
-
+change_maker = ChangeMaker(coin_values)
+
+# ?change_format=compact returns the change as {coin: count} in 'change_counts' instead of a flat list of coins
+CHANGE_FORMAT_PARAM = 'change_format'
+COMPACT_CHANGE_FORMAT = 'compact'
+change_format_doc = {
+    CHANGE_FORMAT_PARAM: {
+        'in': 'query',
+        'type': 'string',
+        'enum': [COMPACT_CHANGE_FORMAT],
+        'description': 'Return the change as {coin: count} in change_counts instead of a flat list of coins',
+    },
+}
+
+
+PRODUCT_NAME_MIN_LENGTH = 4
+PRODUCT_NAME_MAX_LENGTH = 25
 product_name_validators = [
-    validators.Length(min=4, max=25, message=Errors.INVALID_LENGTH),
+    validators.Length(min=PRODUCT_NAME_MIN_LENGTH, max=PRODUCT_NAME_MAX_LENGTH, message=Errors.INVALID_LENGTH),
 ]
 
 product_name_field = StringField('Username',
@@ -62,6 +82,147 @@ buy_response_model = api.model("BuyResponse", {
     "form_errors": fields.Nested(buy_form_errors, allow_null=True, skip_none=True),
 })
 
+# Bulk upsert: items are validated one by one like AddProductForm, so the payload itself isn't
+bulk_product_item_model = api.inherit("BulkProductItem", add_product_payload, {
+    "id": fields.Integer(description='Update this product, only in the fields given, instead of creating one'),
+})
+bulk_products_payload = api.model("BulkProducts", {
+    "products": fields.List(fields.Nested(bulk_product_item_model), required=True),
+})
+bulk_product_result_model = api.model("BulkProductResult", {
+    "status": fields.Integer(description='201 created, 200 updated, or the error status of this item'),
+    "id": fields.Integer(),
+    "errors": fields.Raw(),
+    "form_errors": fields.Raw(),
+})
+bulk_products_response_model = api.model("BulkProductsResponse", {
+    "results": fields.List(fields.Nested(bulk_product_result_model)),
+    "errors": fields.Raw(),
+})
+
+PRODUCT_BULK_MAX_ITEMS = 10000
+# Bulk item field -> products column
+PRODUCT_FORM_COLUMNS = (('name', 'product_name'), ('cost', 'cost'), ('amount', 'amount_available'))
+
+
+def validate_bulk_product(item):
+    """Validate one item of a bulk upsert the way AddProductForm does.
+
+    Items updating a product (with an 'id') are only validated in the fields
+    they have. Well-formed items are checked inline, anything else goes
+    through the form itself so that the errors are exactly the form's.
+
+    :return: (products columns to write or None, form_errors or None)
+    """
+    partial = item.get('id') is not None
+    row = {}
+    for key, column in PRODUCT_FORM_COLUMNS:
+        if key not in item:
+            if partial:
+                continue
+            value = None
+        else:
+            value = item[key]
+        if key == 'name':
+            well_formed = isinstance(value, str) and PRODUCT_NAME_MIN_LENGTH <= len(value) <= PRODUCT_NAME_MAX_LENGTH
+        else:
+            well_formed = value is None or type(value) is int  # pylint: disable=unidiomatic-typecheck
+        if not well_formed:
+            break
+        row[column] = value
+    else:
+        return row, None
+
+    form = AddProductForm.from_json(item)
+    form.validate()
+    form_errors = {key: errors for key, errors in form.errors.items() if not partial or key in item}
+    if form_errors:
+        return None, make_form_errors(form_errors)
+    return {column: form.data[key] for key, column in PRODUCT_FORM_COLUMNS if not partial or key in item}, None
+
+
+cart_item_model = api.model("CartItem", {
+    "product_id": fields.Integer(required=True),
+    "amount": fields.Integer(required=True),
+})
+cart_payload = api.model("Cart", {
+    "items": fields.List(fields.Nested(cart_item_model), required=True),
+})
+cart_response_model = api.model("CartResponse", {
+    "products": fields.List(fields.Nested(product_model)),
+    "items": fields.List(fields.Nested(cart_item_model)),
+    "transaction_amount": fields.Integer(),
+    "change": fields.List(fields.Integer),
+    "errors": fields.Raw(),
+})
+
+# Compact projection of the catalogue listing, built from plain rows rather than ORM objects
+product_list_item_model = api.model("ProductListItem", {
+    "id": fields.Integer(),
+    "product_name": fields.String(),
+    "amount_available": fields.Integer(),
+    "cost": fields.Integer(),
+    "seller_id": fields.Integer(),
+})
+product_list_model = api.model("ProductList", {
+    "products": fields.List(fields.Nested(product_list_item_model)),
+    "next_after": fields.Integer(description='Pass as ?after= to get the next page, null on the last page'),
+    "errors": fields.Raw(),
+})
+
+PRODUCT_LIST_DEFAULT_LIMIT = 50
+PRODUCT_LIST_MAX_LIMIT = 500
+product_list_doc = {
+    'after': {'in': 'query', 'type': 'integer', 'description': 'Only list products with a greater id'},
+    'limit': {
+        'in': 'query',
+        'type': 'integer',
+        'description': f'Page size, {PRODUCT_LIST_DEFAULT_LIMIT} by default and at most {PRODUCT_LIST_MAX_LIMIT}',
+    },
+    'seller_id': {'in': 'query', 'type': 'integer', 'description': 'Only list products of this vendor'},
+    'in_stock': {'in': 'query', 'type': 'boolean', 'description': 'Only list products that are (or are not) in stock'},
+}
+
+product_search_model = api.model("ProductSearch", {
+    "products": fields.List(fields.Nested(product_list_item_model)),
+    "next_after": fields.String(description='Pass as ?after= to get the next page, null on the last page'),
+    "errors": fields.Raw(),
+})
+product_search_doc = {
+    'q': {'in': 'query', 'type': 'string', 'required': True, 'description': 'Words the product name has to contain, or start with'},
+    'after': {'in': 'query', 'type': 'string', 'description': 'next_after of the previous page'},
+    'limit': product_list_doc['limit'],
+}
+
+# Spelled out literally so that SQLite can match it with the partial index ix_products_in_stock_id
+PRODUCT_IN_STOCK = Product.amount_available > literal_column('0')
+
+
+def parse_bool(value):
+    return {'true': True, '1': True, 'false': False, '0': False}[value.lower()]
+
+
+def list_products(after, limit, seller_id=None, in_stock=None):
+    """One page of the catalogue in id order, seeking past `after` so that deep pages cost the same as the first.
+
+    :return: (rows, id to pass as `after` for the next page or None)
+    """
+    query = (
+        select(Product.id, Product.product_name, Product.amount_available, Product.cost, Product.seller_id)
+        .where(Product.id > after)
+        .order_by(Product.id)
+        .limit(limit + 1)
+    )
+    if seller_id is not None:
+        query = query.where(Product.seller_id == seller_id)
+    if in_stock is not None:
+        query = query.where(PRODUCT_IN_STOCK if in_stock else ~PRODUCT_IN_STOCK)
+    rows = db.session.execute(query).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
 product_details_model = api.model("ProductDetails", {
     "product": fields.Nested(product_model),
     "errors": fields.Raw(),
@@ -69,28 +230,106 @@ product_details_model = api.model("ProductDetails", {
 })
 
 
+# Machines with a coin inventory identify themselves with this header, see app/coins.py
+MACHINE_ID_HEADER = 'X-Machine-Id'
+machine_id_doc = {
+    MACHINE_ID_HEADER: {
+        'in': 'header',
+        'type': 'integer',
+        'description': 'The vending machine the change is given out by',
+    },
+}
+
+
+def get_machine_id():
+    machine_id = request.headers.get(MACHINE_ID_HEADER, type=int)
+    if machine_id is None:
+        return current_app.config['MACHINE_ID']
+    return machine_id
+
+
+def compact_change_model(model):
+    """The model of responses with ?change_format=compact, with change_counts in place of change"""
+    return api.model(f'{model.name}Compact', {
+        ('change_counts' if key == 'change' else key): (fields.Raw() if key == 'change' else field)
+        for key, field in model.items()
+    })
+
+
+buy_compact_response_model = compact_change_model(buy_response_model)
+cart_compact_response_model = compact_change_model(cart_response_model)
+
+
+def marshal_with_change(model, compact_model):
+    """api.marshal_with the model of the change format the client asked for, documented with the default one"""
+    def decorator(f):
+        compact = api.marshal_with(compact_model)(f)
+        default = api.marshal_with(model)(f)
+
+        @wraps(default)
+        def wrapper(*args, **kwargs):
+            if request.args.get(CHANGE_FORMAT_PARAM) == COMPACT_CHANGE_FORMAT:
+                return compact(*args, **kwargs)
+            return default(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def make_change_fields(balance, change=None):
+    """The change part of a buy response, in the format the client asked for.
+
+    :param int balance: the buyer's balance, used to make change with unlimited coins
+    :param dict change: {coin: count} actually dispensed by a machine with a coin inventory
+    """
+    if change is None:
+        change = change_maker.make_change(balance)
+    if request.args.get(CHANGE_FORMAT_PARAM) == COMPACT_CHANGE_FORMAT:
+        return {
+            "change_counts": {str(coin): count for coin, count in sorted(change.items(), reverse=True)}
+        }
+    return {
+        "change": expand_change(change)
+    }
+
+
 @api.route('')
 class AddProduct(Resource):
+    @api.doc(params=product_list_doc)
+    @api.marshal_with(product_list_model)
+    @read_only
+    def get(self):
+        args = request.args
+        try:
+            after = int(args.get('after', 0))
+            limit = int(args.get('limit', PRODUCT_LIST_DEFAULT_LIMIT))
+            seller_id = int(args['seller_id']) if 'seller_id' in args else None
+            in_stock = parse_bool(args['in_stock']) if 'in_stock' in args else None
+        except (KeyError, ValueError):
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+        if not 0 < limit <= PRODUCT_LIST_MAX_LIMIT:
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+
+        rows, next_after = list_products(after, limit, seller_id=seller_id, in_stock=in_stock)
+        return {
+            "products": [row._mapping for row in rows],
+            "next_after": next_after,
+        }, 200
+
     @api.expect(add_product_payload)
     @api.marshal_with(add_product_response_model)
-    @login_required
+    @role_required('vendor', error=Errors.NOT_VENDOR)
     def post(self):
         data = request.get_json()
 
-        token = get_custom_auth_token_from_request(request)
-        user_id = get_user_id_from_custom_token(token)
-        role_id = User.query.get(user_id).role_id
-        role = Role.query.get(role_id)
-        if role.title != 'vendor':
-            return {
-                "errors": [Errors.NOT_VENDOR]
-            }, 403
-
         product = Product(
             product_name=data['name'],
             cost=data['cost'],
             amount_available=data['amount'],
-            seller_id=user_id
+            seller_id=get_identity().user_id
         )
         db.session.add(product)
         db.session.commit()
@@ -100,9 +339,112 @@ class AddProduct(Resource):
         }, 201
 
 
+@api.route('/search')
+class SearchProducts(Resource):
+    @api.doc(params=product_search_doc)
+    @api.marshal_with(product_search_model)
+    @read_only
+    def get(self):
+        args = request.args
+        try:
+            limit = int(args.get('limit', PRODUCT_LIST_DEFAULT_LIMIT))
+            if not 0 < limit <= PRODUCT_LIST_MAX_LIMIT:
+                raise ValueError(limit)
+            rows, next_after = search_products(db.session, args['q'], limit, after=args.get('after'))
+        except (KeyError, ValueError):
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+
+        return {
+            "products": [row._mapping for row in rows],
+            "next_after": next_after,
+        }, 200
+
+
+@api.route('/bulk')
+class BulkUpsertProducts(Resource):
+    @api.expect(bulk_products_payload, validate=False)
+    @api.marshal_with(bulk_products_response_model)
+    @role_required('vendor', error=Errors.NOT_VENDOR)
+    def post(self):
+        """Create and update up to 10000 of the vendor's products in one transaction, with a result per item"""
+        items = (request.get_json() or {}).get('products')
+        if not isinstance(items, list) or len(items) > PRODUCT_BULK_MAX_ITEMS:
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+
+        results = [None] * len(items)
+        rows = []
+        row_indexes = []
+        for index, item in enumerate(items):
+            product_id = item.get('id') if isinstance(item, dict) else None
+            if not isinstance(item, dict) or not (product_id is None or type(product_id) is int):  # pylint: disable=unidiomatic-typecheck
+                results[index] = {"status": 400, "errors": [Errors.INVALID_REQUEST]}
+                continue
+            row, form_errors = validate_bulk_product(item)
+            if form_errors:
+                results[index] = {"status": 400, "id": product_id, "form_errors": form_errors}
+                continue
+            if product_id is not None:
+                row['id'] = product_id
+            rows.append(row)
+            row_indexes.append(index)
+
+        try:
+            statuses = upsert_products(db.session, get_identity().user_id, rows) if rows else []
+        except CatalogueError as e:
+            return {
+                "errors": [e.error]
+            }, e.status_code
+        for index, (status, product_id, error) in zip(row_indexes, statuses):
+            results[index] = {"status": status, "id": product_id, "errors": [error] if error else None}
+
+        return {
+            "results": results
+        }, 200
+
+
+@api.route('/export')
+class ExportProducts(Resource):
+    @api.doc(params=EXPORT_FORMAT_DOC)
+    @read_only
+    @role_required('vendor')
+    def get(self):
+        """Stream all of the vendor's products"""
+        export_format = get_export_format()
+        if export_format is None:
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+        query = EXPORTS['products'].where(Product.seller_id == get_identity().user_id)
+        return export_response(query, export_format, 'products')
+
+
+@api.route('/sales/export')
+class ExportSales(Resource):
+    @api.doc(params=EXPORT_FORMAT_DOC)
+    @read_only
+    @role_required('vendor')
+    def get(self):
+        """Stream the ledger of every sale of the vendor's products"""
+        export_format = get_export_format()
+        if export_format is None:
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+        query = EXPORTS['ledger'].where(
+            LedgerEntry.seller_id == get_identity().user_id,
+            LedgerEntry.kind == LedgerKind.PURCHASE,
+        )
+        return export_response(query, export_format, 'sales')
+
+
 @api.route('/<int:product_id>')
 class ProductDetails(Resource):
     @api.marshal_with(product_details_model)
+    @read_only
     def get(self, product_id):
         product = Product.query.get(product_id)
         if product is None:
@@ -113,23 +455,16 @@ class ProductDetails(Resource):
             "product": product
         }, 200
 
-    @login_required
+    @role_required('vendor')
     @api.marshal_with(product_details_model)
     def patch(self, product_id):
-        if not request.headers or 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
         product = Product.query.get(product_id)
         if product is None:
             return {
                 "errors": [Errors.WRONG_PRODUCT_ID]
             }, 404
 
-        owner_id = product.seller_id
-        token = get_custom_auth_token_from_request(request)
-        internal_user_id = get_user_id_from_custom_token(token)
-        if not internal_user_id or internal_user_id != owner_id:
+        if get_identity().user_id != product.seller_id:
             return {
                 "errors": [Errors.ACCESS_DENIED]
             }, 403
@@ -150,26 +485,19 @@ class ProductDetails(Resource):
     # Would actually do a soft-delete in real world project.
     # I'd add a DATE deleted_at field, and actually delete the record once so much time passed,
     # that GDPR would require the deletion
-    @login_required
+    @role_required('vendor')
     def delete(self, product_id):
-        if not request.headers or 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
         product = Product.query.get(product_id)
         if product is None:
             return {
                 "errors": [Errors.WRONG_PRODUCT_ID]
             }, 404
 
-        owner_id = product.seller_id
-        token = get_custom_auth_token_from_request(request)
-        internal_user_id = get_user_id_from_custom_token(token)
-        if not internal_user_id or internal_user_id != owner_id:
+        if get_identity().user_id != product.seller_id:
             return {
                 "errors": [Errors.ACCESS_DENIED]
             }, 403
-        sql = delete(Product).where(product.id == product_id)
+        sql = delete(Product).where(Product.id == product_id)
         db.session.execute(sql)
         db.session.commit()
 
@@ -179,48 +507,50 @@ class ProductDetails(Resource):
 @api.route('/buy/<int:product_id>')
 class BuyProduct(Resource):
     @api.expect(buy_payload)
-    @api.marshal_with(buy_response_model)
+    @api.doc(params={**IDEMPOTENCY_HEADER_DOC, **change_format_doc, **machine_id_doc})
+    @idempotent
+    @marshal_with_change(buy_response_model, buy_compact_response_model)
     @login_required
     def post(self, product_id):
-        if not request.headers or 'Authorization' not in request.headers:
+        amount = request.get_json().get('amount')
+        try:
+            transaction_amount, balance, change = purchase(
+                db.session, get_identity().user_id, product_id, amount, machine_id=get_machine_id()
+            )
+        except PurchaseError as e:
             return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
-        token = get_custom_auth_token_from_request(request)
-        user_id = get_user_id_from_custom_token(token)
-        if not user_id:
-            return {
-                "errors": [Errors.INVALID_TOKEN]
-            }, 403
-        buyer = User.query.get(user_id)
+                "errors": [e.error]
+            }, e.status_code
 
         product = Product.query.get(product_id)
-        if product is None:
-            return {
-                "errors": [Errors.WRONG_PRODUCT_ID]
-            }, 404
+        return {
+            "product": product,
+            "amount_purchased": amount,
+            "transaction_amount": transaction_amount,
+            **make_change_fields(balance, change)
+        }, 200
 
-        seller = User.query.get(product.seller_id)
 
-        amount = request.get_json()['amount']
-        transaction_amount = product.cost * amount
-        if buyer.balance < transaction_amount:
-            return {
-                "errors": [Errors.INSUFFICIENT_FUNDS]
-            }, 403
-        if product.amount_available < amount:
+@api.route('/buy')
+class BuyCart(Resource):
+    @api.expect(cart_payload)
+    @api.doc(params={**change_format_doc, **machine_id_doc})
+    @marshal_with_change(cart_response_model, cart_compact_response_model)
+    @login_required
+    def post(self):
+        try:
+            cart, transaction_amount, balance, change = checkout(
+                db.session, get_identity().user_id, request.get_json()['items'], machine_id=get_machine_id()
+            )
+        except PurchaseError as e:
             return {
-                "errors": [Errors.NOT_ENOUGH_STOCK]
-            }, 400
+                "errors": [e.error]
+            }, e.status_code
 
-        buyer.balance -= transaction_amount
-        seller.balance += transaction_amount
-        product.amount_available -= amount
-
-        change = build_change(buyer.balance, coin_bst)
+        products = Product.query.filter(Product.id.in_(cart)).all()
         return {
-            "product": product,
-            "amount_purchased": amount,
+            "products": products,
+            "items": [{"product_id": product_id, "amount": amount} for product_id, amount in cart.items()],
             "transaction_amount": transaction_amount,
-            "change": change
+            **make_change_fields(balance, change)
         }, 200
@@ -1,6 +1,7 @@
 from flask_restx import fields, Namespace
 
 from app import models
+from app.roles import role_registry
 from app.rest.utils import make_model
 
 
@@ -8,7 +9,7 @@ api = Namespace('models')
 
 
 def get_role(entity):
-    return models.Role.query.get(entity.role_id).title
+    return role_registry.title(entity.role_id)
 
 
 _user_overrides_private = {
@@ -1,22 +1,25 @@
 import re
 import os
 from flask import jsonify, request
-from flask_restx import Namespace, Resource, fields
+from flask_restx import Resource, fields
 from werkzeug.security import generate_password_hash, check_password_hash
 from wtforms import Form, StringField, PasswordField, RadioField, validators
-from sqlalchemy import func, delete
+from sqlalchemy import func, delete, select, update
 
 from database import db
-from app.models import User, Role
+from app.models import User
+from app.roles import role_registry
 from app.rest.rest_models import user_model_private
+from app.rest.marshalling import Namespace
 from app.errors import Errors
-from app.auth.jwt_auth import (
-    generate_custom_auth_token, get_user_id_from_custom_token,
-    get_custom_auth_token_from_request
-)
+from app.auth.jwt_auth import generate_custom_auth_token, forget_user_tokens
+from app.ledger import ledger_writer
+from app.exports import EXPORTS, EXPORT_FORMAT_DOC, export_response, get_export_format
+from app.idempotency import idempotent, IDEMPOTENCY_HEADER_DOC
+from app.replica import read_only, replica_router
 from app.rest.utils import (
-    make_model, make_form_errors_model,
-    login_required, conditional_decorator
+    make_model, make_form_errors_model, make_form_errors,
+    login_required, get_identity, conditional_decorator
 )
 
 
@@ -93,25 +96,27 @@ class SignUpUser(Resource):
 
         if user:
             return {
-                "form_errors": {
+                "form_errors": make_form_errors({
                     "username": [Errors.USERNAME_TAKEN]
-                }
+                })
             }, 400
 
         user = User(
             username=data['username'],
             password=hashed_password,
             balance=0,
-            role_id=Role.query.filter_by(title=f'{data["role"]}').first().id
+            role_id=role_registry.id_for(data["role"])
         )
         db.session.add(user)
         db.session.commit()
 
         # Token relies on id, but there is no id before commit, hence why commit twice
-        token = generate_custom_auth_token(user.id)
+        token = generate_custom_auth_token(user.id, role=data['role'])
         user.token = token
         db.session.add(user)
         db.session.commit()
+        # There is no token in the request to find the new user by afterwards
+        replica_router.record_write(user.id)
         return {
             "user": user,
             "token": token,
@@ -139,34 +144,27 @@ class LogInUser(Resource):
             not check_password_hash(user.password, form.data["password"])
         ):
             return {
-                "form_errors": {
+                "form_errors": make_form_errors({
                     "username": [Errors.INVALID_LOGIN],
                     "password": [Errors.INVALID_LOGIN]
-                }
+                })
             }, 400
 
         return {
-            "token": generate_custom_auth_token(user.id),
+            "token": generate_custom_auth_token(
+                user.id, role=role_registry.title(user.role_id), token_version=user.token_version
+            ),
             "user": user,
         }, 200
 
 
 @api.route('/<int:user_id>')
 class UserDetails(Resource):
+    @read_only
     @login_required
     @api.marshal_with(login_response_model)
     def get(self, user_id):
-        if 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }
-        token = get_custom_auth_token_from_request(request)
-        user_id = get_user_id_from_custom_token(token)
-        if not user_id:
-            return {
-                "errors": [Errors.INVALID_TOKEN]
-            }
-        user = User.query.get(user_id)
+        user = get_identity().user
         user.password = None # hotfix, properly done with overridden models
         user.token = None # hotfix
         user.balance = None # same hotfix
@@ -177,17 +175,12 @@ class UserDetails(Resource):
     @login_required
     @api.marshal_with(login_response_model)
     def patch(self, user_id):
-        if not request.headers or 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
-        token = get_custom_auth_token_from_request(request)
-        internal_user_id = get_user_id_from_custom_token(token)
-        if not internal_user_id or internal_user_id != user_id:
+        identity = get_identity()
+        if identity.user_id != user_id:
             return {
                 "errors": [Errors.ACCESS_DENIED]
             }, 403
-        user = User.query.get(internal_user_id)
+        user = identity.user
         data = request.get_json()
         if 'username' in data:
             user.username = data['username']
@@ -205,61 +198,72 @@ class UserDetails(Resource):
     # that GDPR would require the deletion
     @login_required
     def delete(self, user_id):
-        if not request.headers or 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
-        token = get_custom_auth_token_from_request(request)
-        internal_user_id = get_user_id_from_custom_token(token)
-        if not internal_user_id or internal_user_id != user_id:
+        if get_identity().user_id != user_id:
             return {
                 "errors": [Errors.ACCESS_DENIED]
             }, 403
-        sql = delete(User).where(User.id == internal_user_id)
+        sql = delete(User).where(User.id == user_id)
         db.session.execute(sql)
         db.session.commit()
+        # Tokens of the deleted user are refused from now on, by every worker once their cached version expires
+        forget_user_tokens(user_id)
 
         return 204
 
 
 @api.route('/deposit/<int:amount>')
 class Deposit(Resource):
+    @api.doc(params=IDEMPOTENCY_HEADER_DOC)
+    @idempotent
     @login_required
     def post(self, amount):
         allowed_deposits = [5, 10, 20, 50, 100]
-        if not request.headers or 'Authorization' not in request.headers:
-            return {
-                "errors": [Errors.MISSING_TOKEN]
-            }, 403
-        token = get_custom_auth_token_from_request(request)
-        internal_user_id = get_user_id_from_custom_token(token)
-        user = User.query.get(internal_user_id)
+        user_id = get_identity().user_id
         if amount not in allowed_deposits:
             return {
                 "errors": [Errors.INVALID_AMOUNT]
             }
-        user.balance += amount
-        db.session.add(user)
+        # Add in SQL rather than in Python, so that concurrent deposits can't overwrite each other
+        sql = update(User).where(User.id == user_id).values(balance=User.balance + amount)
+        db.session.execute(sql.execution_options(synchronize_session=False))
+        total_balance = db.session.execute(select(User.balance).where(User.id == user_id)).scalar()
+        ledger_writer.record_deposit(db.session, user_id, amount)
         db.session.commit()
 
         return {
             "deposit": amount,
-            "total_balance": user.balance
+            "total_balance": total_balance
         }, 200
 
 
 # Only enable this endpoint in DEV env. It's clearly unsecure to give out in PROD
 @conditional_decorator(api.route('/all_users'), os.environ.get('FLASK_DEBUG'))
 class GetAllUsers(Resource):
+    @read_only
     @login_required
     def get(self):
-        users = User.query.all()
+        users = db.session.execute(select(User.id, User.username, User.role_id)).all()
         result = []
         for user in users:
             user_data = {}
             user_data['id'] = user.id
             user_data['username'] = user.username
-            user_data['role'] = Role.query.get(user.role_id).title
+            user_data['role'] = role_registry.title(user.role_id)
 
             result.append(user_data)
         return jsonify({'users': result})
+
+
+@conditional_decorator(api.route('/export'), os.environ.get('FLASK_DEBUG'))
+class ExportUsers(Resource):
+    @api.doc(params=EXPORT_FORMAT_DOC)
+    @read_only
+    @login_required
+    def get(self):
+        """Stream every user, like /all_users but in constant memory"""
+        export_format = get_export_format()
+        if export_format is None:
+            return {
+                "errors": [Errors.INVALID_REQUEST]
+            }, 400
+        return export_response(EXPORTS['users'], export_format, 'users')
@@ -1,13 +1,17 @@
 import logging
+import re
 from functools import wraps
-from flask import request
+from flask import g, request
 from flask_restx import fields
 # from flask_restx import fields as flask_fields, Resource, ValidationError
 from wtforms import Form, fields as wtforms_fields
 # from wtforms.validators import Length as LengthValidator
 
 from app.models import User
-from app.auth.jwt_auth import get_custom_auth_token_from_request, get_user_id_from_custom_token
+from app.roles import role_registry
+from app.auth.jwt_auth import (
+    get_custom_auth_token_from_request, get_user_id_from_custom_token, decode_custom_auth_token
+)
 from app.errors import Errors
 from database import db
 
@@ -25,67 +29,87 @@ class APIError(Exception):
         self.errors = errors
 
 
-class BSTNode:
-    def __init__(self, val=None):
-        self.left = None
-        self.right = None
-        self.val = val
-
-    def insert(self, val):
-        if not self.val:
-            self.val = val
-            return
-
-        if self.val == val:
-            return
-
-        if val < self.val:
-            if self.left:
-                self.left.insert(val)
-                return
-            self.left = BSTNode(val)
-            return
-
-        if self.right:
-            self.right.insert(val)
-            return
-        self.right = BSTNode(val)
-
-    def greatest_lte_val(self, val):
-        """
-        Find and return the greatest value in the BST
-        that is less than or equal to the given value.
-        """
-        if self.val > val:
-            if not self.left:
-                return None
-            if self.left.val <= val:
-                return self.left.val
-            return self.left.greatest_lte_val(val)
-
-        if self.val < val:
-            if (not self.right) or (self.right.val > val):
-                return self.val
-            return self.right.greatest_lte_val(val)
-
-        return self.val
-
-
-def build_change(amount, coin_bst):
+class ChangeMaker:
+    """Change-making table built once from the coin denominations.
+
+    Every amount is made of as many of the largest coin as fit, plus a
+    precomputed fewest-coins combination for the remainder, so an answer
+    takes O(number of denominations) whatever the amount. A remainder that
+    can't be made exactly (3 cents out of 5s and 10s) is made as closely as
+    possible from below.
+    """
+
+    def __init__(self, coin_values):
+        self.coins = sorted(set(coin_values), reverse=True)
+        self.largest = self.coins[0]
+        self.table = self._build_table()
+
+    def _build_table(self):
+        # fewest[value] is the fewest coins summing to exactly value, first_coin[value] the largest coin of those.
+        # Preferring larger coins on ties gives the same answer as the greedy algorithm on canonical coin systems.
+        fewest = [0] + [None] * (self.largest - 1)
+        first_coin = [None] * self.largest
+        for value in range(1, self.largest):
+            for coin in self.coins:
+                if coin > value or fewest[value - coin] is None:
+                    continue
+                if fewest[value] is None or fewest[value - coin] + 1 < fewest[value]:
+                    fewest[value] = fewest[value - coin] + 1
+                    first_coin[value] = coin
+
+        table = []
+        closest = 0
+        for remainder in range(self.largest):
+            if fewest[remainder] is not None:
+                closest = remainder
+            counts = {}
+            value = closest
+            while value:
+                coin = first_coin[value]
+                counts[coin] = counts.get(coin, 0) + 1
+                value -= coin
+            table.append(dict(sorted(counts.items(), reverse=True)))
+        return table
+
+    def make_change(self, amount):
+        """Return the change for amount as {coin: count}, largest coin first"""
+        if amount <= 0:
+            return {}
+        dollars, remainder = divmod(amount, self.largest)
+        counts = {self.largest: dollars} if dollars else {}
+        counts.update(self.table[remainder])
+        return counts
+
+
+def expand_change(change):
+    """Turn {coin: count} into the legacy flat list of coins, largest first"""
     result = []
+    for coin, count in sorted(change.items(), reverse=True):
+        result.extend([coin] * count)
+    return result
 
-    dollars = amount // 100
-    if dollars:
-        dollar_list = [100] * dollars
-        result.extend(dollar_list)
-        amount -= 100 * dollars
 
-    while amount > 0:
-        coin = coin_bst.greatest_lte_val(amount)
-        result.append(coin)
-        amount -= coin
+def build_change(amount, change_maker):
+    """Return the change for amount as the legacy flat list of coins, largest first"""
+    return expand_change(change_maker.make_change(amount))
 
-    return result
+
+_PY2_UNICODE_PREFIX = re.compile(r"^u'")
+
+
+def make_form_errors(errors):
+    """Build the form_errors of a response from {field_name: [error, ...]}.
+
+    Normalises the messages where they are produced, so that responses don't
+    have to be parsed again on their way out.
+    """
+    return {
+        field_name: [
+            # Swap u'foo' is too short to 'foo' is too short
+            _PY2_UNICODE_PREFIX.sub("'", error) for error in field_errors
+        ]
+        for field_name, field_errors in errors.items()
+    }
 
 
 def conditional_decorator(decorator, condition, *args):
@@ -104,18 +128,60 @@ def get_id(entity):
     return (entity.id if isinstance(entity, db.Model) else entity["id"]) or 0
 
 
-def get_logged_in_user(token):
-    """Try to get the logged in user or throw"""
+class Identity():
+    """Who is making the current request.
+
+    Built once per request by login_required from a single token decode.
+    The user row is only loaded on first use and then kept for the rest of
+    the request, so handlers never need to decode the token or query the
+    user again.
+    """
+
+    def __init__(self, user_id, role=None, user=None):
+        self.user_id = user_id
+        self._role = role
+        self._user = user
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.user_id)
+        return self._user
+
+    @property
+    def role(self):
+        """Title of the user's role, e.g. 'vendor'"""
+        if self._role is None and self.user is not None:
+            self._role = role_registry.title(self.user.role_id)
+        return self._role
+
+
+def get_identity():
+    """The identity login_required has established for the current request"""
+    return g.get('identity')
+
+
+def get_identity_from_token(token):
+    """Try to get an identity from the verified token claims alone, without touching the DB, or throw"""
     if not token:
         raise AuthError(Errors.MISSING_TOKEN)
     user_id = get_user_id_from_custom_token(token)
     if not user_id:
         raise AuthError(Errors.INVALID_TOKEN)
+    return Identity(user_id, role=decode_custom_auth_token(token).get('role'))
+
 
-    user = User.query.get(user_id)
-    if not user:
+def get_logged_in_identity(token):
+    """Try to get the identity of the logged in user or throw"""
+    identity = get_identity_from_token(token)
+    if not identity.user:
         raise AuthError(Errors.INVALID_TOKEN)
-    return user
+    return identity
+
+
+def get_logged_in_user(token):
+    """Try to get the logged in user or throw"""
+    return get_logged_in_identity(token).user
 
 
 # def login_optional(f):
@@ -123,12 +189,9 @@ def get_logged_in_user(token):
 #     def wrapper(*args, **kwargs):
 #         try:
 #             token = get_custom_auth_token_from_request(request)
-#             user = get_logged_in_user(token)
-#             request.user_id = user.id
-#             request.user = user
+#             g.identity = get_logged_in_identity(token)
 #         except AuthError:
-#             request.user_id = None
-#             request.user = None
+#             g.identity = None
 #         return f(*args, **kwargs)
 #     return wrapper
 
@@ -138,15 +201,37 @@ def login_required(f):
     def wrapper(*args, **kwargs):
         try:
             token = get_custom_auth_token_from_request(request)
-            user = get_logged_in_user(token)
-            request.user_id = user.id
-            request.user = user
+            g.identity = get_logged_in_identity(token)
         except AuthError as e:
             return {"errors": [str(e)]}, 403
         return f(*args, **kwargs)
     return wrapper
 
 
+def role_required(*roles, error=Errors.ACCESS_DENIED):
+    """Only let users with one of the given roles through, e.g. @role_required('vendor').
+
+    Authorises from the verified token claims, which are only accepted for the
+    current token version of the user (cached, see app/auth/jwt_auth.py), so
+    unlike login_required it doesn't load the user. Tokens issued before roles were put in the
+    claims fall back to loading the user to find their role.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            try:
+                token = get_custom_auth_token_from_request(request)
+                identity = get_identity_from_token(token)
+            except AuthError as e:
+                return {"errors": [str(e)]}, 403
+            if identity.role not in roles:
+                return {"errors": [error]}, 403
+            g.identity = identity
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def make_model_from_form(api, form_class, name=None, overrides=None):
     field_map = {
         wtforms_fields.BooleanField: fields.Boolean,
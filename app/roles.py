@@ -0,0 +1,55 @@
+import threading
+
+from sqlalchemy import event, select
+
+from database import db
+from app.models import Role
+
+
+class RoleRegistry():
+    """In-process role_id <-> title map of the handful of roles there are.
+
+    Loaded once at startup and reloaded lazily after any Role is inserted,
+    updated or deleted through the ORM, or when asked about an id or title
+    it doesn't know.
+    """
+
+    def __init__(self):
+        self._titles = {}
+        self._ids = {}
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = db.session.execute(select(Role.id, Role.title)).all()
+        with self._lock:
+            self._titles = {row.id: row.title for row in rows}
+            self._ids = {row.title: row.id for row in rows}
+            self._stale = False
+
+    def invalidate(self):
+        self._stale = True
+
+    def title(self, role_id):
+        """Title of the role with the given id, or None"""
+        if role_id is None:
+            return None
+        if self._stale or role_id not in self._titles:
+            self.load()
+        return self._titles.get(role_id)
+
+    def id_for(self, title):
+        """Id of the role with the given title, or None"""
+        if self._stale or title not in self._ids:
+            self.load()
+        return self._ids.get(title)
+
+
+role_registry = RoleRegistry()
+
+
+@event.listens_for(Role, 'after_insert')
+@event.listens_for(Role, 'after_update')
+@event.listens_for(Role, 'after_delete')
+def _invalidate_role_registry(mapper, connection, target):
+    role_registry.invalidate()
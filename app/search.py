@@ -0,0 +1,134 @@
+"""Full-text search over product names with an SQLite FTS5 index.
+
+products_fts is an external content FTS5 table over products: it only holds
+the index, the names themselves are read from products. Prefixes of 2 and 3
+characters are indexed as well, so that short prefixes as typed by a user
+don't have to merge the postings of every word they start. Triggers keep it in
+sync with every insert, delete and product_name update, whether it is done
+through the ORM or a Core statement. It is created and dropped along with the
+products table, `flask search_rebuild` creates it for an existing database.
+"""
+import contextlib
+import re
+
+from sqlalchemy import DDL, event, text
+
+from app.models import Product
+
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        product_name, content='products', content_rowid='id', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, product_name) VALUES (new.id, new.product_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+    END""",
+    # Only renames touch the index, stock and price updates of the buy path don't
+    """CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF product_name ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, product_name) VALUES ('delete', old.id, old.product_name);
+        INSERT INTO products_fts(rowid, product_name) VALUES (new.id, new.product_name);
+    END""",
+]
+
+for statement in FTS_DDL:
+    event.listen(Product.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Product.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS products_fts').execute_if(dialect='sqlite'))
+
+
+def create_index(connection):
+    """Create the index and its triggers if missing and (re)index every product"""
+    for statement in FTS_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+@contextlib.contextmanager
+def bulk_load(engine):
+    """Don't index products inserted inside the block one by one, rebuild the index once at the end.
+
+    Indexing through the insert trigger flushes a new index segment for every
+    statement, which makes loading millions of products in batches crawl. The
+    trigger is back in its own transaction before the rebuild starts, so that
+    a load or a rebuild that fails doesn't leave later inserts unindexed.
+    """
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TRIGGER IF EXISTS products_fts_insert')
+    try:
+        yield
+    finally:
+        with engine.begin() as connection:
+            for statement in FTS_DDL:
+                connection.exec_driver_sql(statement)
+        with engine.begin() as connection:
+            create_index(connection)
+
+
+_TERM = re.compile(r'\w+')
+
+
+def make_match_queries(query):
+    """Turn user input into the FTS5 queries of each relevance tier, best first.
+
+    Names containing every word as a whole word come first, then names where
+    some word only matches as a prefix, e.g. "choc" before "chocolate".
+    Everything but the words is dropped, so FTS5 query syntax can't be
+    injected. Returns [] if there are no words.
+    """
+    terms = _TERM.findall(query)
+    if not terms:
+        return []
+    exact = ' '.join(f'"{term}"' for term in terms)
+    prefix = ' '.join(f'"{term}"*' for term in terms)
+    return [exact, f'({prefix}) NOT ({exact})']
+
+
+# FTS5 walks a match in rowid order, so a page only ever reads limit + 1 postings.
+# Ordering by bm25 instead would score every match on every page.
+_SEARCH_SQL = text("""
+    SELECT products.id, products.product_name, products.amount_available, products.cost, products.seller_id
+    FROM products_fts JOIN products ON products.id = products_fts.rowid
+    WHERE products_fts MATCH :match AND products_fts.rowid > :after
+    ORDER BY products_fts.rowid
+    LIMIT :limit
+""")
+
+
+def encode_cursor(tier, product_id):
+    return f'{tier}:{product_id}'
+
+
+def decode_cursor(cursor):
+    """:raises ValueError: not a cursor encode_cursor made"""
+    tier, product_id = (int(part) for part in cursor.split(':'))
+    return tier, product_id
+
+
+def search_products(session, query, limit, after=None):
+    """One page of the products matching query, best matches first and by id within a tier.
+
+    Pages seek past the (tier, id) of the last result of the previous page
+    rather than using an offset, so deep pages cost the same as the first.
+
+    :param str after: cursor returned with the previous page
+    :return: (rows, cursor of the next page or None)
+    """
+    queries = make_match_queries(query)
+    tier, after_id = decode_cursor(after) if after else (0, 0)
+    rows = []
+    tiers = []
+    while tier < len(queries) and len(rows) <= limit:
+        page = session.execute(_SEARCH_SQL, {
+            'match': queries[tier],
+            'after': after_id,
+            'limit': limit + 1 - len(rows),
+        }).all()
+        rows.extend(page)
+        tiers.extend([tier] * len(page))
+        tier, after_id = tier + 1, 0
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(tiers[limit - 1], rows[limit - 1].id)
+    return rows, None
@@ -0,0 +1,88 @@
+"""Per-response cost of the rest_blueprint after_request hook.
+
+Compares the hook as it used to be (json.loads of every JSON body, a regex
+over form_errors, json.dumps back) with the current one that only attaches
+the precomputed CORS headers.
+
+    $> python -m benchmarks.after_request
+"""
+import json
+import re
+import timeit
+
+from flask import Response
+
+from app.rest import after_request
+
+
+def legacy_after_request(response):
+    """The hook before form error normalisation moved to make_form_errors"""
+    if response.headers.get('Content-Type') == 'application/json':
+        response_data = json.loads(response.get_data())
+        if response_data is not None:
+            form_errors = response_data.get('form_errors')
+            if form_errors:
+                for field_name, errors in form_errors.items():
+                    new_errors = [re.sub(r"^u'", "'", error) for error in errors]
+                    response_data['form_errors'][field_name] = new_errors
+            response.set_data(json.dumps(response_data))
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Methods', 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT')
+    response.headers.add('Access-Control-Allow-Headers', 'Accept, Authorization, Content-Type')
+    return response
+
+
+def _product(product_id):
+    return {
+        "id": product_id,
+        "product_name": f"Product {product_id}",
+        "amount_available": "42",
+        "cost": "25",
+        "seller_id": "1",
+    }
+
+
+PAYLOADS = {
+    'product_details': {"product": _product(1), "errors": None, "form_errors": None},
+    'login_failed': {
+        "user": None,
+        "token": None,
+        "errors": None,
+        "form_errors": {"username": ["INVALID_LOGIN"], "password": ["INVALID_LOGIN"]},
+    },
+    'buy_legacy_change': {
+        "product": _product(1),
+        "amount_purchased": 1,
+        "transaction_amount": 25,
+        "change": [100] * 1004 + [50, 20, 5],
+        "errors": None,
+        "form_errors": None,
+    },
+    'cart_50_products': {
+        "products": [_product(product_id) for product_id in range(50)],
+        "items": [{"product_id": product_id, "amount": 1} for product_id in range(50)],
+        "transaction_amount": 1250,
+        "change": [50, 20, 5],
+        "errors": None,
+    },
+}
+
+
+def bench(hook, body, number):
+    responses = [Response(body, mimetype='application/json') for _ in range(number)]
+    iterator = iter(responses)
+    return timeit.timeit(lambda: hook(next(iterator)), number=number) / number
+
+
+def main(number=20000):
+    print(f"{'payload':<20} {'legacy µs':>10} {'current µs':>11} {'saved µs':>9}")
+    for name, payload in PAYLOADS.items():
+        body = json.dumps(payload)
+        legacy = bench(legacy_after_request, body, number) * 1e6
+        current = bench(after_request, body, number) * 1e6
+        print(f"{name:<20} {legacy:>10.2f} {current:>11.2f} {legacy - current:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
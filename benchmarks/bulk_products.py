@@ -0,0 +1,57 @@
+"""Ingesting a vendor's catalogue through POST /api/product/bulk.
+
+Runs against a throwaway database file. Times a request creating N products,
+then one updating all of them, end to end through the Flask test client.
+
+    $> python -m benchmarks.bulk_products [number of products, 10000 by default]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from app import create_app, models
+from app.auth.jwt_auth import generate_custom_auth_token
+from config import Config
+from database import db
+
+
+def make_config(path):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+    return BenchmarkConfig
+
+
+def main(products=10000):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(make_config(os.path.join(directory, 'bulk.db')))
+        with app.app_context():
+            vendor_role = models.Role(title='vendor')
+            db.session.add(vendor_role)
+            db.session.commit()
+            vendor = models.User(username='bulkvendor', password='', balance=0, role_id=vendor_role.id)
+            db.session.add(vendor)
+            db.session.commit()
+            headers = {'Authorization': f'Bearer {generate_custom_auth_token(vendor.id, role="vendor")}'}
+
+        client = app.test_client()
+        items = [{"name": f"Product {i:06d}", "cost": 5 * (i % 20 + 1), "amount": i % 50} for i in range(products)]
+
+        started = time.perf_counter()
+        response = client.post('/api/product/bulk', headers=headers, json={"products": items})
+        created = time.perf_counter() - started
+        results = response.get_json()['results']
+        assert all(result['status'] == 201 for result in results), response.get_json()
+
+        updates = [{"id": result['id'], "cost": 30, "amount": 1} for result in results]
+        started = time.perf_counter()
+        response = client.post('/api/product/bulk', headers=headers, json={"products": updates})
+        updated = time.perf_counter() - started
+        assert all(result['status'] == 200 for result in response.get_json()['results'])
+
+        print(f'{products} products created in {created * 1e3:.0f} ms, updated in {updated * 1e3:.0f} ms')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,339 @@
+"""Concurrent buys and deposits against a file-backed SQLite database.
+
+Workers, threads of one process or separate processes, each fire a mix of
+POST /api/product/buy/<id> and POST /api/user/deposit/<amount> through their
+own Flask test client at a few hot products with little stock, from buyers
+with little money. Half of the buys go through a machine with a coin
+inventory, so that change is dispensed under contention too. Afterwards the
+invariants are checked against the database and the ledger:
+
+- stock never went negative and every product lost exactly what was sold,
+- money is conserved: balances grew by the deposits and shrank by the change
+  paid out in coins, which is also what the coin inventory lost,
+- every buy and deposit a client was told succeeded is in the ledger.
+
+Writes that were committed although their request failed are reported
+separately, they are what a client would retry.
+
+Reports throughput, SQLITE_BUSY ("database is locked") errors and write
+statements that waited for the lock, so the scaling limits of the buy path
+are measured rather than guessed. Exits with 1 when an invariant is broken.
+
+    $> python -m benchmarks.concurrency [--mode threads|processes] [--workers 8] [--operations 500]
+    $> python -m benchmarks.concurrency --mode processes --workers 16 --busy-timeout 0.1
+"""
+import argparse
+import collections
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import OperationalError
+
+from app import create_app, models
+from app.auth.jwt_auth import generate_custom_auth_token
+from app.ledger import ledger_writer
+from app.models import LedgerKind
+from config import Config
+from database import db
+
+MACHINE_ID = 1
+MACHINE_COINS = {100: 200, 50: 400, 20: 1000, 10: 1000, 5: 2000}
+DEPOSITS = [5, 10, 20, 50, 100]
+# A write statement taking longer than this is counted as having waited for the lock
+LOCK_WAIT_THRESHOLD = 0.005
+
+
+def make_config(path, busy_timeout):
+    class StressConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': busy_timeout}}
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+    return StressConfig
+
+
+def make_app(path, busy_timeout):
+    app = create_app(make_config(path, busy_timeout))
+    # Requests failing on a locked database are expected here and counted, not logged one by one
+    app.logger.setLevel(logging.CRITICAL)
+    return app
+
+
+def seed(buyers, vendors, products, stock, balance):
+    """Users, products and a machine with coins. Needs an app context.
+
+    :return: plan shared by the workers: {'buyers': [token, ...], 'products': [id, ...]}
+    """
+    vendor_role = models.Role(title='vendor')
+    buyer_role = models.Role(title='buyer')
+    db.session.add_all([vendor_role, buyer_role])
+    db.session.commit()
+
+    vendor_users = [models.User(username=f'vendor{i}', password='', balance=0, role_id=vendor_role.id) for i in range(vendors)]
+    buyer_users = [models.User(username=f'buyer{i}', password='', balance=balance, role_id=buyer_role.id) for i in range(buyers)]
+    db.session.add_all(vendor_users + buyer_users)
+    db.session.commit()
+
+    product_rows = [
+        models.Product(product_name=f'Product {i}', amount_available=stock, cost=5 * (i % 5 + 1), seller_id=vendor_users[i % vendors].id)
+        for i in range(products)
+    ]
+    db.session.add_all(product_rows)
+    db.session.add_all(models.CoinInventory(machine_id=MACHINE_ID, coin=coin, count=count) for coin, count in MACHINE_COINS.items())
+    db.session.commit()
+    return {
+        'buyers': [generate_custom_auth_token(user.id, role='buyer') for user in buyer_users],
+        'products': [product.id for product in product_rows],
+    }
+
+
+def snapshot():
+    """What the invariants are checked on. Needs an app context."""
+    return {
+        'balance': db.session.execute(select(func.sum(models.User.balance))).scalar(),
+        'stock': dict(db.session.execute(select(models.Product.id, models.Product.amount_available)).all()),
+        'coins': db.session.execute(select(func.sum(models.CoinInventory.coin * models.CoinInventory.count))).scalar(),
+        'min_coins': db.session.execute(select(func.min(models.CoinInventory.count))).scalar(),
+    }
+
+
+class LockProbe():
+    """Counts SQLITE_BUSY errors and write statements that waited for the lock on an engine"""
+
+    def __init__(self, engine):
+        self.busy = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(engine, 'handle_error', self._on_error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['stress_started'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('stress_started')
+        if elapsed > LOCK_WAIT_THRESHOLD and not statement.lstrip().upper().startswith('SELECT'):
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += elapsed
+
+    def _on_error(self, context):
+        error = context.original_exception
+        if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+            with self._lock:
+                self.busy += 1
+
+    def stats(self):
+        return {'busy': self.busy, 'lock_waits': self.waits, 'lock_wait_seconds': self.wait_seconds}
+
+
+def run_worker(app, plan, index, operations, deposit_share):
+    """Fire operations requests from one client, returning what the client saw happen"""
+    rng = random.Random(index)
+    client = app.test_client()
+    statuses = collections.Counter()
+    deposited = 0
+    sold = collections.Counter()
+    for _ in range(operations):
+        headers = {'Authorization': f'Bearer {rng.choice(plan["buyers"])}'}
+        if rng.random() < deposit_share:
+            amount = rng.choice(DEPOSITS)
+            response = client.post(f'/api/user/deposit/{amount}', headers=headers)
+            statuses['deposit', response.status_code] += 1
+            if response.status_code == 200:
+                deposited += amount
+        else:
+            product_id = rng.choice(plan['products'])
+            amount = rng.choice([1, 1, 2])
+            if rng.random() < 0.5:
+                headers['X-Machine-Id'] = str(MACHINE_ID)
+            response = client.post(f'/api/product/buy/{product_id}?change_format=compact', headers=headers, json={'amount': amount})
+            statuses['buy', response.status_code] += 1
+            if response.status_code == 200:
+                sold[product_id] += amount
+    return {'statuses': statuses, 'deposited': deposited, 'sold': sold}
+
+
+def flush_ledger():
+    """Write out the ledger rows still buffered in this process, however long the lock takes"""
+    while True:
+        try:
+            ledger_writer.flush()
+            return
+        except OperationalError:
+            # Rows stay buffered for the next try
+            time.sleep(0.05)
+
+
+def merge(results):
+    merged = {'statuses': collections.Counter(), 'deposited': 0, 'sold': collections.Counter()}
+    for result in results:
+        merged['statuses'].update(result['statuses'])
+        merged['deposited'] += result['deposited']
+        merged['sold'].update(result['sold'])
+    return merged
+
+
+def run_threads(app, plan, workers, operations, deposit_share):
+    with app.app_context():
+        probe = LockProbe(db.engine)
+    results = [None] * workers
+    barrier = threading.Barrier(workers)
+
+    def target(index):
+        barrier.wait()
+        results[index] = run_worker(app, plan, index, operations, deposit_share)
+
+    threads = [threading.Thread(target=target, args=(index,)) for index in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    flush_ledger()
+    return merge(results), probe.stats(), elapsed
+
+
+def process_main(path, busy_timeout, plan, index, operations, deposit_share, barrier, queue):
+    app = make_app(path, busy_timeout)
+    with app.app_context():
+        probe = LockProbe(db.engine)
+    barrier.wait()
+    result = run_worker(app, plan, index, operations, deposit_share)
+    # The ledger rows of this process are only in its buffer so far
+    flush_ledger()
+    queue.put((result, probe.stats()))
+
+
+def run_processes(path, busy_timeout, plan, workers, operations, deposit_share):
+    context = multiprocessing.get_context('spawn')
+    # One more party, so that the clock starts when every worker has its app ready
+    barrier = context.Barrier(workers + 1)
+    queue = context.Queue()
+    processes = [
+        context.Process(target=process_main, args=(path, busy_timeout, plan, index, operations, deposit_share, barrier, queue))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    started = time.perf_counter()
+    outcomes = [queue.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    probe = collections.Counter()
+    for _, stats in outcomes:
+        probe.update(stats)
+    return merge(result for result, _ in outcomes), dict(probe), elapsed
+
+
+def check_invariants(before, after, outcome):
+    """Broken invariants and writes clients weren't told about, as lines of text. Needs an app context.
+
+    The ledger is the record of what was committed. A write a client was told
+    succeeded but that isn't there is broken. A committed write whose request
+    still failed, e.g. on a read after the commit, is only unacknowledged.
+
+    :return: (broken, unacknowledged)
+    """
+    ledger = dict(db.session.execute(
+        select(models.LedgerEntry.kind, func.sum(models.LedgerEntry.total)).group_by(models.LedgerEntry.kind)
+    ).all())
+    ledger_sold = collections.Counter(dict(db.session.execute(
+        select(models.LedgerEntry.product_id, func.sum(models.LedgerEntry.amount))
+        .where(models.LedgerEntry.kind == LedgerKind.PURCHASE).group_by(models.LedgerEntry.product_id)
+    ).all()))
+    deposited = ledger.get(LedgerKind.DEPOSIT, 0)
+    change = ledger.get(LedgerKind.CHANGE, 0)
+    broken = []
+    unacknowledged = []
+
+    negative = {product_id: stock for product_id, stock in after['stock'].items() if stock < 0}
+    if negative:
+        broken.append(f'negative stock {negative}')
+    for product_id, stock in before['stock'].items():
+        lost = stock - after['stock'][product_id]
+        if lost != ledger_sold[product_id]:
+            broken.append(f'product {product_id} lost {lost} items, the ledger has {ledger_sold[product_id]} sold')
+        if outcome['sold'][product_id] > ledger_sold[product_id]:
+            broken.append(f'product {product_id} sold {outcome["sold"][product_id]} items to clients, the ledger has {ledger_sold[product_id]}')
+        elif outcome['sold'][product_id] < ledger_sold[product_id]:
+            unacknowledged.append(f'{ledger_sold[product_id] - outcome["sold"][product_id]} items of product {product_id} sold')
+
+    if outcome['deposited'] > deposited:
+        broken.append(f'deposits of {outcome["deposited"]} succeeded for clients, the ledger has {deposited}')
+    elif outcome['deposited'] < deposited:
+        unacknowledged.append(f'{deposited - outcome["deposited"]} deposited')
+    expected_balance = before['balance'] + deposited - change
+    if after['balance'] != expected_balance:
+        broken.append(f'balances total {after["balance"]}, expected {expected_balance}')
+    if before['coins'] - after['coins'] != change:
+        broken.append(f'coin inventory lost {before["coins"] - after["coins"]}, change paid out {change}')
+    if after['min_coins'] < 0:
+        broken.append('negative coin count')
+    return broken, unacknowledged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.concurrency', description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=['threads', 'processes'], default='threads')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--operations', type=int, default=500, help='requests per worker')
+    parser.add_argument('--deposit-share', type=float, default=0.3)
+    parser.add_argument('--buyers', type=int, default=50)
+    parser.add_argument('--products', type=int, default=5, help='few products make them hot')
+    parser.add_argument('--stock', type=int, default=200)
+    parser.add_argument('--balance', type=int, default=100)
+    parser.add_argument('--busy-timeout', type=float, default=5.0, help='seconds a connection waits for the lock')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stress.db')
+        app = make_app(path, args.busy_timeout)
+        with app.app_context():
+            plan = seed(args.buyers, 2, args.products, args.stock, args.balance)
+            before = snapshot()
+
+        if args.mode == 'threads':
+            outcome, probe, elapsed = run_threads(app, plan, args.workers, args.operations, args.deposit_share)
+        else:
+            outcome, probe, elapsed = run_processes(
+                path, args.busy_timeout, plan, args.workers, args.operations, args.deposit_share
+            )
+
+        with app.app_context():
+            db.session.remove()
+            after = snapshot()
+            broken, unacknowledged = check_invariants(before, after, outcome)
+
+    requests = sum(outcome['statuses'].values())
+    print(f'{args.workers} {args.mode}, {requests} requests in {elapsed:.2f}s: {requests / elapsed:.0f} req/s')
+    for (kind, status), count in sorted(outcome['statuses'].items()):
+        print(f'  {kind:<8} {status}: {count}')
+    print(f"SQLITE_BUSY errors: {probe['busy']} ({probe['busy'] / requests:.2%} of requests)")
+    print(f"Write statements waiting over {LOCK_WAIT_THRESHOLD * 1e3:.0f} ms for the lock: "
+          f"{probe['lock_waits']} ({probe['lock_waits'] / requests:.2f} per request), {probe['lock_wait_seconds']:.2f}s in total")
+
+    for line in unacknowledged:
+        print(f'UNACKNOWLEDGED {line}, committed but the request failed')
+    for line in broken:
+        print(f'BROKEN {line}')
+    if broken:
+        return 1
+    print('Invariants hold: no negative stock, no oversell, money conserved')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""Latency, throughput and SQL statements per request of the hot endpoints.
+
+Runs in-process against create_app with the Flask test client, over a
+throwaway database file seeded through the test factories (tests/utils.py)
+at a configurable scale. For each endpoint it reports p50/p95/p99 latency,
+requests per second and SQL statements per request. Results can be saved as
+a JSON baseline and later runs compared against one: the check fails when
+an endpoint got slower than the tolerance allows or runs more statements.
+Latencies are only comparable between runs on the same machine.
+
+    $> python -m benchmarks.endpoints --save baseline.json
+    $> python -m benchmarks.endpoints --compare baseline.json [--tolerance 0.2]
+    $> python -m benchmarks.endpoints --only buy deposit --requests 2000 --users 10000 --products 50000
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from flask import url_for
+from sqlalchemy import event
+
+from app import create_app
+from app.auth.jwt_auth import generate_custom_auth_token
+from app.ledger import ledger_writer
+from app.roles import role_registry
+from config import Config
+from database import db
+from tests.utils import ProductFactory, RoleFactory, UserFactory
+
+PASSWORD = 'password'
+# Enough for over a hundred purchases each. Not much more, the remaining balance
+# is listed coin by coin in the response of a buy and would dominate its cost.
+BALANCE = 10000
+# Stock that never runs out over a run
+DEEP_STOCK = 10 ** 12
+
+
+def make_config(path):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+    return BenchmarkConfig
+
+
+def seed(users, products, vendor_share=0.1, batch_size=1000):
+    """Roles, users and products made by the test factories, returned as plain dicts with tokens.
+
+    Every user has PASSWORD for a password and BALANCE. Needs an app context.
+    """
+    vendor_role = RoleFactory.create(title='vendor', db=db)
+    buyer_role = RoleFactory.create(title='buyer', db=db)
+    vendors = max(1, int(users * vendor_share))
+
+    users_made = []
+    for start in range(0, users, batch_size):
+        batch = [
+            UserFactory.create(
+                username=f'bench{index}', password=PASSWORD, balance=BALANCE,
+                role_id=vendor_role.id if index < vendors else buyer_role.id,
+            )
+            for index in range(start, min(start + batch_size, users))
+        ]
+        db.session.add_all(batch)
+        db.session.commit()
+        users_made.extend(
+            {'id': user.id, 'username': user.username, 'role': 'vendor' if user.role_id == vendor_role.id else 'buyer'}
+            for user in batch
+        )
+    role_registry.load()
+    for user in users_made:
+        user['token'] = generate_custom_auth_token(user['id'], role=user['role'])
+
+    rng = random.Random(0)
+    product_ids = {user['id']: [] for user in users_made if user['role'] == 'vendor'}
+    vendor_ids = list(product_ids)
+    for start in range(0, products, batch_size):
+        batch = [
+            ProductFactory.create(
+                product_name=f'Product {index}', amount_available=DEEP_STOCK, cost=rng.choice([5, 10, 25, 50, 75]),
+                seller_id=rng.choice(vendor_ids),
+            )
+            for index in range(start, min(start + batch_size, products))
+        ]
+        db.session.add_all(batch)
+        db.session.commit()
+        for product in batch:
+            product_ids[product.seller_id].append(product.id)
+
+    return {
+        'vendors': [user for user in users_made if user['role'] == 'vendor' and product_ids[user['id']]],
+        'buyers': [user for user in users_made if user['role'] == 'buyer'],
+        'products': product_ids,
+    }
+
+
+def auth(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+# Every scenario makes one request from the i-th call and the seeded dataset
+def sign_up(client, data, rng, i):
+    return client.post(url_for('api.user_sign_up_user'), json={
+        'username': f'signup{i}', 'password': PASSWORD, 'role': 'buyer',
+    })
+
+
+def login(client, data, rng, i):
+    user = rng.choice(data['buyers'])
+    return client.post(url_for('api.user_log_in_user'), json={'username': user['username'], 'password': PASSWORD})
+
+
+def deposit(client, data, rng, i):
+    return client.post(url_for('api.user_deposit', amount=5), headers=auth(rng.choice(data['buyers'])['token']))
+
+
+def product_details(client, data, rng, i):
+    vendor = rng.choice(data['vendors'])
+    return client.get(url_for('api.product_product_details', product_id=rng.choice(data['products'][vendor['id']])))
+
+
+def patch_product(client, data, rng, i):
+    vendor = rng.choice(data['vendors'])
+    return client.patch(
+        url_for('api.product_product_details', product_id=rng.choice(data['products'][vendor['id']])),
+        # A new amount every time, a patch changing nothing would skip the UPDATE
+        headers=auth(vendor['token']), json={'cost': rng.choice([5, 10, 25, 50, 75]), 'amount': DEEP_STOCK + i},
+    )
+
+
+def buy(client, data, rng, i):
+    vendor = rng.choice(data['vendors'])
+    return client.post(
+        url_for('api.product_buy_product', product_id=rng.choice(data['products'][vendor['id']])),
+        headers=auth(rng.choice(data['buyers'])['token']), json={'amount': 1},
+    )
+
+
+SCENARIOS = {
+    'sign_up': (sign_up, 201),
+    'login': (login, 200),
+    'deposit': (deposit, 200),
+    'product_details': (product_details, 200),
+    'patch_product': (patch_product, 200),
+    'buy': (buy, 200),
+}
+
+
+class StatementCounter():
+    """Counts the SQL statements the current thread runs, not the background writers'"""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._thread = threading.get_ident()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self._thread:
+            self.count += 1
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(app, client, counter, data, scenario, expected_status, requests, warmup):
+    rng = random.Random(1)
+    latencies = []
+    statements = 0
+    with app.test_request_context():
+        for i in range(warmup + requests):
+            counter.count = 0
+            started = time.perf_counter()
+            response = scenario(client, data, rng, i)
+            elapsed = time.perf_counter() - started
+            assert response.status_code == expected_status, (scenario.__name__, response.status_code, response.get_data())
+            if i >= warmup:
+                latencies.append(elapsed)
+                statements += counter.count
+    latencies.sort()
+    return {
+        'requests': requests,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p95_ms': percentile(latencies, 0.95) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'throughput_rps': requests / sum(latencies),
+        'sql_per_request': statements / requests,
+    }
+
+
+def run(names, requests, warmup, users, products):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(make_config(os.path.join(directory, 'bench.db')))
+        with app.app_context():
+            data = seed(users, products)
+            counter = StatementCounter(db.engine)
+        client = app.test_client()
+        for name in names:
+            scenario, expected_status = SCENARIOS[name]
+            results[name] = run_scenario(app, client, counter, data, scenario, expected_status, requests, warmup)
+        # Write out what the buys left buffered while the database is still there
+        ledger_writer.flush()
+    return results
+
+
+def compare(baseline, results, tolerance):
+    """Regressions of results against a baseline, as lines of text
+
+    p50 and p95 regress by getting slower than the baseline by more than
+    tolerance (a fraction), statements per request by getting more at all.
+    p99 is reported only, a few hundred requests make it too noisy to gate on.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms'):
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f'{name} {metric}: {base[metric]:.3f} -> {result[metric]:.3f}')
+        if round(result['sql_per_request'], 2) > round(base['sql_per_request'], 2):
+            regressions.append(f"{name} sql_per_request: {base['sql_per_request']:.2f} -> {result['sql_per_request']:.2f}")
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'endpoint':<16} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'sql/req':>8}")
+    for name, result in results.items():
+        line = (
+            f"{name:<16} {result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f} {result['p99_ms']:>8.3f} "
+            f"{result['throughput_rps']:>8.0f} {result['sql_per_request']:>8.2f}"
+        )
+        base = (baseline or {}).get('results', {}).get(name)
+        if base:
+            line += f"   p50 {(result['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}% vs baseline"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.endpoints', description=__doc__.split('\n')[0])
+    parser.add_argument('--only', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS), metavar='ENDPOINT')
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests per endpoint first')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--save', metavar='FILE', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='exit with 1 when slower or chattier than this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='latency increase allowed by --compare, 0.2 = 20%%')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run(args.only, args.requests, args.warmup, args.users, args.products)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({
+                'meta': {
+                    'created_at': int(time.time()),
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'requests': args.requests,
+                    'users': args.users,
+                    'products': args.products,
+                },
+                'results': results,
+            }, baseline_file, indent=2)
+        print(f'Baseline saved to {args.save}')
+
+    if baseline is not None:
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""Encoding and decoding our response payloads with each JSON_BACKEND.
+
+Encoding goes through output_json, the way flask_restx responses are built,
+decoding through the backend's loads, the way request.get_json parses bodies.
+
+    $> python -m benchmarks.json_backends
+"""
+import timeit
+
+from app import create_app, json_backend
+from app.json_backend import JSON_BACKENDS, output_json
+from benchmarks.after_request import PAYLOADS
+
+
+def main(number=2000):
+    app = create_app()
+    print(f"{'payload':<20} {'backend':<8} {'encode µs':>10} {'decode µs':>10} {'bytes':>7}")
+    for name, payload in PAYLOADS.items():
+        for backend in JSON_BACKENDS:
+            app.config['JSON_BACKEND'] = backend
+            json_backend.init_app(app)
+            with app.test_request_context():
+                body = output_json(payload, 200).get_data()
+                encode = timeit.timeit(lambda: output_json(payload, 200), number=number) / number * 1e6
+                decode = timeit.timeit(lambda: app.json.loads(body), number=number) / number * 1e6
+            print(f"{name:<20} {backend:<8} {encode:>10.2f} {decode:>10.2f} {len(body):>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Cost of serializing the response models with flask_restx's marshal vs the compiled marshallers.
+
+    $> python -m benchmarks.marshalling
+"""
+import timeit
+
+from flask_restx import marshal
+
+from app import create_app, models
+from app.rest.marshalling import compile_model
+from app.rest.products import buy_response_model, cart_response_model, product_details_model
+from app.rest.rest_models import product_model
+
+
+def _product(product_id):
+    return models.Product(
+        id=product_id,
+        product_name=f"Product {product_id}",
+        amount_available=42,
+        cost=25,
+        seller_id=1,
+    )
+
+
+def cases():
+    return {
+        'product_details': (product_details_model, {"product": _product(1)}),
+        'buy_legacy_change': (buy_response_model, {
+            "product": _product(1),
+            "amount_purchased": 1,
+            "transaction_amount": 25,
+            "change": [100] * 1004 + [50, 20, 5],
+        }),
+        'cart_50_products': (cart_response_model, {
+            "products": [_product(product_id) for product_id in range(50)],
+            "items": [{"product_id": product_id, "amount": 1} for product_id in range(50)],
+            "transaction_amount": 1250,
+            "change": [50, 20, 5],
+        }),
+        'product_list_1000': (product_model, [_product(product_id) for product_id in range(1000)]),
+    }
+
+
+def main(number=2000):
+    with create_app().app_context():
+        print(f"{'payload':<20} {'marshal µs':>11} {'compiled µs':>12} {'speedup':>8}")
+        for name, (model, data) in cases().items():
+            compiled = compile_model(model)
+            assert compiled(data) == marshal(data, model)
+            runs = max(number // (len(data) if isinstance(data, list) else 1), 10)
+            interpreted_time = timeit.timeit(lambda: marshal(data, model), number=runs) / runs * 1e6
+            compiled_time = timeit.timeit(lambda: compiled(data), number=runs) / runs * 1e6
+            print(f"{name:<20} {interpreted_time:>11.2f} {compiled_time:>12.2f} {interpreted_time / compiled_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Overhead of the per-request instrumentation (app/metrics.py).
+
+Times the request hooks and the statement events on their own, then the
+cheapest endpoint and the one running the most statements with the
+instrumentation on and off, alternating rounds over the same dataset as
+benchmarks.endpoints, and a scrape of /api/metrics. End to end, buy is
+dominated by commits and the difference drowns in their noise.
+
+    $> python -m benchmarks.metrics [requests per round, 1000 by default]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+from flask import Response
+
+from app import create_app
+from app.metrics import request_metrics
+from benchmarks.endpoints import SCENARIOS, StatementCounter, make_config, run_scenario, seed
+from database import db
+from app.ledger import ledger_writer
+
+ROUNDS = 5
+
+
+def main(requests=1000):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(make_config(os.path.join(directory, 'bench.db')))
+        with app.app_context():
+            data = seed(1000, 5000)
+            counter = StatementCounter(db.engine)
+        client = app.test_client()
+
+        request_metrics.enabled = True
+        response = Response()
+        with app.test_request_context('/api/product/1'):
+            hooks = timeit.timeit(lambda: (request_metrics.start_request(), request_metrics.end_request(response)), number=100000) / 100000
+            request_metrics.start_request()
+            statement = timeit.timeit(
+                lambda: (
+                    request_metrics._before_cursor_execute(None, None, '', None, None, False),
+                    request_metrics._after_cursor_execute(None, None, '', None, None, False),
+                ),
+                number=100000,
+            ) / 100000
+        print(f'Request hooks {hooks * 1e6:.2f} µs per request, statement events {statement * 1e6:.2f} µs per statement')
+
+        print(f"{'endpoint':<16} {'off p50 ms':>11} {'on p50 ms':>10} {'overhead µs':>12}")
+        for name in ('product_details', 'buy'):
+            scenario, expected_status = SCENARIOS[name]
+            p50 = {True: [], False: []}
+            for round_index in range(ROUNDS):
+                # Alternating which goes first, the dataset changes as the run goes on
+                for enabled in ((False, True) if round_index % 2 else (True, False)):
+                    request_metrics.enabled = enabled
+                    result = run_scenario(app, client, counter, data, scenario, expected_status, requests // ROUNDS, 20)
+                    p50[enabled].append(result['p50_ms'])
+            off, on = statistics.median(p50[False]), statistics.median(p50[True])
+            print(f'{name:<16} {off:>11.3f} {on:>10.3f} {(on - off) * 1e3:>12.1f}')
+
+        request_metrics.enabled = True
+        started = time.perf_counter()
+        response = client.get('/api/metrics')
+        print(f'Scrape of {len(response.data)} bytes in {(time.perf_counter() - started) * 1e3:.2f} ms')
+        ledger_writer.flush()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
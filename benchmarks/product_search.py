@@ -0,0 +1,74 @@
+"""Latency of product search (app/search.py) over a large catalogue.
+
+Builds a throwaway in-memory database of random product names, indexed by
+the same triggers as the real one, then times first pages and deep pages
+for a few kinds of query.
+
+    $> python -m benchmarks.product_search [number of products, 1000000 by default]
+"""
+import random
+import sys
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+from database import db
+from app.models import Product
+from app.search import search_products
+
+WORDS = [
+    'cola', 'zero', 'classic', 'cherry', 'lemon', 'lime', 'orange', 'chocolate', 'caramel', 'peanut', 'almond',
+    'gum', 'mint', 'chips', 'salted', 'paprika', 'cheese', 'onion', 'water', 'sparkling', 'still', 'energy',
+    'drink', 'bar', 'cookie', 'wafer', 'coffee', 'espresso', 'latte', 'tea', 'green', 'black', 'juice', 'apple',
+]
+QUERIES = {
+    'rare word': 'espresso latte',
+    'common word': 'cola',
+    'common prefix': 'co',
+    'prefix': 'choc',
+    'two prefixes': 'sal chi',
+}
+
+
+def build(engine, products, batch_size=50000):
+    rng = random.Random(42)
+    db.metadata.create_all(engine, tables=[Product.__table__])
+    with engine.begin() as connection:
+        for start in range(0, products, batch_size):
+            connection.execute(insert(Product.__table__), [
+                {
+                    'product_name': ' '.join(rng.sample(WORDS, rng.randint(1, 3))) + f' {i}',
+                    'amount_available': rng.randint(0, 100),
+                    'cost': rng.choice([5, 10, 25, 50, 75]),
+                    'seller_id': rng.randint(1, 1000),
+                }
+                for i in range(start, min(start + batch_size, products))
+            ])
+
+
+def timed(session, query, after, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        rows, cursor = search_products(session, query, 50, after=after)
+    return (time.perf_counter() - started) / number * 1e3, cursor
+
+
+def main(products=1000000, number=20):
+    engine = create_engine('sqlite://')
+    started = time.perf_counter()
+    build(engine, products)
+    print(f'Indexed {products} products in {time.perf_counter() - started:.1f}s')
+
+    print(f"{'query':<14} {'page 1 ms':>10} {'page 20 ms':>11}")
+    with Session(engine) as session:
+        for name, query in QUERIES.items():
+            first, cursor = timed(session, query, None, number)
+            for _ in range(18):
+                _, cursor = search_products(session, query, 50, after=cursor)
+            deep, _ = timed(session, query, cursor, number) if cursor else (float('nan'), None)
+            print(f'{name:<14} {first:>10.2f} {deep:>11.2f}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,152 @@
+"""Concurrent readers and writers on a SQLite file, driver defaults vs the tuned profile.
+
+Runs the same mix twice against a fresh copy of the same database: once with
+the engine of the base Config (a connection per checkout, rollback journal,
+synchronous=FULL) and once with the engine profile of ProductionConfig (WAL,
+synchronous=NORMAL, mmap, a bigger page cache and a pool of connections, see
+config.py). Writer threads run the statements of a buy in a transaction,
+reader threads fetch a product and a page of the listing. Reports throughput,
+latencies and SQLITE_BUSY ("database is locked") errors of both.
+
+    $> python -m benchmarks.sqlite_profile [--readers 8] [--writers 4] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.exc import OperationalError
+
+from app import models
+from config import Config, ProductionConfig
+from database import db, set_sqlite_pragmas
+
+USERS = 1000
+PRODUCTS = 5000
+PAGE = 50
+
+BUY = [
+    text('UPDATE users SET balance = balance - :cost WHERE id = :buyer_id AND balance >= :cost'),
+    text('UPDATE products SET amount_available = amount_available - 1 WHERE id = :product_id AND amount_available > 0'),
+    text('UPDATE users SET balance = balance + :cost WHERE id = :seller_id'),
+]
+PRODUCT = text('SELECT * FROM products WHERE id = :product_id')
+LISTING = text('SELECT * FROM products ORDER BY id LIMIT :limit OFFSET :offset')
+
+
+def seed(path):
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    rng = random.Random(0)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User.__table__), [
+            {'id': i, 'username': f'user{i}', 'password': '', 'balance': 10 ** 9, 'role_id': None}
+            for i in range(1, USERS + 1)
+        ])
+        conn.execute(insert(models.Product.__table__), [
+            {'id': i, 'product_name': f'product {i}', 'amount_available': 10 ** 9, 'cost': rng.choice([5, 10, 50, 100]),
+             'seller_id': rng.randint(1, USERS)}
+            for i in range(1, PRODUCTS + 1)
+        ])
+    engine.dispose()
+
+
+def make_engine(path, config):
+    engine = create_engine(f'sqlite:///{path}', **getattr(config, 'SQLALCHEMY_ENGINE_OPTIONS', {}))
+    set_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+    return engine
+
+
+def percentile(samples, share):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def run(engine, readers, writers, seconds):
+    stop = threading.Event()
+    results = {'read': [], 'write': []}
+    busy = []
+    lock = threading.Lock()
+
+    def read(rng):
+        with engine.connect() as conn:
+            conn.execute(PRODUCT, {'product_id': rng.randint(1, PRODUCTS)}).one()
+            conn.execute(LISTING, {'limit': PAGE, 'offset': rng.randrange(0, PRODUCTS - PAGE)}).all()
+
+    def write(rng):
+        params = {'buyer_id': rng.randint(1, USERS), 'product_id': rng.randint(1, PRODUCTS),
+                  'seller_id': rng.randint(1, USERS), 'cost': 5}
+        with engine.begin() as conn:
+            for statement in BUY:
+                conn.execute(statement, params)
+
+    def worker(kind, operation, seed_value):
+        rng = random.Random(seed_value)
+        latencies, errors = [], 0
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                operation(rng)
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+        with lock:
+            results[kind].extend(latencies)
+            busy.append(errors)
+
+    threads = [threading.Thread(target=worker, args=('read', read, i)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=('write', write, readers + i)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'reads/s': len(results['read']) / seconds,
+        'writes/s': len(results['write']) / seconds,
+        'read p50 ms': percentile(results['read'], 0.5) * 1e3,
+        'read p99 ms': percentile(results['read'], 0.99) * 1e3,
+        'write p50 ms': percentile(results['write'], 0.5) * 1e3,
+        'write p99 ms': percentile(results['write'], 0.99) * 1e3,
+        'busy errors': sum(busy),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    profiles = {'default': Config, 'tuned': ProductionConfig}
+    reports = {}
+    with tempfile.TemporaryDirectory() as directory:
+        seeded = os.path.join(directory, 'seed.db')
+        seed(seeded)
+        for name, config in profiles.items():
+            path = os.path.join(directory, f'{name}.db')
+            shutil.copyfile(seeded, path)
+            engine = make_engine(path, config)
+            reports[name] = run(engine, args.readers, args.writers, args.seconds)
+            engine.dispose()
+
+    print(f'{args.readers} readers, {args.writers} writers, {args.seconds:g}s each\n')
+    print(f'{"":<14}' + ''.join(f'{name:>12}' for name in reports) + f'{"tuned/default":>15}')
+    for metric in reports['default']:
+        default, tuned = reports['default'][metric], reports['tuned'][metric]
+        ratio = f'{tuned / default:.2f}x' if default else '-'
+        print(f'{metric:<14}' + ''.join(f'{report[metric]:>12.1f}' for report in reports.values()) + f'{ratio:>15}')
+
+
+if __name__ == '__main__':
+    main()
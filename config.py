@@ -1,11 +1,30 @@
 import os
 
+from sqlalchemy.pool import QueuePool
+
 from app import keys
 from database import DB_NAME
 
 # Determine the folder of the top-level directory of this project
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 
+# Engine profile for concurrent use of a SQLite file, see benchmarks/sqlite_profile.py.
+# The pragmas are applied to every new connection by database.set_sqlite_pragmas.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers and the writer don't block each other
+    'synchronous': 'NORMAL',  # no fsync per commit, WAL stays consistent but may lose the last commits on power loss
+    'busy_timeout': 5000,  # ms a writer waits for the lock before "database is locked"
+    'mmap_size': 256 * 1024 * 1024,  # bytes of the file read through memory mapping
+    'cache_size': -64 * 1024,  # page cache per connection, negative is in KiB
+}
+# Connections are kept open, rather than opened per checkout, so the pragmas run once per connection
+SQLITE_ENGINE_OPTIONS = {
+    'poolclass': QueuePool,
+    'pool_size': 10,
+    'max_overflow': 10,
+    'connect_args': {'check_same_thread': False, 'timeout': 5},
+}
+
 
 class Config(object):
     # FLASK_ENV = 'development'
@@ -13,17 +32,70 @@ class Config(object):
     TESTING = False
     SECRET_KEY = keys.API_KEYS['secret_key']
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{DB_NAME}'
+    # Driver defaults, the configs below carry the tuned SQLite profile
+    SQLITE_PRAGMAS = {}
+    # Read-only handlers read from this database when set, see app/replica.py
+    REPLICA_DATABASE_URI = None
+    REPLICA_STICKY_SECONDS = 5  # a user reads from the primary for this long after a write
+    REPLICA_SYNC_INTERVAL = 1.0  # seconds between backups of the primary into a local SQLite replica, 0 for none
+
+    # Encoder/decoder of request and response bodies, see app/json_backend.py.
+    # 'json' or 'orjson' (falls back to 'json' when orjson isn't installed). orjson is faster, but its
+    # output is compact and keeps non-ASCII characters as they are, so a config has to opt in to it
+    JSON_BACKEND = 'json'
+
+    # Idempotency-Key support, see app/idempotency.py
+    IDEMPOTENCY_TTL = 60 * 60 * 24  # 1 day
+    IDEMPOTENCY_CACHE_SIZE = 10000
+    IDEMPOTENCY_SWEEP_INTERVAL = 60 * 10  # 0 disables the background sweeper
+    IDEMPOTENCY_SWEEP_BATCH = 1000
+
+    # Write-behind buffer of the purchase ledger, see app/ledger.py
+    LEDGER_FLUSH_SIZE = 500  # rows per group commit
+    LEDGER_FLUSH_INTERVAL = 1.0  # seconds
+
+    # Machine whose coin inventory change is given from when the X-Machine-Id header is absent.
+    # None, or a machine without coin_inventory rows, gives change as if coins were unlimited.
+    MACHINE_ID = None
+
+    # Per-request latency and SQL counters, scraped at /api/metrics, see app/metrics.py
+    METRICS_ENABLED = True
+
+    # Logging of requests that run a statement in a loop or spend too long in SQL, see app/query_detector.py.
+    # Meant for development and canary builds.
+    QUERY_DETECTOR_ENABLED = False
+    QUERY_DETECTOR_REPEAT_THRESHOLD = 5  # the same statement more often than this gets a request flagged
+    QUERY_DETECTOR_TIME_BUDGET = 0.5  # seconds of SQL per request, None for no budget
+
+    # Profiling of single requests sent with a signed X-Profile header, see app/profiling.py.
+    # Meant for staging, `flask profile_header` makes the header.
+    PROFILER_ENABLED = False
+    PROFILER_SECRET = None  # the SECRET_KEY signs the headers when None
+    PROFILER_DIR = os.path.join(BASEDIR, 'instance', 'profiles')
+    PROFILER_KEEP = 50  # dumps kept in PROFILER_DIR, the oldest are deleted
+    PROFILER_TOP = 5  # hotspots in the X-Profile-Summary response header
+    PROFILER_SAMPLE_INTERVAL = 0.001  # seconds between stack samples in the sampling mode
 
 
 class ProductionConfig(Config):
     FLASK_ENV = 'production'
+    SQLITE_PRAGMAS = SQLITE_PRAGMAS
+    SQLALCHEMY_ENGINE_OPTIONS = SQLITE_ENGINE_OPTIONS
 
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    QUERY_DETECTOR_ENABLED = True
+    SQLITE_PRAGMAS = SQLITE_PRAGMAS
+    SQLALCHEMY_ENGINE_OPTIONS = SQLITE_ENGINE_OPTIONS
+    # A local copy of the database standing in for a read replica
+    REPLICA_DATABASE_URI = f'sqlite:///{DB_NAME}_replica'
 
 
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{DB_NAME}_test'
+    # Durability doesn't matter for a test database
+    SQLITE_PRAGMAS = {**SQLITE_PRAGMAS, 'synchronous': 'OFF'}
+    SQLALCHEMY_ENGINE_OPTIONS = SQLITE_ENGINE_OPTIONS
 
@@ -1,4 +1,68 @@
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect, text
 
-db = SQLAlchemy()
 DB_NAME = "database.db"
+
+
+class RoutingSession(Session):
+    """Session sending the statements of a request to the engine in g.read_replica when there is one, see app/replica.py.
+
+    While g.hold_commit is set, commit only flushes and leaves the transaction
+    open for whoever set it to commit, see app/idempotency.py.
+    """
+
+    def commit(self):
+        if has_request_context() and g.get('hold_commit'):
+            self.flush()
+            # As if committed, later reads load fresh rows
+            self.expire_all()
+            return
+        super().commit()
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            replica = g.get('read_replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """Run `PRAGMA name = value` for each of pragmas on every new connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    statements = [f'PRAGMA {name} = {value}' for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+def add_missing_columns(engine, metadata):
+    """ALTER the tables that already exist to add the model columns they lack, which create_all doesn't.
+
+    New columns have to be nullable or have a server_default.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                definition = f'{column.name} {column.type.compile(engine.dialect)}'
+                if not column.nullable:
+                    definition += ' NOT NULL'
+                if column.server_default is not None:
+                    definition += f' DEFAULT {column.server_default.arg}'
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {definition}'))
@@ -1,6 +1,7 @@
-from app import create_app
+from app import create_app, environment
+from config import DevelopmentConfig, ProductionConfig
 
-app = create_app()
+app = create_app(DevelopmentConfig if environment.is_development() else ProductionConfig)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
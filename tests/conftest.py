@@ -4,6 +4,7 @@ import pytest
 # from werkzeug.security import generate_password_hash
 
 from app import create_app
+from config import TestingConfig
 from app.auth.jwt_auth import generate_custom_auth_token
 from database import db as project_db
 
@@ -12,7 +13,7 @@ from tests.utils import UserFactory, RoleFactory
 
 @pytest.fixture
 def app():
-    app = create_app()
+    app = create_app(TestingConfig)
     return app
 
 
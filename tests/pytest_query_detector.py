@@ -0,0 +1,63 @@
+"""pytest plugin failing tests whose API requests run a statement in a loop or go over a SQL time budget.
+
+Loaded for the suite by addopts in pyproject.toml. The detector (app/query_detector.py)
+checks every request a test makes with the repeat threshold of --query-repeat-threshold,
+and the SQL time budget of --query-time-budget if given, overridable per test:
+
+    @pytest.mark.query_budget(repeats=20, seconds=0.2)
+    def test_...
+
+    @pytest.mark.query_budget(ignore=True)
+    def test_...
+
+    $> python -m pytest --no-query-detector  # to switch it off
+"""
+import pytest
+from sqlalchemy.engine import Engine
+
+from app.query_detector import query_detector
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('query detector')
+    group.addoption('--no-query-detector', action='store_true', help="don't fail tests on flagged requests")
+    group.addoption('--query-repeat-threshold', type=int, default=5,
+                    help='times a request may run the same statement, 5 by default')
+    group.addoption('--query-time-budget', type=float, default=None,
+                    help='seconds of SQL a request may take, no budget by default')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'query_budget(repeats=None, seconds=None, ignore=False): '
+        'repeat threshold and SQL time budget of the requests of a test for the query detector'
+    )
+    if not config.getoption('--no-query-detector'):
+        # Every engine, the test apps are created after this
+        query_detector.watch(Engine)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker('query_budget')
+    budget = marker.kwargs if marker else {}
+    if item.config.getoption('--no-query-detector') or budget.get('ignore'):
+        yield
+        return
+
+    saved = query_detector.enabled, query_detector.repeat_threshold, query_detector.time_budget
+    query_detector.enabled = True
+    query_detector.repeat_threshold = budget.get('repeats', item.config.getoption('--query-repeat-threshold'))
+    query_detector.time_budget = budget.get('seconds', item.config.getoption('--query-time-budget'))
+    query_detector.collected = findings = []
+    try:
+        outcome = yield
+    finally:
+        query_detector.enabled, query_detector.repeat_threshold, query_detector.time_budget = saved
+        query_detector.collected = None
+
+    if findings and outcome.excinfo is None:
+        pytest.fail('\n\n'.join(
+            f"Query detector flagged {finding['endpoint']}, {finding['message']}\n{finding['stack']}"
+            for finding in findings
+        ), pytrace=False)
@@ -1,7 +1,12 @@
 import json
+import uuid
 from flask import url_for
+from sqlalchemy import event
 
+from app import models
+from app.auth.jwt_auth import generate_custom_auth_token, bump_token_version
 from app.errors import Errors
+from app.ledger import ledger_writer
 from tests.utils import UserFactory, ProductFactory
 
 
@@ -108,3 +113,604 @@ def test_product_purchase_change_105(client, db):
     response_object = json.loads(response.data)
     assert response.status_code == 200
     assert response_object['change'] == [100, 5]
+
+def test_product_purchase_is_persisted(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets a valid req
+    THEN the stock and both balances are updated in the database
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(balance=10, role='vendor', db=db)
+    product = ProductFactory.create(cost=30, amount_available=5, seller_id=vendor.id, db=db)
+    req_json = {"amount": 2}
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json=req_json,
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 200
+    assert response_object['transaction_amount'] == 60
+    assert int(response_object['product']['amount_available']) == 3
+
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 40
+    assert models.User.query.get(vendor.id).balance == 70
+    assert models.Product.query.get(product.id).amount_available == 3
+
+def test_product_purchase_not_enough_stock(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets a req for more items than there are in stock
+    THEN the response field 'errors' contains 'NOT_ENOUGH_STOCK' and nothing is charged
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=10, amount_available=1, seller_id=vendor.id, db=db)
+    req_json = {"amount": 2}
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json=req_json,
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 400
+    assert Errors.NOT_ENOUGH_STOCK in response_object['errors']
+
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 100
+    assert models.Product.query.get(product.id).amount_available == 1
+
+def test_product_purchase_wrong_product_id(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets a req for a product that doesn't exist
+    THEN the response field 'errors' contains 'WRONG_PRODUCT_ID' and response code == 404
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    req_json = {"amount": 1}
+    response = client.post(
+        url_for('api.product_buy_product', product_id=987654321),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json=req_json,
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 404
+    assert Errors.WRONG_PRODUCT_ID in response_object['errors']
+
+def test_cart_checkout(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy endpoint gets a cart with products of two different vendors
+    THEN the whole cart is bought, every vendor is paid and the change is built for the final balance
+    """
+    buyer = UserFactory.create(balance=200, role='buyer', db=db)
+    vendor1 = UserFactory.create(balance=0, role='vendor', db=db)
+    vendor2 = UserFactory.create(balance=0, role='vendor', db=db)
+    product1 = ProductFactory.create(cost=20, amount_available=10, seller_id=vendor1.id, db=db)
+    product2 = ProductFactory.create(cost=15, amount_available=10, seller_id=vendor1.id, db=db)
+    product3 = ProductFactory.create(cost=50, amount_available=1, seller_id=vendor2.id, db=db)
+    req_json = {"items": [
+        {"product_id": product1.id, "amount": 2},
+        {"product_id": product2.id, "amount": 1},
+        {"product_id": product3.id, "amount": 1},
+        {"product_id": product1.id, "amount": 1},
+    ]}
+    response = client.post(
+        url_for('api.product_buy_cart'),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json=req_json,
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 200
+    assert response_object['transaction_amount'] == 125
+    assert response_object['change'] == [50, 20, 5]
+    assert {"product_id": product1.id, "amount": 3} in response_object['items']
+
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 75
+    assert models.User.query.get(vendor1.id).balance == 75
+    assert models.User.query.get(vendor2.id).balance == 50
+    assert models.Product.query.get(product1.id).amount_available == 7
+    assert models.Product.query.get(product3.id).amount_available == 0
+
+def test_cart_checkout_rolls_back_as_a_unit(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy endpoint gets a cart where one of the products is out of stock
+    THEN nothing in the cart is bought and 'NOT_ENOUGH_STOCK' is returned
+    """
+    buyer = UserFactory.create(balance=200, role='buyer', db=db)
+    vendor = UserFactory.create(balance=0, role='vendor', db=db)
+    in_stock = ProductFactory.create(cost=20, amount_available=10, seller_id=vendor.id, db=db)
+    out_of_stock = ProductFactory.create(cost=20, amount_available=0, seller_id=vendor.id, db=db)
+    req_json = {"items": [
+        {"product_id": in_stock.id, "amount": 1},
+        {"product_id": out_of_stock.id, "amount": 1},
+    ]}
+    response = client.post(
+        url_for('api.product_buy_cart'),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json=req_json,
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 400
+    assert Errors.NOT_ENOUGH_STOCK in response_object['errors']
+
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 200
+    assert models.User.query.get(vendor.id).balance == 0
+    assert models.Product.query.get(in_stock.id).amount_available == 10
+
+def test_product_purchase_is_recorded_in_ledger(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets a valid req
+    THEN a purchase entry is written to the ledger once the write-behind buffer is flushed
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=30, seller_id=vendor.id, db=db)
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json={"amount": 2},
+        follow_redirects=True
+    )
+    assert response.status_code == 200
+
+    ledger_writer.flush()
+    entries = models.LedgerEntry.query.filter_by(buyer_id=buyer.id).all()
+    assert len(entries) == 1
+    assert entries[0].kind == models.LedgerKind.PURCHASE
+    assert entries[0].seller_id == vendor.id
+    assert entries[0].product_id == product.id
+    assert entries[0].amount == 2
+    assert entries[0].total == 60
+
+def test_product_purchase_compact_change(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets a valid req with ?change_format=compact
+    THEN the change is returned as {coin: count} in 'change_counts' instead of the flat 'change' list
+    """
+    buyer = UserFactory.create(balance=100500, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=25, seller_id=vendor.id, db=db)
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id, change_format='compact'),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json={"amount": 1},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 200
+    assert response_object['change_counts'] == {"100": 1004, "50": 1, "20": 1, "5": 1}
+    assert 'change' not in response_object
+
+def test_product_purchase_from_coin_inventory(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing and a machine with a limited coin inventory
+    WHEN the /product/buy/<int:product_id> endpoint gets a valid req for that machine
+    THEN the change is made from the coins the machine has, and they are taken out of it and the balance
+    """
+    machine_id = 4242
+    for coin, count in [(100, 0), (50, 0), (20, 3), (10, 1), (5, 5)]:
+        db.session.merge(models.CoinInventory(machine_id=machine_id, coin=coin, count=count))
+    db.session.commit()
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=25, seller_id=vendor.id, db=db)
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}', 'X-Machine-Id': str(machine_id)},
+        json={"amount": 1},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 200
+    assert response_object['change'] == [20, 20, 20, 10, 5]
+    assert 'change_counts' not in response_object
+
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 0
+    inventory = {row.coin: row.count for row in models.CoinInventory.query.filter_by(machine_id=machine_id)}
+    assert inventory == {100: 0, 50: 0, 20: 0, 10: 0, 5: 4}
+
+def test_product_purchase_from_machine_zero(app, client, db):
+    """
+    GIVEN a Flask-backed API with a default machine and a machine 0 with a limited coin inventory
+    WHEN the /product/buy/<int:product_id> endpoint gets a valid req for machine 0
+    THEN the change is made from the coins of machine 0 rather than the default machine's
+    """
+    app.config['MACHINE_ID'] = 4242
+    for coin, count in [(100, 0), (50, 0), (20, 0), (10, 0), (5, 20)]:
+        db.session.merge(models.CoinInventory(machine_id=0, coin=coin, count=count))
+    db.session.commit()
+    buyer = UserFactory.create(balance=50, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=25, seller_id=vendor.id, db=db)
+    response = client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}', 'X-Machine-Id': '0'},
+        json={"amount": 1},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 200
+    assert response_object['change'] == [5, 5, 5, 5, 5]
+
+def test_add_product(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product endpoint gets a valid POST req from a vendor
+    THEN the product is created with the vendor as its seller
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    response = client.post(
+        url_for('api.product_add_product'),
+        headers={'Authorization': f'Bearer {vendor.token}'},
+        json={"name": "Chewing Gum", "cost": 15, "amount": 10},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 201
+    assert int(response_object['product']['seller_id']) == vendor.id
+
+def test_add_product_not_vendor(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product endpoint gets a POST req from a buyer
+    THEN the response field 'errors' contains 'NOT_VENDOR' and response code == 403
+    """
+    buyer = UserFactory.create(role='buyer', db=db)
+    response = client.post(
+        url_for('api.product_add_product'),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json={"name": "Chewing Gum", "cost": 15, "amount": 10},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 403
+    assert Errors.NOT_VENDOR in response_object['errors']
+
+def test_add_product_authorised_from_role_claim(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing and a vendor token with the role in its claims
+    WHEN the /product endpoint gets a valid POST req with that token, after the token version of the vendor is cached
+    THEN the product is created without any auth-related SQL
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    token = generate_custom_auth_token(vendor.id, role='vendor')
+    client.post(
+        url_for('api.product_add_product'),
+        headers={'Authorization': f'Bearer {token}'},
+        json={"name": "Bubble Gum", "cost": 15, "amount": 10},
+        follow_redirects=True
+    )
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        response = client.post(
+            url_for('api.product_add_product'),
+            headers={'Authorization': f'Bearer {token}'},
+            json={"name": "Chewing Gum", "cost": 15, "amount": 10},
+            follow_redirects=True
+        )
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    assert response.status_code == 201
+    assert not [statement for statement in statements if 'FROM users' in statement or 'FROM roles' in statement]
+
+def test_add_product_stale_role_claim(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing and a vendor token with the role in its claims
+    WHEN the vendor's token version is bumped (e.g. their role changed) and the old token is used
+    THEN the token is refused
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    token = generate_custom_auth_token(vendor.id, role='vendor')
+    bump_token_version(db.session, vendor.id)
+    db.session.commit()
+    response = client.post(
+        url_for('api.product_add_product'),
+        headers={'Authorization': f'Bearer {token}'},
+        json={"name": "Chewing Gum", "cost": 15, "amount": 10},
+        follow_redirects=True
+    )
+    response_object = json.loads(response.data)
+    assert response.status_code == 403
+    assert Errors.INVALID_TOKEN in response_object['errors']
+
+def test_list_products_keyset_pages(client, db):
+    """
+    GIVEN a vendor with 5 products, 2 of them out of stock
+    WHEN the /product listing is paged through 2 at a time, filtered by seller and stock
+    THEN every matching product is listed once, in id order, and the last page has no next_after
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    products = [
+        ProductFactory.create(amount_available=amount, seller_id=vendor.id, db=db)
+        for amount in [3, 0, 1, 0, 7]
+    ]
+
+    listed = []
+    after = 0
+    while after is not None:
+        response = client.get(
+            url_for('api.product_add_product'),
+            query_string={'seller_id': vendor.id, 'in_stock': 'true', 'limit': 2, 'after': after},
+        )
+        assert response.status_code == 200
+        response_object = json.loads(response.data)
+        listed.extend(response_object['products'])
+        after = response_object['next_after']
+
+    assert [product['id'] for product in listed] == [products[0].id, products[2].id, products[4].id]
+    assert listed[0] == {
+        'id': products[0].id,
+        'product_name': products[0].product_name,
+        'amount_available': 3,
+        'cost': products[0].cost,
+        'seller_id': vendor.id,
+    }
+
+    response = client.get(url_for('api.product_add_product'), query_string={'seller_id': vendor.id, 'in_stock': 'false'})
+    assert [product['id'] for product in json.loads(response.data)['products']] == [products[1].id, products[3].id]
+
+def test_list_products_invalid_params(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product listing is requested with a malformed filter or an out of range page size
+    THEN the response field 'errors' contains 'INVALID_REQUEST' and response code == 400
+    """
+    for query_string in [{'limit': 0}, {'limit': 100000}, {'after': 'x'}, {'in_stock': 'maybe'}]:
+        response = client.get(url_for('api.product_add_product'), query_string=query_string)
+        assert response.status_code == 400
+        assert Errors.INVALID_REQUEST in json.loads(response.data)['errors']
+
+def test_search_products(client, db):
+    """
+    GIVEN products named after a word that no other product has, one of them renamed and one deleted
+    WHEN the /product/search endpoint is queried by the word, one result per page, and by a prefix of it
+    THEN the matching products are returned once each, whole word matches first, without the renamed and deleted ones
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    # Unique per run, the test database outlives a test run
+    word, new_word = (f'zyx{uuid.uuid4().hex[:8]}' for _ in range(2))
+    names = [f'{word} Classic', f'{word} {word} Extra', f'Plain {word}s', f'{word} Light']
+    products = [ProductFactory.create(product_name=name, seller_id=vendor.id, db=db) for name in names]
+    products[0].product_name = f'Renamed {new_word}'
+    db.session.commit()
+    client.delete(
+        url_for('api.product_product_details', product_id=products[3].id),
+        headers={'Authorization': f'Bearer {vendor.token}'},
+    )
+
+    found = []
+    after = None
+    while True:
+        query_string = {'q': word, 'limit': 1}
+        if after:
+            query_string['after'] = after
+        response = client.get(url_for('api.product_search_products'), query_string=query_string)
+        assert response.status_code == 200
+        response_object = json.loads(response.data)
+        found.extend(product['id'] for product in response_object['products'])
+        after = response_object['next_after']
+        if after is None:
+            break
+
+    # The whole word match ranks before the name the word is only a prefix in
+    assert found == [products[1].id, products[2].id]
+
+    response = client.get(url_for('api.product_search_products'), query_string={'q': word[:5]})
+    assert [product['id'] for product in json.loads(response.data)['products']] == [products[1].id, products[2].id]
+
+    response = client.get(url_for('api.product_search_products'), query_string={'q': new_word})
+    assert [product['id'] for product in json.loads(response.data)['products']] == [products[0].id]
+
+    response = client.get(url_for('api.product_search_products'), query_string={'q': word, 'after': 'nonsense'})
+    assert response.status_code == 400
+
+def test_export_products(client, db):
+    """
+    GIVEN a vendor with 3 products and another vendor's product
+    WHEN the vendor exports their products as NDJSON and as CSV
+    THEN both list exactly the vendor's products in id order
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    other_vendor = UserFactory.create(role='vendor', db=db)
+    products = [ProductFactory.create(product_name=f'Export {i}', seller_id=vendor.id, db=db) for i in range(3)]
+    ProductFactory.create(seller_id=other_vendor.id, db=db)
+
+    response = client.get(url_for('api.product_export_products'), headers={'Authorization': f'Bearer {vendor.token}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert lines == [
+        {
+            'id': product.id,
+            'product_name': product.product_name,
+            'amount_available': product.amount_available,
+            'cost': product.cost,
+            'seller_id': vendor.id,
+        }
+        for product in products
+    ]
+
+    response = client.get(
+        url_for('api.product_export_products'),
+        query_string={'format': 'csv'},
+        headers={'Authorization': f'Bearer {vendor.token}'},
+    )
+    assert response.mimetype == 'text/csv'
+    assert response.data.decode().splitlines() == ['id,product_name,amount_available,cost,seller_id'] + [
+        f'{product.id},{product.product_name},{product.amount_available},{product.cost},{vendor.id}'
+        for product in products
+    ]
+
+def test_export_sales(client, db):
+    """
+    GIVEN a purchase of a vendor's product, with the ledger flushed
+    WHEN the vendor exports their sales
+    THEN the purchase is in the export, with its kind spelled out
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    buyer = UserFactory.create(role='buyer', balance=100, db=db)
+    product = ProductFactory.create(cost=25, seller_id=vendor.id, db=db)
+    client.post(
+        url_for('api.product_buy_product', product_id=product.id),
+        headers={'Authorization': f'Bearer {buyer.token}'},
+        json={"amount": 2},
+    )
+    ledger_writer.flush()
+
+    response = client.get(url_for('api.product_export_sales'), headers={'Authorization': f'Bearer {vendor.token}'})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [(line['kind'], line['buyer_id'], line['product_id'], line['amount'], line['total']) for line in lines] == [
+        ('PURCHASE', buyer.id, product.id, 2, 50)
+    ]
+
+def test_bulk_upsert_products(client, db):
+    """
+    GIVEN a vendor with a product, and another vendor's product
+    WHEN the vendor bulk upserts new products, an update of each of the two, an unknown id and invalid items
+    THEN valid items are written in one go and every item gets its own status, in order
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    other_vendor = UserFactory.create(role='vendor', db=db)
+    own_product = ProductFactory.create(product_name='Own product', cost=10, seller_id=vendor.id, db=db)
+    other_product = ProductFactory.create(product_name='Other product', seller_id=other_vendor.id, db=db)
+
+    response = client.post(
+        url_for('api.product_bulk_upsert_products'),
+        headers={'Authorization': f'Bearer {vendor.token}'},
+        json={"products": [
+            {"name": "Bulk product 1", "cost": 15, "amount": 10},
+            {"id": own_product.id, "cost": 20},
+            {"name": "abc", "cost": 15},
+            {"id": other_product.id, "amount": 0},
+            {"name": "Bulk product 2", "cost": "25", "amount": 1},
+            {"id": 10 ** 9, "cost": 5},
+            {"name": "Bulk product 3", "cost": "a lot"},
+            "not a product",
+        ]},
+    )
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+
+    assert [result['status'] for result in results] == [201, 200, 400, 403, 201, 404, 400, 400]
+    assert results[2]['form_errors'] == {'name': [Errors.INVALID_LENGTH]}
+    assert results[3]['errors'] == [Errors.ACCESS_DENIED]
+    assert results[5]['errors'] == [Errors.WRONG_PRODUCT_ID]
+    assert list(results[6]['form_errors']) == ['cost']
+
+    created = [db.session.get(models.Product, results[index]['id']) for index in (0, 4)]
+    assert [(product.product_name, product.cost, product.amount_available, product.seller_id) for product in created] == [
+        ('Bulk product 1', 15, 10, vendor.id),
+        ('Bulk product 2', 25, 1, vendor.id),
+    ]
+    db.session.refresh(own_product)
+    db.session.refresh(other_product)
+    assert (own_product.product_name, own_product.cost) == ('Own product', 20)
+    assert other_product.amount_available != 0
+
+def test_bulk_upsert_products_null_id(client, db):
+    """
+    GIVEN a vendor
+    WHEN the vendor bulk upserts items with a null id
+    THEN they are validated as new products, and one without a name is refused
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+
+    response = client.post(
+        url_for('api.product_bulk_upsert_products'),
+        headers={'Authorization': f'Bearer {vendor.token}'},
+        json={"products": [{"id": None}, {"id": None, "name": "Null id product", "cost": 5, "amount": 1}]},
+    )
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+
+    assert [result['status'] for result in results] == [400, 201]
+    assert 'name' in results[0]['form_errors']
+    assert models.Product.query.filter_by(seller_id=vendor.id).count() == 1
+
+def test_bulk_upsert_products_same_id(client, db):
+    """
+    GIVEN a vendor with a product
+    WHEN the vendor bulk upserts two updates of it in different columns
+    THEN both are applied in item order, the later one winning in the column they share
+    """
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(product_name='Own product', cost=10, amount_available=1, seller_id=vendor.id, db=db)
+
+    response = client.post(
+        url_for('api.product_bulk_upsert_products'),
+        headers={'Authorization': f'Bearer {vendor.token}'},
+        json={"products": [
+            {"id": product.id, "name": "First", "cost": 10},
+            {"id": product.id, "cost": 99},
+            {"id": product.id, "amount": 3},
+        ]},
+    )
+    assert response.status_code == 200
+    assert [result['status'] for result in json.loads(response.data)['results']] == [200, 200, 200]
+
+    db.session.refresh(product)
+    assert (product.product_name, product.cost, product.amount_available) == ('First', 99, 3)
+
+def test_product_purchase_idempotency_key(client, db):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the /product/buy/<int:product_id> endpoint gets the same POST request twice with the same Idempotency-Key
+    THEN the buyer is charged and the stock taken once, and the retry gets the stored response back
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(balance=0, role='vendor', db=db)
+    product = ProductFactory.create(cost=25, amount_available=5, seller_id=vendor.id, db=db)
+    headers = {'Authorization': f'Bearer {buyer.token}', 'Idempotency-Key': 'buy-retry-test'}
+
+    first = client.post(url_for('api.product_buy_product', product_id=product.id), headers=headers, json={"amount": 1})
+    retry = client.post(url_for('api.product_buy_product', product_id=product.id), headers=headers, json={"amount": 1})
+
+    assert first.status_code == retry.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    assert json.loads(retry.data) == json.loads(first.data)
+    db.session.expire_all()
+    assert models.User.query.get(buyer.id).balance == 75
+    assert models.User.query.get(vendor.id).balance == 25
+    assert models.Product.query.get(product.id).amount_available == 4
+
+def test_product_purchase_idempotency_key_per_format(client, db):
+    """
+    GIVEN a purchase made with an Idempotency-Key
+    WHEN the same key is sent with ?change_format=compact, then retried
+    THEN it is a request of its own, and its retry replays the compact response rather than the first one
+    """
+    buyer = UserFactory.create(balance=100, role='buyer', db=db)
+    vendor = UserFactory.create(role='vendor', db=db)
+    product = ProductFactory.create(cost=25, amount_available=5, seller_id=vendor.id, db=db)
+    headers = {'Authorization': f'Bearer {buyer.token}', 'Idempotency-Key': 'buy-format-test'}
+
+    legacy = client.post(url_for('api.product_buy_product', product_id=product.id), headers=headers, json={"amount": 1})
+    compact_url = url_for('api.product_buy_product', product_id=product.id, change_format='compact')
+    compact = client.post(compact_url, headers=headers, json={"amount": 1})
+    retry = client.post(compact_url, headers=headers, json={"amount": 1})
+
+    assert json.loads(legacy.data)['change'] == [50, 20, 5]
+    assert 'Idempotent-Replayed' not in compact.headers
+    assert json.loads(compact.data)['change_counts'] == {"50": 1}
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    assert json.loads(retry.data) == json.loads(compact.data)
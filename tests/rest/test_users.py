@@ -1,9 +1,11 @@
 # pylint: disable=line-too-long
 import json
+import pytest
 from flask import url_for
 from sqlalchemy import func
 
-from app import errors, models
+from app import errors, models, idempotency
+from app.ledger import ledger_writer
 
 def test_user_registration_valid(client, seed_database):
     """
@@ -231,3 +233,66 @@ def test_user_deposit_invalid_amount(client, seed_database):
     )
     response_object = json.loads(response.data)
     assert errors.Errors.INVALID_AMOUNT in response_object['errors']
+
+def test_user_deposit_idempotency_key(client, seed_database):
+    """
+    GIVEN a Flask-backed API configured for testing
+    WHEN the '/user/deposit/<int:amount>' URL gets the same POST request twice with the same Idempotency-Key
+    THEN the deposit happens once and the retry gets the stored response back
+    """
+    buyer = models.User.query.filter(func.lower(models.User.username) == 'mrbuyer').first()
+    headers = {'Authorization': f'Bearer {buyer.token}', 'Idempotency-Key': 'deposit-retry-test'}
+
+    first = client.post(url_for('api.user_deposit', amount=20), headers=headers, follow_redirects=True)
+    retry = client.post(url_for('api.user_deposit', amount=20), headers=headers, follow_redirects=True)
+
+    assert json.loads(first.data)['total_balance'] == 20
+    assert json.loads(retry.data) == json.loads(first.data)
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    assert models.User.query.get(buyer.id).balance == 20
+
+
+def test_user_deposit_idempotency_key_in_progress(client, seed_database):
+    """
+    GIVEN a deposit whose Idempotency-Key is reserved by a request still running
+    WHEN a retry with the same key comes in
+    THEN it gets a 409 and the deposit isn't repeated
+    """
+    buyer = models.User.query.filter(func.lower(models.User.username) == 'mrbuyer').first()
+    headers = {'Authorization': f'Bearer {buyer.token}', 'Idempotency-Key': 'deposit-in-progress-test'}
+    path = url_for('api.user_deposit', amount=20)
+    assert idempotency.reserve_key(idempotency.make_key(buyer.id, path, 'deposit-in-progress-test'), 60)
+
+    retry = client.post(path, headers=headers, follow_redirects=True)
+
+    assert retry.status_code == 409
+    assert errors.Errors.REQUEST_IN_PROGRESS in json.loads(retry.data)['errors']
+    assert models.User.query.get(buyer.id).balance == 0
+
+
+def test_user_deposit_idempotency_key_store_fails(client, seed_database, monkeypatch):
+    """
+    GIVEN a deposit with an Idempotency-Key whose response can't be stored
+    WHEN it fails, and is retried once storing works again
+    THEN the failed attempt leaves neither the deposit nor a ledger entry, the retry records one of each
+    """
+    buyer = models.User.query.filter(func.lower(models.User.username) == 'mrbuyer').first()
+    headers = {'Authorization': f'Bearer {buyer.token}', 'Idempotency-Key': 'deposit-store-fails-test'}
+    # Rows other tests left in the buffer
+    ledger_writer.flush()
+    last_entry_id = models.LedgerEntry.query.with_entities(func.max(models.LedgerEntry.id)).scalar() or 0
+
+    def failing_store_response(key, status_code, data):
+        raise RuntimeError('Storing the response failed')
+    with monkeypatch.context() as patch:
+        patch.setattr(idempotency, 'store_response', failing_store_response)
+        with pytest.raises(RuntimeError):
+            client.post(url_for('api.user_deposit', amount=20), headers=headers, follow_redirects=True)
+    assert ledger_writer.pending() == 0
+    assert models.User.query.get(buyer.id).balance == 0
+
+    retry = client.post(url_for('api.user_deposit', amount=20), headers=headers, follow_redirects=True)
+    assert json.loads(retry.data)['total_balance'] == 20
+    assert ledger_writer.flush() == 1
+    entries = models.LedgerEntry.query.filter(models.LedgerEntry.id > last_entry_id).all()
+    assert [(entry.buyer_id, entry.kind, entry.total) for entry in entries] == [(buyer.id, models.LedgerKind.DEPOSIT, 20)]
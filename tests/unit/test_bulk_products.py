@@ -0,0 +1,46 @@
+from app.rest.products import AddProductForm, validate_bulk_product
+from app.rest.utils import make_form_errors
+
+ITEMS = [
+    {"name": "Cola", "cost": 25, "amount": 10},
+    {"name": "Chocolate bar", "cost": None},
+    {"name": "x" * 25},
+    {"name": "x" * 26, "cost": 5},
+    {"name": "abc"},
+    {"name": "", "cost": 5},
+    {"name": None},
+    {"name": 12345},
+    {"cost": 5, "amount": 1},
+    {"name": "Cola", "cost": "25", "amount": "1"},
+    {"name": "Cola", "cost": 2.5},
+    {"name": "Cola", "amount": True},
+    {"name": "Cola", "cost": "free"},
+    {"id": None},
+    {"id": None, "name": "Cola", "cost": 25},
+]
+
+
+def test_validate_bulk_product_matches_form(app):
+    """
+    GIVEN items of a bulk product upsert, well-formed or not
+    WHEN they are validated for the bulk upsert
+    THEN the outcome is the same as validating each with AddProductForm
+    """
+    for item in ITEMS:
+        form = AddProductForm.from_json(item)
+        if form.validate():
+            expected = ({'product_name': form.data['name'], 'cost': form.data['cost'], 'amount_available': form.data['amount']}, None)
+        else:
+            expected = (None, make_form_errors(form.errors))
+        assert validate_bulk_product(item) == expected, item
+
+
+def test_validate_bulk_product_update(app):
+    """
+    GIVEN items of a bulk product upsert that update an existing product
+    WHEN they are validated for the bulk upsert
+    THEN only the fields they have are validated and written
+    """
+    assert validate_bulk_product({"id": 1, "cost": 30}) == ({'cost': 30}, None)
+    assert validate_bulk_product({"id": 1, "amount": "7"}) == ({'amount_available': 7}, None)
+    assert validate_bulk_product({"id": 1, "name": "abc"}) == (None, {'name': ['INVALID_LENGTH']})
@@ -0,0 +1,70 @@
+from app.coins import solve_change, inventory_signature
+from app.rest.utils import ChangeMaker, build_change
+
+COIN_VALUES = [20, 5, 10, 50, 100]
+
+
+def test_make_change_counts():
+    """
+    GIVEN a ChangeMaker built from the vending machine coins
+    WHEN change is made for a large balance
+    THEN it is returned as {coin: count}, largest coin first, without one element per dollar
+    """
+    change_maker = ChangeMaker(COIN_VALUES)
+
+    assert change_maker.make_change(100500) == {100: 1005}
+    assert change_maker.make_change(100575) == {100: 1005, 50: 1, 20: 1, 5: 1}
+    assert list(change_maker.make_change(195)) == [100, 50, 20, 5]
+    assert change_maker.make_change(0) == {}
+
+
+def test_build_change_matches_greedy():
+    """
+    GIVEN a ChangeMaker built from the vending machine coins
+    WHEN the legacy flat list is built for every amount up to 10 dollars
+    THEN it is the same list the greedy largest-coin-first algorithm gives
+    """
+    change_maker = ChangeMaker(COIN_VALUES)
+    for amount in range(0, 1001, 5):
+        expected = []
+        left = amount
+        for coin in sorted(COIN_VALUES, reverse=True):
+            expected.extend([coin] * (left // coin))
+            left %= coin
+        assert build_change(amount, change_maker) == expected
+
+
+def test_make_change_unreachable_remainder():
+    """
+    GIVEN a ChangeMaker built from the vending machine coins
+    WHEN the amount is not a multiple of the smallest coin
+    THEN as much of it as possible is returned
+    """
+    change_maker = ChangeMaker(COIN_VALUES)
+
+    assert change_maker.make_change(3) == {}
+    assert change_maker.make_change(128) == {100: 1, 20: 1, 5: 1}
+
+
+def test_solve_change_respects_inventory():
+    """
+    GIVEN a machine that has run out of some coins
+    WHEN change is solved from its inventory
+    THEN the fewest coins it actually has are used, even where largest coin first would get stuck
+    """
+    inventory = inventory_signature([(100, 0), (50, 1), (20, 3), (10, 0), (5, 0)])
+
+    assert solve_change(60, inventory) == (((20, 3),), 0)
+    assert solve_change(110, inventory) == (((50, 1), (20, 3)), 0)
+
+
+def test_solve_change_shortfall():
+    """
+    GIVEN a machine without enough coins for exact change
+    WHEN change is solved from its inventory
+    THEN as much as possible is given and the rest is reported as shortfall
+    """
+    inventory = inventory_signature([(50, 1), (20, 1)])
+
+    assert solve_change(95, inventory) == (((50, 1), (20, 1)), 25)
+    assert solve_change(95, ()) == ((), 95)
@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import create_engine, func, insert, select, text
+
+from database import db
+from app.datagen import generate
+from app.models import LedgerEntry, LedgerKind, Product, User
+
+
+def make_dataset(seed, **counts):
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    generate(engine, seed=seed, batch_size=40, **counts)
+    return engine
+
+
+def dump(engine):
+    with engine.connect() as connection:
+        return [
+            # Everything but the password, which is salted anew by every run
+            connection.execute(select(*(column for column in table.c if column.name != 'password')).order_by(table.c.id)).all()
+            for table in (User.__table__, Product.__table__, LedgerEntry.__table__)
+        ]
+
+
+def test_generate():
+    """
+    GIVEN an empty database
+    WHEN a dataset is generated into it
+    THEN it has the rows asked for, consistent with each other and indexed for search
+    """
+    engine = make_dataset(1, users=100, products=150, ledger=500)
+    with engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(User)).scalar() == 100
+        assert connection.execute(select(func.count()).select_from(Product)).scalar() == 150
+        assert connection.execute(select(func.count()).select_from(LedgerEntry)).scalar() == 500
+        # One hash for everyone
+        assert connection.execute(select(func.count(User.password.distinct()))).scalar() == 1
+        # Products are sold by vendors, at their cost
+        assert not connection.execute(
+            select(LedgerEntry.id).join(Product, Product.id == LedgerEntry.product_id).where(
+                LedgerEntry.kind == LedgerKind.PURCHASE,
+                (LedgerEntry.seller_id != Product.seller_id) | (LedgerEntry.total != Product.cost * LedgerEntry.amount),
+            )
+        ).all()
+        indexed = connection.execute(text("SELECT count(*) FROM products_fts WHERE products_fts MATCH 'espresso'")).scalar()
+        named = connection.execute(select(func.count()).where(Product.product_name.like('%espresso%'))).scalar()
+        assert indexed == named > 0
+
+
+def test_generate_deterministic():
+    """
+    GIVEN two empty databases
+    WHEN datasets are generated into both
+    THEN they are the same with the same seed and different otherwise
+    """
+    counts = {'users': 30, 'products': 50, 'ledger': 100}
+    assert dump(make_dataset(7, **counts)) == dump(make_dataset(7, **counts))
+    assert dump(make_dataset(7, **counts)) != dump(make_dataset(8, **counts))
+
+
+def test_generate_appends():
+    """
+    GIVEN a database with a generated dataset
+    WHEN another one is generated into it
+    THEN its rows are added after the ones there
+    """
+    engine = make_dataset(1, users=20, products=10, ledger=10)
+    generate(engine, users=20, products=10, ledger=10, seed=1)
+    users, products, ledger = dump(engine)
+    assert (len(users), len(products), len(ledger)) == (40, 20, 20)
+
+
+def test_generate_invalid():
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    with pytest.raises(ValueError):
+        generate(engine, users=0, products=10, ledger=0)
+    with pytest.raises(ValueError):
+        generate(engine, users=10, products=10, ledger=10, popularity='pareto')
+    with engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(User)).scalar() == 0
+
+
+def test_generate_username_taken():
+    """
+    GIVEN a database where someone signed up as GEN2
+    WHEN a dataset whose users would include gen2 is generated into it
+    THEN it is refused before anything is written
+    """
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User.__table__), {'id': 1, 'username': 'GEN2', 'password': '', 'balance': 0})
+    with pytest.raises(ValueError, match='GEN2'):
+        generate(engine, users=10, products=0, ledger=0)
+    with engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(User)).scalar() == 1
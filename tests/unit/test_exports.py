@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+
+from app import models
+from app.exports import EXPORTS, iter_batches
+from tests.utils import UserFactory
+
+
+def test_iter_batches(client, db):
+    """
+    GIVEN a table with more rows than fit in a batch
+    WHEN it is read for an export
+    THEN the rows come in batches of at most the batch size, all of them in order
+    """
+    for _ in range(5):
+        UserFactory.create(db=db)
+
+    batches = list(iter_batches(EXPORTS['users'], batch_size=2))
+    ids = [row.id for batch in batches for row in batch]
+
+    assert all(len(batch) <= 2 for batch in batches)
+    assert ids == sorted(ids)
+    assert len(ids) == models.User.query.count()
+
+
+def test_export_command(app, db):
+    """
+    GIVEN users in the database
+    WHEN `flask export users` is run in each format
+    THEN every user is written out, with the title of their role
+    """
+    user = UserFactory.create(role='vendor', db=db)
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['export', 'users'])
+    users = [json.loads(line) for line in result.output.splitlines()]
+    assert {'id': user.id, 'username': user.username, 'role': 'vendor', 'balance': int(user.balance)} in users
+
+    result = runner.invoke(args=['export', 'users', '--format', 'csv'])
+    rows = list(csv.DictReader(io.StringIO(result.output)))
+    assert len(rows) == len(users)
+    assert {'id': str(user.id), 'username': user.username, 'role': 'vendor', 'balance': str(user.balance)} in rows
+
+    result = runner.invoke(args=['export', 'users', '--seller-id', '1'])
+    assert result.exit_code != 0
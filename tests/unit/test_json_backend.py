@@ -0,0 +1,101 @@
+import json
+import logging
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+from app import json_backend
+from app.json_backend import JSON_BACKENDS, OrjsonProvider
+
+# orjson is an optional extra (fast-json)
+requires_orjson = pytest.mark.skipif(json_backend.orjson is None, reason='orjson is not installed')
+
+
+PAYLOAD = {
+    "product": {"id": "1", "product_name": "Cola ü", "amount_available": "3", "cost": "65", "seller_id": "2"},
+    "change": [50, 10, 5],
+    "change_counts": {50: 1, 10: 1, 5: 1},
+    "errors": None,
+}
+
+
+@pytest.mark.parametrize('backend', [
+    pytest.param(backend, marks=requires_orjson) if backend == 'orjson' else backend for backend in JSON_BACKENDS
+])
+def test_json_backends_round_trip(app, backend):
+    """
+    GIVEN each configurable JSON backend
+    WHEN a response payload is encoded and decoded again
+    THEN it decodes the same as with the stdlib json module, non-string keys included
+    """
+    provider = JSON_BACKENDS[backend](app)
+    dumped = provider.dumps(PAYLOAD)
+
+    assert provider.loads(dumped) == json.loads(json.dumps(PAYLOAD))
+    assert provider.loads(dumped.encode()) == json.loads(json.dumps(PAYLOAD))
+
+
+@requires_orjson
+def test_json_backend_from_config(app):
+    """
+    GIVEN the JSON_BACKEND setting
+    WHEN the app's JSON backend is installed from it
+    THEN app.json is the matching provider, and unknown backends are refused
+    """
+    app.config['JSON_BACKEND'] = 'json'
+    json_backend.init_app(app)
+    assert type(app.json) is JSON_BACKENDS['json']  # pylint: disable=unidiomatic-typecheck
+
+    app.config['JSON_BACKEND'] = 'orjson'
+    json_backend.init_app(app)
+    assert isinstance(app.json, OrjsonProvider)
+
+    app.config['JSON_BACKEND'] = 'yaml'
+    with pytest.raises(ValueError):
+        json_backend.init_app(app)
+
+
+def test_json_backend_without_orjson(app, monkeypatch, caplog):
+    """
+    GIVEN the orjson backend configured where orjson isn't installed
+    WHEN the app's JSON backend is installed
+    THEN it falls back to the stdlib json provider with a warning
+    """
+    monkeypatch.setattr(json_backend, 'orjson', None)
+    app.config['JSON_BACKEND'] = 'orjson'
+    with caplog.at_level(logging.WARNING):
+        json_backend.init_app(app)
+
+    assert type(app.json) is DefaultJSONProvider  # pylint: disable=unidiomatic-typecheck
+    assert 'orjson' in caplog.text
+
+
+@requires_orjson
+def test_output_json_uses_backend(app):
+    """
+    GIVEN the orjson backend installed on the app
+    WHEN a flask_restx response is encoded
+    THEN the body is orjson's compact encoding with keys in marshalling order
+    """
+    app.config['JSON_BACKEND'] = 'orjson'
+    json_backend.init_app(app)
+    with app.test_request_context():
+        response = json_backend.output_json({"b": 1, "a": "ü"}, 201, {'X-Test': 'yes'})
+
+    assert response.status_code == 201
+    assert response.headers['X-Test'] == 'yes'
+    assert response.get_data() == '{"b":1,"a":"ü"}\n'.encode()
+
+
+def test_malformed_json_body(app, client):
+    """
+    GIVEN the orjson backend parsing request bodies
+    WHEN a request with a malformed JSON body is sent
+    THEN it is answered with 400 Bad Request as with the stdlib json module
+    """
+    app.config['JSON_BACKEND'] = 'orjson'
+    json_backend.init_app(app)
+    response = client.post('/api/user/login', data='{"username": ', content_type='application/json')
+
+    assert response.status_code == 400
+
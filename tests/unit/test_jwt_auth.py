@@ -0,0 +1,58 @@
+from sqlalchemy import delete
+
+from app.auth import jwt_auth
+from app.models import User
+from tests.utils import UserFactory
+
+
+def test_verified_token_cache_hits():
+    """
+    GIVEN a freshly generated token
+    WHEN it is decoded twice
+    THEN the second decode is served from the verified token cache
+    """
+    token = jwt_auth.generate_custom_auth_token(424242)
+    jwt_auth.token_cache.clear()
+
+    assert jwt_auth.decode_custom_auth_token(token)['user_id'] == 424242
+    assert jwt_auth.decode_custom_auth_token(token)['user_id'] == 424242
+    assert jwt_auth.token_cache.stats()['misses'] == 1
+    assert jwt_auth.token_cache.stats()['hits'] == 1
+
+
+def test_verified_token_cache_invalidate_user():
+    """
+    GIVEN a cached token
+    WHEN the cache entries of its user are invalidated
+    THEN the next decode verifies the token again
+    """
+    token = jwt_auth.generate_custom_auth_token(424243)
+    jwt_auth.token_cache.clear()
+    jwt_auth.decode_custom_auth_token(token)
+
+    jwt_auth.token_cache.invalidate_user(424243)
+
+    assert jwt_auth.decode_custom_auth_token(token)['user_id'] == 424243
+    assert jwt_auth.token_cache.stats()['misses'] == 2
+
+
+def test_token_version_persisted(db):
+    """
+    GIVEN a token of a user
+    WHEN the user's token version is bumped, or the user is deleted, in the database
+    THEN the token is refused once the cached version expires, as it would be by any other worker
+    """
+    user = UserFactory.create(db=db)
+    token = jwt_auth.generate_custom_auth_token(user.id)
+    assert jwt_auth.get_user_id_from_custom_token(token) == user.id
+
+    jwt_auth.bump_token_version(db.session, user.id)
+    db.session.commit()
+    assert jwt_auth.get_user_id_from_custom_token(token) is None
+    new_token = jwt_auth.generate_custom_auth_token(user.id, token_version=1)
+    assert jwt_auth.get_user_id_from_custom_token(new_token) == user.id
+
+    db.session.execute(delete(User).where(User.id == user.id))
+    db.session.commit()
+    jwt_auth.token_versions.clear()
+    assert jwt_auth.get_user_id_from_custom_token(new_token) is None
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+from flask_restx import fields, marshal, Model
+from flask_restx.fields import MarshallingError
+
+from app import models
+from app.rest.marshalling import compile_model
+from app.rest.products import (
+    buy_response_model, buy_compact_response_model, cart_response_model, product_details_model,
+)
+from app.rest.users import sign_up_response_model, login_response_model
+from app.rest.rest_models import user_model_private
+
+
+def _same(model, data, skip_none=False):
+    expected = marshal(data, model, skip_none=skip_none)
+    assert json.dumps(compile_model(model, skip_none)(data)) == json.dumps(expected)
+
+
+def test_compiled_response_models_match_marshal(client, db):
+    """
+    GIVEN the compiled response models of the product and user endpoints
+    WHEN they serialize ORM objects, dicts, missing values and lists
+    THEN the JSON is byte for byte what flask_restx's marshal gives
+    """
+    product = models.Product(id=1, product_name='Cola', amount_available=3, cost=65, seller_id=2)
+    user = models.User(id=3, username='buyer', password='hash', balance=100, role_id=None)
+
+    _same(buy_response_model, {
+        'product': product, 'amount_purchased': '2', 'transaction_amount': 130,
+        'change': [20, 20, 5], 'errors': [], 'form_errors': None,
+    })
+    _same(buy_compact_response_model, {'change_counts': {'20': 2}, 'change': None, 'product': None})
+    _same(buy_response_model, {'form_errors': {'amount': ['Not a valid integer']}})
+    _same(cart_response_model, {
+        'products': [product, None, {'id': 2, 'cost': 5}], 'items': [{'product_id': 1, 'amount': 2}],
+        'transaction_amount': 130, 'change': (50, 5),
+    })
+    _same(product_details_model, {'product': product})
+    _same(sign_up_response_model, {'user': user, 'token': 'abc'})
+    _same(login_response_model, {'errors': ['Wrong password']})
+    _same(user_model_private, [user, user])
+    _same(user_model_private, {'id': 1}, skip_none=True)
+
+
+def test_compiled_marshaller_falls_back_to_marshal():
+    """
+    GIVEN models using fields the compiler leaves to flask_restx
+    WHEN they serialize data, or data a field can't format
+    THEN the result, or the error, is the same as marshal's
+    """
+    model = Model('Fallback', {
+        'total': fields.Integer,
+        'price': fields.Float(attribute='cost'),
+        'name': fields.String(attribute='product.name', default='n/a'),
+        'tags': fields.List(fields.String),
+        'nested': {'flag': fields.Boolean(attribute='active')},
+    })
+    _same(model, {'total': '7', 'cost': '1.5', 'product': {'name': 'x'}, 'tags': ['a', 1], 'active': 1})
+    _same(model, {'tags': None, 'product': None})
+
+    with pytest.raises(MarshallingError):
+        compile_model(model)({'total': 'seven'})
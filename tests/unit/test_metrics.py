@@ -0,0 +1,98 @@
+import re
+import threading
+
+from flask import Response, url_for
+
+from app.metrics import RequestMetrics, request_metrics
+from tests.utils import ProductFactory, UserFactory
+
+
+def test_counters_merged_across_threads(app):
+    """
+    GIVEN requests recorded by several threads at once
+    WHEN the counters are scraped
+    THEN every thread's requests are added up per endpoint
+    """
+    metrics = RequestMetrics(buckets=(0.1, 1.0))
+    metrics.enabled = True
+
+    def record(times):
+        for _ in range(times):
+            with app.test_request_context('/api/product/1'):
+                metrics.start_request()
+                metrics._before_cursor_execute(None, None, 'SELECT 1', None, None, False)
+                metrics._after_cursor_execute(None, None, 'SELECT 1', None, None, False)
+                metrics.end_request(Response(status=200))
+
+    threads = [threading.Thread(target=record, args=(100,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [(key, series)] = metrics.snapshot().items()
+    assert key == ('api.product_product_details', 'GET', 200)
+    requests, seconds, statements, sql_seconds, buckets = series
+    assert (requests, statements, sum(buckets)) == (400, 400, 400)
+    assert 0 < sql_seconds < seconds
+
+
+def test_counters_of_ended_threads_retired(app):
+    """
+    GIVEN requests recorded by a thread each, as a thread-per-request server does
+    WHEN the counters are scraped after the threads have ended
+    THEN their requests are still counted but their counters are no longer kept per thread
+    """
+    metrics = RequestMetrics()
+    metrics.enabled = True
+
+    def record():
+        with app.test_request_context('/api/product/1'):
+            metrics.start_request()
+            metrics.end_request(Response(status=200))
+
+    for _ in range(50):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+
+    [series] = metrics.snapshot().values()
+    assert series[0] == 50
+    assert metrics._threads == []
+    [series] = metrics.snapshot().values()
+    assert series[0] == 50
+
+
+def test_statements_outside_requests_not_counted(app):
+    metrics = RequestMetrics()
+    metrics.enabled = True
+    metrics._before_cursor_execute(None, None, 'SELECT 1', None, None, False)
+    metrics._after_cursor_execute(None, None, 'SELECT 1', None, None, False)
+    with app.test_request_context('/api/product/1'):
+        metrics.start_request()
+        metrics.end_request(Response(status=404))
+    [series] = metrics.snapshot().values()
+    assert series[2] == 0
+
+
+def test_metrics_endpoint(client, db):
+    """
+    GIVEN requests made to the API
+    WHEN /api/metrics is scraped
+    THEN it has their latency histogram and SQL counters in the Prometheus format
+    """
+    request_metrics.reset()
+    vendor = UserFactory.create(role='vendor', db=db)
+    ProductFactory.create(seller_id=vendor.id, db=db)
+    for _ in range(3):
+        client.get(url_for('api.product_add_product'))
+
+    response = client.get(url_for('api.metrics'))
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    labels = 'endpoint="api.product_add_product",method="GET",status="200"'
+    assert f'api_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3\n' in text
+    assert f'api_request_duration_seconds_count{{{labels}}} 3\n' in text
+    statements = re.search(rf'api_request_sql_statements_total{{{labels}}} (\d+)', text)
+    assert int(statements.group(1)) >= 3
@@ -0,0 +1,77 @@
+import os
+import pstats
+import time
+
+import pytest
+
+from app import create_app, profiling
+from config import Config
+
+
+@pytest.fixture
+def profiled_app(tmp_path):
+    class ProfiledConfig(Config):
+        PROFILER_ENABLED = True
+        PROFILER_DIR = str(tmp_path)
+        PROFILER_KEEP = 3
+    return create_app(ProfiledConfig)
+
+
+def test_verify_header():
+    header = profiling.make_header('secret', 'sampling')
+    assert profiling.verify_header('secret', header) == 'sampling'
+    assert profiling.verify_header('other secret', header) is None
+    assert profiling.verify_header('secret', header.replace('sampling', 'deterministic')) is None
+    assert profiling.verify_header('secret', profiling.make_header('secret', ttl=-1)) is None
+    assert profiling.verify_header('secret', 'deterministic:soon:abc') is None
+    assert profiling.verify_header('secret', '') is None
+    expires = int(time.time()) + 300
+    assert profiling.verify_header('secret', f'sampling:{expires}:\u00e9') is None
+
+
+@pytest.mark.parametrize('mode', profiling.PROFILE_MODES)
+def test_profiled_request(profiled_app, tmp_path, mode):
+    """
+    GIVEN an app with the profiler enabled
+    WHEN a request comes with a signed X-Profile header
+    THEN the response is as usual plus the hotspots, and the stats are dumped
+    """
+    client = profiled_app.test_client()
+    header = profiling.make_header(profiled_app.config['SECRET_KEY'], mode)
+    response = client.get('/api/product', headers={profiling.PROFILE_HEADER: header})
+
+    assert response.status_code == 200
+    assert 'products' in response.get_json()
+    assert response.headers[profiling.SUMMARY_HEADER] is not None
+    filename = response.headers[profiling.FILE_HEADER]
+    assert os.listdir(tmp_path) == [filename]
+    if mode == 'deterministic':
+        assert len(response.headers[profiling.SUMMARY_HEADER].split('; ')) == 5
+        assert pstats.Stats(str(tmp_path / filename)).total_calls > 0
+
+
+def test_unprofiled_requests(profiled_app, tmp_path):
+    """
+    GIVEN an app with the profiler enabled
+    WHEN requests come without an X-Profile header, with one not signed by the app or a malformed one
+    THEN they are neither profiled nor told about the profiler
+    """
+    client = profiled_app.test_client()
+    forged = profiling.make_header('not the secret key')
+    malformed = f'sampling:{int(time.time()) + 300}:\u00e9'
+    for headers in ({}, {profiling.PROFILE_HEADER: forged}, {profiling.PROFILE_HEADER: malformed}):
+        response = client.get('/api/product', headers=headers)
+        assert response.status_code == 200
+        assert profiling.SUMMARY_HEADER not in response.headers
+    assert os.listdir(tmp_path) == []
+
+
+def test_profiles_rotated(profiled_app, tmp_path):
+    client = profiled_app.test_client()
+    header = profiling.make_header(profiled_app.config['SECRET_KEY'])
+    filenames = []
+    for _ in range(5):
+        filenames.append(client.get('/api/product', headers={profiling.PROFILE_HEADER: header}).headers[profiling.FILE_HEADER])
+        # Distinct modification times on coarse filesystem clocks
+        time.sleep(0.01)
+    assert sorted(os.listdir(tmp_path)) == sorted(filenames[-3:])
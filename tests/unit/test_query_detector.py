@@ -0,0 +1,62 @@
+from sqlalchemy import select, text
+
+from app.models import User
+from app.query_detector import QueryDetector, fingerprint
+
+
+def test_fingerprint():
+    """
+    GIVEN statements differing only in their literals or the length of a parameter list
+    WHEN they are fingerprinted
+    THEN they get the same fingerprint, which statements differing otherwise don't
+    """
+    assert fingerprint("SELECT * FROM users WHERE id = 1 AND username = 'a'") == \
+        fingerprint("select *  from users\nwhere id = 22 and username = 'it''s'")
+    assert fingerprint('SELECT * FROM users WHERE id IN (?, ?)') == fingerprint('SELECT * FROM users WHERE id IN (?,?,?,?)')
+    assert fingerprint('INSERT INTO t (a, b) VALUES (?, ?), (?, ?)') == fingerprint('INSERT INTO t (a, b) VALUES (?, ?)')
+    assert fingerprint('SELECT * FROM users WHERE id = ?') != fingerprint('SELECT * FROM products WHERE id = ?')
+    # Digits in names are not literals
+    assert fingerprint('SELECT ix_2.a FROM t2') == 'select ix_2.a from t2'
+
+
+def test_detector_flags_repeated_statements(app, db):
+    """
+    GIVEN a request running the same statement in a loop
+    WHEN the request ends
+    THEN it is flagged, with the stack of the code running the loop
+    """
+    detector = QueryDetector(repeat_threshold=3, time_budget=None)
+    detector.enabled = True
+    detector.watch(db.engine)
+    detector.collected = collected = []
+
+    with app.test_request_context('/api/user/all_users'):
+        detector.start_request()
+        for user_id in range(4):
+            db.session.execute(select(User.role_id).where(User.id == user_id)).all()
+        db.session.execute(text('SELECT 1')).all()
+        findings = detector.end_request()
+
+    assert findings == collected
+    [finding] = findings
+    assert finding['kind'] == 'repeated'
+    assert finding['endpoint'] == 'GET /api/user/all_users'
+    assert finding['message'].startswith('same statement 4 times: select users.role_id from users where users.id = ?')
+    assert 'test_detector_flags_repeated_statements' in finding['stack']
+
+
+def test_detector_time_budget(app, db):
+    detector = QueryDetector(repeat_threshold=100, time_budget=0)
+    detector.enabled = True
+    detector.watch(db.engine)
+
+    with app.test_request_context('/api/product'):
+        detector.start_request()
+        db.session.execute(text('SELECT 1')).all()
+        [finding] = detector.end_request()
+    assert finding['kind'] == 'slow'
+
+    # Statements outside a request are not looked at
+    db.session.execute(text('SELECT 1')).all()
+    with app.test_request_context('/api/product'):
+        assert detector.end_request() == []
@@ -0,0 +1,88 @@
+import pytest
+
+from app import create_app, models
+from app.auth.jwt_auth import generate_custom_auth_token
+from app.replica import replica_router
+from config import Config
+from database import db
+
+
+@pytest.fixture
+def replicated_app(tmp_path):
+    class ReplicatedConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path / "primary.db"}'
+        REPLICA_DATABASE_URI = f'sqlite:///{tmp_path / "replica.db"}'
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+    return create_app(ReplicatedConfig)
+
+
+@pytest.fixture
+def vendor_token(replicated_app):
+    with replicated_app.app_context():
+        role = models.Role(title='vendor')
+        db.session.add(role)
+        db.session.commit()
+        vendor = models.User(username='vendor', password='', balance=0, role_id=role.id)
+        db.session.add(vendor)
+        db.session.commit()
+        token = generate_custom_auth_token(vendor.id, role='vendor')
+    replica_router.sync()
+    return token
+
+
+def test_reads_routed_to_replica(replicated_app, vendor_token):
+    """
+    GIVEN an app with a replica, and a vendor who just added a product
+    WHEN the product is read before the replica is synced
+    THEN the vendor sees it from the primary, other clients don't until the sync
+    """
+    vendor_client = replicated_app.test_client()
+    other_client = replicated_app.test_client()
+    headers = {'Authorization': f'Bearer {vendor_token}'}
+    response = vendor_client.post('/api/product', headers=headers, json={'name': 'Cola', 'cost': 50, 'amount': 3})
+    assert response.status_code == 201
+    product_id = response.get_json()['product']['id']
+
+    assert other_client.get(f'/api/product/{product_id}').status_code == 404
+    assert vendor_client.get(f'/api/product/{product_id}', headers=headers).status_code == 200
+
+    replica_router.sync()
+    response = other_client.get(f'/api/product/{product_id}')
+    assert response.status_code == 200
+    assert int(response.get_json()['product']['amount_available']) == 3
+
+
+def test_reads_sticky_without_cookies(replicated_app, vendor_token):
+    """
+    GIVEN an app with a replica, and an API client that only sends its Bearer token
+    WHEN it signs up, then reads its own user before the replica is synced
+    THEN the read goes to the primary and the new user is found
+    """
+    with replicated_app.app_context():
+        db.session.add(models.Role(title='buyer'))
+        db.session.commit()
+    replica_router.sync()
+    client = replicated_app.test_client(use_cookies=False)
+    response = client.post('/api/user', json={'username': 'NewBuyer', 'password': 'password', 'role': 'buyer'})
+    assert response.status_code == 201
+    user = response.get_json()['user']
+
+    response = client.get(f'/api/user/{user["id"]}', headers={'Authorization': f'Bearer {response.get_json()["token"]}'})
+    assert response.status_code == 200
+    assert response.get_json()['user']['username'] == 'NewBuyer'
+
+
+def test_sticky_window_expires(replicated_app, vendor_token):
+    """
+    GIVEN an app with a replica and a product only the primary has
+    WHEN its vendor reads it past the sticky window of their write
+    THEN the read goes to the replica
+    """
+    client = replicated_app.test_client(use_cookies=False)
+    headers = {'Authorization': f'Bearer {vendor_token}'}
+    response = client.post('/api/product', headers=headers, json={'name': 'Cola', 'cost': 50, 'amount': 3})
+    product_id = response.get_json()['product']['id']
+    assert client.get(f'/api/product/{product_id}', headers=headers).status_code == 200
+
+    replica_router.sticky_seconds = -1
+    assert client.get(f'/api/product/{product_id}', headers=headers).status_code == 404
@@ -0,0 +1,32 @@
+from app.roles import role_registry
+from tests.utils import RoleFactory
+
+
+def test_role_registry_lookups(client, db):
+    """
+    GIVEN the role registry loaded at startup
+    WHEN a role is added and then looked up by id and by title
+    THEN the registry knows about it in both directions
+    """
+    role = RoleFactory.get_or_create(title='registry_test_role', db=db)
+
+    assert role_registry.title(role.id) == 'registry_test_role'
+    assert role_registry.id_for('registry_test_role') == role.id
+
+
+def test_role_registry_refreshed_on_change(client, db):
+    """
+    GIVEN a role the registry already knows
+    WHEN its title is changed through the ORM
+    THEN the registry returns the new title
+    """
+    role = RoleFactory.get_or_create(title='registry_renamed_role', db=db)
+    assert role_registry.title(role.id) == 'registry_renamed_role'
+
+    role.title = 'registry_renamed_role_2'
+    db.session.commit()
+    assert role_registry.title(role.id) == 'registry_renamed_role_2'
+
+    db.session.delete(role)
+    db.session.commit()
+    assert role_registry.title(role.id) is None
@@ -0,0 +1,57 @@
+from sqlalchemy import text
+from sqlalchemy.pool import NullPool, QueuePool
+
+from app import create_app
+from config import Config, ProductionConfig
+from database import db
+
+
+def test_production_profile(tmp_path):
+    """
+    GIVEN the production config pointed at a SQLite file
+    WHEN the app connects to it
+    THEN every connection is in WAL mode with the tuned pragmas, and connections are pooled
+    """
+    class TunedConfig(ProductionConfig):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path / "tuned.db"}'
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+
+    app = create_app(TunedConfig)
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        with db.engine.connect() as connection, db.engine.connect() as other:
+            for conn in (connection, other):
+                assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+                assert conn.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+                assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+                assert conn.execute(text('PRAGMA cache_size')).scalar() == -64 * 1024
+
+
+def test_default_profile(tmp_path):
+    """
+    GIVEN the base config pointed at a SQLite file
+    WHEN the app connects to it
+    THEN the driver defaults are kept: a connection per checkout and the rollback journal
+    """
+    class PlainConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{tmp_path / "plain.db"}'
+        IDEMPOTENCY_SWEEP_INTERVAL = 0
+
+    app = create_app(PlainConfig)
+    with app.app_context():
+        assert isinstance(db.engine.pool, NullPool)
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'delete'
+
+
+def test_testing_profile(app):
+    """
+    GIVEN the app the tests run against
+    WHEN it connects to its database
+    THEN it uses the testing config: the tuned profile with synchronous off, on the test database
+    """
+    with app.app_context():
+        assert app.config['TESTING']
+        assert db.engine.url.database.endswith('database.db_test')
+        assert isinstance(db.engine.pool, QueuePool)
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.session.execute(text('PRAGMA synchronous')).scalar() == 0  # OFF
@@ -100,7 +100,7 @@ class ProductFactory():
     def create(cls, product_name=None, amount_available=None, cost=None, seller_id=None, db=None):
         data = FAKE_PRODUCT_DATA.copy()
 
-        if product_name is None:
+        if product_name is not None:
             data['product_name'] = product_name
 
         if amount_available is not None: